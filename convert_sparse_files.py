@@ -0,0 +1,17 @@
+#!/usr/bin/env python
+import sys
+from voxnet.utilities import convert_sparse_files
+
+# Converts the Matrix Market (.mtx) files of a run directory to HDF5 CSC
+# files next to them; the Python scripts read those in preference.
+# Pass --remove to delete the .mtx files, once the external solver is done.
+
+# setup the run
+param_fn='run_setup.py'
+with open(param_fn) as f:
+    code = compile(f.read(), param_fn, 'exec')
+    exec(code)
+
+remove='--remove' in sys.argv[1:]
+for fn in convert_sparse_files(save_dir,ext='.h5',remove=remove):
+    print "wrote " + fn
@@ -34,6 +34,68 @@ try:
         pass
 except NameError:
     epsilon = 0.0
+
+try:
+    if n_jobs:
+        pass
+except NameError:
+    n_jobs = 1
+
+try:
+    if qc_dir:
+        pass
+except NameError:
+    # QC tables are keyed by source set, so they are shared between runs
+    qc_dir = os.path.join(data_dir, 'experiment_qc')
+
+try:
+    if sparse_targets:
+        pass
+except NameError:
+    # sparse Y files are written in the sparse h5write layout, which the
+    # external solver does not read
+    sparse_targets = False
+
+try:
+    if fold_copies:
+        pass
+except NameError:
+    # by default folds are only recorded as column indices in a manifest
+    # (see voxnet.folds), and the solver commands write the training
+    # matrices of a fold just before fitting it
+    fold_copies = False
+
+try:
+    if matrix_compression:
+        pass
+except NameError:
+    # None keeps X and Y contiguous, so fold columns are read by memory
+    # mapping; 'gzip', 'lzf' or 'lz4' chunk them by columns and compress
+    matrix_compression = None
+
+try:
+    if solver_sparse_ext:
+        pass
+except NameError:
+    # format of the sparse solver inputs (Laplacians, Omega_train); the
+    # external solver reads Matrix Market only. Other sparse files are
+    # written as HDF5 CSC.
+    solver_sparse_ext = '.mtx'
+
+try:
+    if path_fits:
+        pass
+except NameError:
+    # True writes one command per inner fold and hemisphere, fitting all of
+    # lambda_list with warm starts (voxnet.path), instead of one external
+    # solver command per lambda
+    path_fits = False
+
+try:
+    if path_early_stop:
+        pass
+except NameError:
+    path_early_stop = False
     
 
 experiment_dict= \
@@ -47,7 +109,10 @@ experiment_dict= \
                           fit_gaussian=fit_gaussian,
                           cre=cre,
                           max_injection_volume=max_injection_volume,
-                          epsilon = epsilon)
+                          epsilon = epsilon,
+                          n_jobs = n_jobs,
+                          qc_dir = qc_dir,
+                          sparse_targets = sparse_targets)
 experiment_dict['source_acro']=np.array(source_acronyms,dtype=np.object)
 experiment_dict['source_ids']=np.array(sources.id)
 experiment_dict['target_acro']=np.array(target_acronyms,dtype=np.object)
@@ -62,7 +127,6 @@ savemat(save_file_name,experiment_dict,oned_as='column',do_compression=True)
 
 if save_mtx:
     # only save X, Y, Lx, Ly
-    from scipy.io import mmwrite
     X=experiment_dict['experiment_source_matrix'].T
     Y_ipsi=experiment_dict['experiment_target_matrix_ipsi'].T
     Y_contra=experiment_dict['experiment_target_matrix_contra'].T
@@ -70,22 +134,33 @@ if save_mtx:
     Ly_ipsi=experiment_dict['Ly_ipsi'].T
     Ly_contra=experiment_dict['Ly_contra'].T
     Omega=experiment_dict['Omega'].T
-    h5write(os.path.join(save_dir,save_stem+'_X.h5'),X)
-    h5write(os.path.join(save_dir,save_stem+'_Y_ipsi.h5'),Y_ipsi)
-    h5write(os.path.join(save_dir,save_stem+'_Y_contra.h5'),Y_contra)
-    Lx_fn=absjoin(save_dir,save_stem+'_Lx.mtx')
-    Ly_ipsi_fn=absjoin(save_dir,save_stem+'_Ly_ipsi.mtx')
-    Ly_contra_fn=absjoin(save_dir,save_stem+'_Ly_contra.mtx')
-    mmwrite(Lx_fn,Lx)
-    mmwrite(Ly_ipsi_fn,Ly_ipsi)
-    mmwrite(Ly_contra_fn,Ly_contra)
-    mmwrite(os.path.join(save_dir,save_stem+'_Omega.mtx'),Omega)
+    from voxnet.matrix_store import write_matrix
+    inj_labels=experiment_dict['row_label_list']
+    metadata={'save_stem':save_stem,'resolution':resolution}
+    for suffix,mat,kind in [('_X.h5',X,'source'),
+                            ('_Y_ipsi.h5',Y_ipsi,'target_ipsi'),
+                            ('_Y_contra.h5',Y_contra,'target_contra')]:
+        write_matrix(os.path.join(save_dir,save_stem+suffix),mat,
+                     row_labels=experiment_dict['col_label_list_'+kind],
+                     col_labels=inj_labels,
+                     row_coords=experiment_dict['voxel_coords_'+kind],
+                     metadata=metadata,compression=matrix_compression)
+    Lx_fn=absjoin(save_dir,save_stem+'_Lx'+solver_sparse_ext)
+    Ly_ipsi_fn=absjoin(save_dir,save_stem+'_Ly_ipsi'+solver_sparse_ext)
+    Ly_contra_fn=absjoin(save_dir,save_stem+'_Ly_contra'+solver_sparse_ext)
+    sparse_write(Lx_fn,Lx)
+    sparse_write(Ly_ipsi_fn,Ly_ipsi)
+    sparse_write(Ly_contra_fn,Ly_contra)
+    sparse_write(os.path.join(save_dir,save_stem+'_Omega.h5'),Omega)
     # h5write(os.path.join(save_dir,save_stem+'_W0_ipsi.h5'),
     #         np.zeros((Y_ipsi.shape[0],X.shape[0])))
     # h5write(os.path.join(save_dir,save_stem+'_W0_contra.h5'),
     #         np.zeros((Y_contra.shape[0],X.shape[0])))
     if cross_val_matrices:
         from sklearn import cross_validation
+        from voxnet.folds import FoldManifest, manifest_fn, \
+          materialize_command
+        manifest=FoldManifest()
         fid=open(cmdfile,'w')
         n_inj=X.shape[1]
         # Sets up nested outer/inner cross-validation. The inner loop is for
@@ -98,14 +173,7 @@ if save_mtx:
                                               shuffle=True,
                                               random_state=shuffle_seed)
         for i,(train,test) in enumerate(outer_sets):
-            X_train=X[:,train]
-            X_test=X[:,test]
-            Y_train_ipsi=Y_ipsi[:,train]
-            Y_test_ipsi=Y_ipsi[:,test]
-            Omega_train = Omega[:,train]
-            Omega_test = Omega[:,test]
-            Y_train_contra=Y_contra[:,train]
-            Y_test_contra=Y_contra[:,test]
+            manifest.add('cval%d'%i,train,test)
             # setup some directories
             outer_dir=os.path.join(save_dir,'cval%d'%i)
             try:
@@ -122,15 +190,11 @@ if save_mtx:
                     os.mkdir(inner_dir)
                 except OSError:
                     pass
-                # pull all inner training/testing sets from outer training sets
-                X_train_inner=X_train[:,train_inner]
-                X_test_inner=X_train[:,test_inner]
-                Y_train_ipsi_inner=Y_train_ipsi[:,train_inner]
-                Y_test_ipsi_inner=Y_train_ipsi[:,test_inner]
-                Y_train_contra_inner=Y_train_contra[:,train_inner]
-                Y_test_contra_inner=Y_train_contra[:,test_inner]
-                Omega_train_inner = Omega_train[:,train_inner]
-                Omega_test_inner = Omega_train[:,test_inner]
+                # inner training/testing sets are drawn from the outer
+                # training set; the manifest holds their master columns
+                train_inner=train[train_inner]
+                test_inner=train[test_inner]
+                manifest.add('cval%d/cval%d'%(i,j),train_inner,test_inner)
                 # filenames
                 X_train_fn=absjoin(inner_dir,'X_train.h5')
                 X_test_fn=absjoin(inner_dir,'X_test.h5')
@@ -138,34 +202,51 @@ if save_mtx:
                 Y_train_contra_fn=absjoin(inner_dir,'Y_train_contra.h5')
                 Y_test_ipsi_fn=absjoin(inner_dir,'Y_test_ipsi.h5')
                 Y_test_contra_fn=absjoin(inner_dir,'Y_test_contra.h5')
-                Omega_train_inner_fn=absjoin(inner_dir,'Omega_train.mtx')
-                Omega_test_inner_fn=absjoin(inner_dir,'Omega_test.mtx')
+                Omega_train_inner_fn=absjoin(inner_dir,
+                                             'Omega_train'+solver_sparse_ext)
+                Omega_test_inner_fn=absjoin(inner_dir,'Omega_test.h5')
                 # save matrices
-                h5write(X_train_fn,X_train_inner)
-                h5write(X_test_fn,X_test_inner)
-                h5write(Y_train_ipsi_fn,Y_train_ipsi_inner)
-                h5write(Y_train_contra_fn,Y_train_contra_inner)
-                h5write(Y_test_ipsi_fn,Y_test_ipsi_inner)
-                h5write(Y_test_contra_fn,Y_test_contra_inner)
-                mmwrite(Omega_train_inner_fn,Omega_train_inner)
-                mmwrite(Omega_test_inner_fn,Omega_test_inner)
+                if fold_copies:
+                    h5write(X_train_fn,X[:,train_inner])
+                    h5write(X_test_fn,X[:,test_inner])
+                    h5write(Y_train_ipsi_fn,Y_ipsi[:,train_inner])
+                    h5write(Y_train_contra_fn,Y_contra[:,train_inner])
+                    h5write(Y_test_ipsi_fn,Y_ipsi[:,test_inner])
+                    h5write(Y_test_contra_fn,Y_contra[:,test_inner])
+                    sparse_write(Omega_train_inner_fn,Omega[:,train_inner])
+                    sparse_write(Omega_test_inner_fn,Omega[:,test_inner])
+                    prefix=[]
+                else:
+                    prefix=[materialize_command(save_dir,save_stem,
+                                                'cval%d/cval%d'%(i,j),
+                                                solver_sparse_ext),'&&']
                 # setup commands to run for model selection
+                if path_fits:
+                    from voxnet.path import path_command
+                    for hemisphere in ['ipsi','contra']:
+                        cmd=path_command(save_dir,save_stem,
+                                         'cval%d/cval%d'%(i,j),hemisphere,
+                                         lambda_list,
+                                         early_stop=path_early_stop)
+                        print cmd
+                        fid.write(cmd+'\n')
+                    continue
                 for k,lambda_val in enumerate(lambda_list):
                     output_ipsi=absjoin(inner_dir,"W_ipsi_%1.4e.h5"%lambda_val)
                     output_contra=absjoin(inner_dir,
                                           "W_contra_%1.4e.h5"%lambda_val)
                     lambda_str="%1.4e" % lambda_val
-                    cmd_ipsi=' '.join([solver,'--W0_init',
-                                       Omega_train_inner_fn,
-                                       X_train_fn,Y_train_ipsi_fn,
-                                       Lx_fn,Ly_ipsi_fn,
-                                       lambda_str,output_ipsi])
+                    cmd_ipsi=' '.join(prefix+[solver,'--W0_init',
+                                              Omega_train_inner_fn,
+                                              X_train_fn,Y_train_ipsi_fn,
+                                              Lx_fn,Ly_ipsi_fn,
+                                              lambda_str,output_ipsi])
                     print cmd_ipsi
                     fid.write(cmd_ipsi+'\n')
-                    cmd_contra=' '.join([solver,'--W0_init',
-                                         X_train_fn,Y_train_contra_fn,
-                                         Lx_fn,Ly_contra_fn,
-                                         lambda_str,output_contra])
+                    cmd_contra=' '.join(prefix+[solver,'--W0_init',
+                                                X_train_fn,Y_train_contra_fn,
+                                                Lx_fn,Ly_contra_fn,
+                                                lambda_str,output_contra])
                     print cmd_contra
                     fid.write(cmd_contra+'\n')
             # We will need these outer cross-validation sets and fit the
@@ -177,14 +258,16 @@ if save_mtx:
             Y_train_contra_fn=absjoin(outer_dir,'Y_train_contra.h5')
             Y_test_ipsi_fn=absjoin(outer_dir,'Y_test_ipsi.h5')
             Y_test_contra_fn=absjoin(outer_dir,'Y_test_contra.h5')
-            Omega_train_fn=absjoin(outer_dir,'Omega_train.mtx')
-            Omega_test_fn=absjoin(outer_dir,'Omega_test.mtx')
-            h5write(X_train_fn,X_train)
-            h5write(X_test_fn,X_test)
-            h5write(Y_train_ipsi_fn,Y_train_ipsi)
-            h5write(Y_train_contra_fn,Y_train_contra)
-            h5write(Y_test_ipsi_fn,Y_test_ipsi)
-            h5write(Y_test_contra_fn,Y_test_contra)
-            mmwrite(Omega_train_fn,Omega_train)
-            mmwrite(Omega_test_fn,Omega_test)
+            Omega_train_fn=absjoin(outer_dir,'Omega_train'+solver_sparse_ext)
+            Omega_test_fn=absjoin(outer_dir,'Omega_test.h5')
+            if fold_copies:
+                h5write(X_train_fn,X[:,train])
+                h5write(X_test_fn,X[:,test])
+                h5write(Y_train_ipsi_fn,Y_ipsi[:,train])
+                h5write(Y_train_contra_fn,Y_contra[:,train])
+                h5write(Y_test_ipsi_fn,Y_ipsi[:,test])
+                h5write(Y_test_contra_fn,Y_contra[:,test])
+                sparse_write(Omega_train_fn,Omega[:,train])
+                sparse_write(Omega_test_fn,Omega[:,test])
         fid.close()
+        manifest.save(manifest_fn(save_dir,save_stem))
@@ -4,7 +4,8 @@ import glob
 from voxnet.utilities import absjoin
 from scipy.io import mmread
 from scipy.linalg import norm
-from scipy.io import savemat
+from scipy.io import savemat, loadmat
+from voxnet.regional import construct_proj_op
 import pandas as pd
 
 # setup the run
@@ -13,6 +14,11 @@ with open(param_fn) as f:
     code = compile(f.read(), param_fn, 'exec')
     exec(code)
 
+# regional projections of the targets, from the voxel labels of the run
+mat=loadmat(os.path.join(save_dir,save_stem + '.mat'))
+P_Y_ipsi=construct_proj_op(mat['col_label_list_target_ipsi'])[0]
+P_Y_contra=construct_proj_op(mat['col_label_list_target_contra'])[0]
+
 err_fun=error_MSE
 
 # def sq_error_fro(resid):
@@ -33,3 +33,10 @@ else:
 laplacian='free'
 shuffle_seed=666
 max_injection_volume=0.7
+n_jobs=1 # processes for building voxel matrices, -1 for all cpus
+sparse_targets=False # store Y sparse (not readable by the external solver)
+solver_sparse_ext='.mtx' # Laplacian/Omega format for the solver
+path_fits=False # one warm-started lambda path per fold instead of cmds
+path_early_stop=False
+cv_n_jobs=1 # fit processes of run_nested_cv.py, -1 for all cpus
+eval_n_threads=1 # threads per fold evaluating errors in model_select_and_fit.py
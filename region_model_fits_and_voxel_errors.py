@@ -1,12 +1,16 @@
 import os
 import numpy as np
 import scipy.optimize as sopt
-from scipy.linalg import norm,pinv,kron
-from scipy.io import loadmat,savemat,mmread
+from scipy.linalg import norm
+from scipy.io import loadmat,savemat
 from sklearn import cross_validation, metrics
 import pandas as pd
 import glob
-from voxnet.utilities import absjoin,h5read
+from voxnet.utilities import absjoin,h5read,dense_array,sparse_read,\
+  find_sparse_file
+from voxnet.folds import FoldReader, manifest_fn, fold_path
+from voxnet.regional import regional_loo_fits, fit_masked_regional, \
+  construct_proj_op
 from scipy.sparse import find as spfind
 
 # relative error type
@@ -19,6 +23,12 @@ with open(param_fn) as f:
     code = compile(f.read(), param_fn, 'exec')
     exec(code)
 
+try:
+    if cv_n_jobs:
+        pass
+except NameError:
+    cv_n_jobs = 1
+
 save_file_name=os.path.join(save_dir,save_stem + '.mat')
 mat=loadmat(save_file_name)
 locals().update(mat) # load into locals namespace (MATLAB-like)
@@ -29,15 +39,9 @@ def proj_Omega(Y,Omega):
     Y[Omega_idx[0],Omega_idx[1]] = 0.0
     return Y
 
-def fit_linear_model_proj(X,Y,P_Y_dag,P_X,Omega):
-    A=kron(X.T.dot(P_X.T),P_Y_dag)
-    for ii in range(tmp.shape[1]):
-        col=A[:,ii]
-        col_proj=proj_Omega(col.reshape(Y.shape,order='F'),Omega)
-        A[:,ii]=col_proj.flatten(order='F')
-    b=proj_Omega(Y,Omega).flatten(order='F')
-    W=sopt.nnls(A,b)[0]
-    return W.reshape((P_Y_dag.shape[1],P_X.shape[0]),order='F')
+def fit_linear_model_proj(X,Y,P_Y_dag,P_X,Omega,W0=None):
+    """Regional W fit to voxel targets outside Omega, Y=P_Y_dag W P_X X"""
+    return fit_masked_regional(X,Y,P_Y_dag,P_X,Omega,W0=W0).W
 
 def fit_linear_model(X, Y, col_wise=False):
     """Y=WX convention unless col_wise is True"""
@@ -52,18 +56,6 @@ def fit_linear_model(X, Y, col_wise=False):
         W=W.T
     return W
 
-def construct_proj_op(label_list):
-    unique_labels=np.unique(label_list)
-    n_vox=len(label_list)
-    n_reg=len(unique_labels)
-    proj=np.zeros((n_reg,n_vox))
-    proj_pinv=np.zeros((n_vox,n_reg))
-    for i,r in enumerate(unique_labels):
-        r_idx=np.where(label_list==r)[0]
-        proj[i,r_idx]=1.
-    proj_pinv=pinv(proj)
-    return (proj,proj_pinv)
-
 def error_MSE(resid):
     """Computes mean squared error
 
@@ -83,15 +75,21 @@ def error_RMSE(resid):
     return np.sqrt(error_MSE(resid))
 
 
-def region_CV_fits_and_errors(X,Y,P_X,P_Y,P_Y_dag,err_fun,Omega=None):
+def region_CV_fits_and_errors(X,Y,P_X,P_Y,P_Y_dag,err_fun,Omega=None,
+                              n_jobs=1):
     n_inj=X.shape[1]
     outer_sets=cross_validation.LeaveOneOut(n_inj)
+    if Omega is None:
+        # all leave-one-out fits at once, updated from the full data fit
+        W_loo=regional_loo_fits(P_X.dot(X),P_Y.dot(Y),n_jobs=n_jobs,
+                                verbose=True)[1]
     err_reg=np.zeros((len(outer_sets),))
     err_homog=np.zeros((len(outer_sets),))
     rel_err_reg=np.zeros((len(outer_sets),))
     rel_err_homog=np.zeros((len(outer_sets),))
     GOF_reg=np.zeros((len(outer_sets),))
     GOF_homog=np.zeros((len(outer_sets),))
+    W=None
     for i,(train,test) in enumerate(outer_sets):
         # compare models in outer sets only, same as eventual test errors in the
         # nested cross-validation procedure
@@ -102,9 +100,11 @@ def region_CV_fits_and_errors(X,Y,P_X,P_Y,P_Y_dag,err_fun,Omega=None):
         if Omega is not None:
             Omega_train=Omega[:,train]
             Omega_test=Omega[:,test]
-            W=fit_linear_model_proj(X_train,Y_train,P_Y_dag,P_X,Omega_train)
+            # warm start from the previous fold's fit
+            W=fit_linear_model_proj(X_train,Y_train,P_Y_dag,P_X,Omega_train,
+                                    W0=W)
         else:
-            W=fit_linear_model(P_X.dot(X_train),P_Y.dot(Y_train))
+            W=W_loo[i] # fold i leaves out injection i
         Y_pred=W.dot(P_X.dot(X_test))
         Y_pred_homog=P_Y_dag.dot(Y_pred)
         Y_test_reg=P_Y.dot(Y_test)
@@ -160,13 +160,14 @@ P_Y_contra,P_Y_contra_dag=construct_proj_op(col_label_list_target_contra)
 
 Omega=Omega.T
 X=experiment_source_matrix.T
-Y_ipsi=experiment_target_matrix_ipsi.T
-Y_contra=experiment_target_matrix_contra.T
+# targets may have been saved sparse
+Y_ipsi=dense_array(experiment_target_matrix_ipsi).T
+Y_contra=dense_array(experiment_target_matrix_contra).T
 #err=pd.DataFrame(np.nan((len(outer_sets),2), columns=['err_reg','err_vox_proj'])
 errs_ipsi=region_CV_fits_and_errors(X,Y_ipsi,P_X,P_Y_ipsi,P_Y_ipsi_dag,
                                     error_MSE,Omega)
 errs_contra=region_CV_fits_and_errors(X,Y_contra,P_X,P_Y_contra,P_Y_contra_dag,
-                                      error_MSE)
+                                      error_MSE,n_jobs=cv_n_jobs)
 
 
 errs_reg = pd.DataFrame(np.vstack((errs_ipsi,errs_contra)).T,
@@ -187,6 +188,10 @@ Ly_contra_fn=absjoin(save_dir,save_stem+'_Ly_contra.mtx')
 # loop through the outer loop (validation sets)
 outer_dir_list=glob.glob(save_dir+'/cval*')
 n_cval=len(outer_dir_list)
+if os.path.exists(manifest_fn(save_dir,save_stem)):
+    folds=FoldReader.for_run(save_dir,save_stem)
+else:
+    folds=None
 err_ipsi=np.zeros((n_cval,))
 err_contra=np.zeros((n_cval,))
 err_reg_ipsi=np.zeros((n_cval,))
@@ -202,7 +207,7 @@ for o_idx,outer_dir in enumerate(outer_dir_list):
     Y_test_ipsi_fn=absjoin(outer_dir,'Y_test_ipsi.h5')
     Y_test_contra_fn=absjoin(outer_dir,'Y_test_contra.h5')
     W_ipsi_fn=glob.glob(absjoin(outer_dir,'W_ipsi_opt_*.h5'))
-    Omega_test_fn=absjoin(outer_dir,'Omega_test.mtx')
+    Omega_test_fn=find_sparse_file(absjoin(outer_dir,'Omega_test'))
     if len(W_ipsi_fn) > 1:
         raise Exception('More than one W_ipsi_opt_*.h5')
     elif len(W_ipsi_fn) == 0:
@@ -214,10 +219,17 @@ for o_idx,outer_dir in enumerate(outer_dir_list):
         raise Exception('More than one W_contra_opt_*.h5')
     else:
         W_contra_fn=W_contra_fn[0]
-    X_test=h5read(X_test_fn)
-    Y_test_ipsi=h5read(Y_test_ipsi_fn)
-    Omega=mmread(Omega_test_fn)
-    Y_test_contra=h5read(Y_test_contra_fn)
+    if folds is not None:
+        path=fold_path(save_dir,outer_dir)
+        X_test=folds.read('X',path,'test',dense=True)
+        Y_test_ipsi=folds.read('Y_ipsi',path,'test',dense=True)
+        Omega=folds.read('Omega',path,'test')
+        Y_test_contra=folds.read('Y_contra',path,'test',dense=True)
+    else:
+        X_test=h5read(X_test_fn)
+        Y_test_ipsi=h5read(Y_test_ipsi_fn,dense=True)
+        Omega=sparse_read(Omega_test_fn)
+        Y_test_contra=h5read(Y_test_contra_fn,dense=True)
     W_ipsi=h5read(W_ipsi_fn)
     W_contra=h5read(W_contra_fn)
     Y_pred_ipsi=W_ipsi.dot(X_test)
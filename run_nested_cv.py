@@ -0,0 +1,24 @@
+#!/usr/bin/env python
+from voxnet.lossfun import rel_MSE_2
+from voxnet.nested_cv import run_nested_cv
+
+# setup the run
+param_fn='run_setup.py'
+with open(param_fn) as f:
+    code = compile(f.read(), param_fn, 'exec')
+    exec(code)
+
+try:
+    if cv_n_jobs:
+        pass
+except NameError:
+    cv_n_jobs = 1
+
+print "Running nested cross-validation for run %s" % save_stem
+selected=run_nested_cv(save_dir,save_stem,lambda_list,
+                       select_one_lambda=select_one_lambda,
+                       lambda_fn=lambda_fn,n_jobs=cv_n_jobs,loss=rel_MSE_2,
+                       verbose=True)
+for outer,(lambda_ipsi,lambda_contra) in selected.items():
+    print '%s: lambda_ipsi=%1.4e, lambda_contra=%1.4e' % \
+      (outer,lambda_ipsi,lambda_contra)
@@ -0,0 +1,72 @@
+'''
+Writes voxel_matrices_baseline.npz, the outputs of the original
+structure-major generate_voxel_matrices on the synthetic atlas, against
+which tests/test_voxel_matrices.py checks the current implementation.
+
+Run it with a checkout of the original voxnet package (before the
+experiment-major rewrite) first on the path, with voxnet/synthetic.py
+copied into it:
+
+    PYTHONPATH=<old checkout> python make_voxel_matrices_baseline.py
+
+Two fixes are applied to the old code before running it, as they are
+intentional changes of behavior:
+  * shell_mask is a dilation by a (2*radius+1)^3 cube, dropping negative
+    coordinates; the old one returned wrong shells, and its negative
+    coordinates wrapped around in mask_intersection
+  * the warnings about LIMS error codes, which referenced undefined names,
+    are silenced; the values are zeroed as before
+'''
+import os
+import sys
+import numpy as np
+import scipy.sparse as sp
+import voxnet.mask
+import voxnet.utilities
+import voxnet.matrices
+from voxnet.synthetic import SyntheticConnectivityCache
+
+# settings as (seed, laplacian, source_shell)
+SETTINGS = [(0, 'boundary', None), (0, 'free', 1), (0, 'boundary', 2)]
+
+def setting_key(seed, laplacian, source_shell):
+    return 'seed%d_%s_shell%s' % (seed, laplacian, source_shell)
+
+def shell_mask(mask, radius=1):
+    from scipy.ndimage import binary_dilation
+    voxels = np.array(mask, dtype=int).T
+    lower = voxels.min(axis=0) - radius
+    box = np.zeros(voxels.max(axis=0) - lower + radius + 1, dtype=bool)
+    box[tuple((voxels - lower).T)] = True
+    dilated = binary_dilation(box, structure=np.ones((2*radius+1,)*3,
+                                                     dtype=bool))
+    shell_voxels = np.array(np.nonzero(dilated)) + lower.reshape((3,1))
+    inside = np.all(shell_voxels >= 0, axis=0)
+    return tuple([col for col in shell_voxels[:,inside]])
+
+def main(fn):
+    voxnet.mask.shell_mask = shell_mask
+    voxnet.utilities.shell_mask = shell_mask
+    voxnet.utilities.warn = lambda *args: None
+    voxnet.utilities.curr_LIMS_id = 0
+    out = {}
+    for seed, laplacian, source_shell in SETTINGS:
+        mcc = SyntheticConnectivityCache(seed=seed)
+        ex = voxnet.matrices.generate_voxel_matrices(
+            mcc, mcc.structures(), mcc.structures(), source_coverage=0.3,
+            min_voxels_per_injection=0, laplacian=laplacian,
+            source_shell=source_shell)
+        key = setting_key(seed, laplacian, source_shell)
+        for field, val in ex.items():
+            if sp.issparse(val):
+                val = sp.coo_matrix(val)
+                for part in ('row', 'col', 'data'):
+                    out['%s/%s/%s' % (key, field, part)] = getattr(val, part)
+                out['%s/%s/shape' % (key, field)] = np.array(val.shape)
+            else:
+                out['%s/%s' % (key, field)] = np.asarray(val)
+    np.savez_compressed(fn, **out)
+
+if __name__ == '__main__':
+    main(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      'voxel_matrices_baseline.npz'))
@@ -0,0 +1,38 @@
+'''
+Reference solutions of the nonnegative fits, from scipy.optimize.nnls on
+their explicit Kronecker form.
+'''
+import numpy as np
+from scipy.optimize import nnls
+
+def dense(A):
+    if hasattr(A, 'toarray'):
+        return A.toarray()
+    return np.asarray(A, dtype=np.float64)
+
+def kronecker_nnls(W_shape, terms):
+    '''
+    Solution of
+
+      min_{W >= 0} sum_k ||M_k * (L_k W R_k - B_k)||^2
+
+    over the terms (L_k, R_k, B_k, M_k), with M_k a boolean array of the
+    entries kept (None: all of them). Uses vec(L W R) = (R^T kron L) vec(W),
+    vec stacking columns, with the masked entries dropped as rows.
+
+    Returns
+    -------
+    W : (W_shape) array
+    objective : float
+    '''
+    A, b = [], []
+    for L, R, B, M in terms:
+        A_k = np.kron(dense(R).T, dense(L))
+        b_k = dense(B).ravel(order='F')
+        if M is not None:
+            keep = np.asarray(M, dtype=bool).ravel(order='F')
+            A_k, b_k = A_k[keep], b_k[keep]
+        A.append(A_k)
+        b.append(b_k)
+    w, res = nnls(np.vstack(A), np.concatenate(b))
+    return w.reshape(W_shape, order='F'), res**2
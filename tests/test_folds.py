@@ -0,0 +1,40 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from voxnet.folds import FoldManifest
+
+class TestFoldManifest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.fn = os.path.join(self.tmp_dir, 'run_folds.h5')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_leave_one_out_round_trip(self):
+        # nested leave-one-out folds of 80 injections: 6400 paths, more
+        # than fit in an HDF5 attribute
+        n_inj = 80
+        manifest = FoldManifest()
+        cols = np.arange(n_inj)
+        for i in range(n_inj):
+            train = np.delete(cols, i)
+            manifest.add('cval%d' % i, train, [i])
+            for j in range(n_inj - 1):
+                manifest.add('cval%d/cval%d' % (i, j),
+                             np.delete(train, j), train[j:j+1])
+        manifest.save(self.fn)
+        loaded = FoldManifest.load(self.fn)
+        self.assertEqual(list(loaded.folds), list(manifest.folds))
+        for path in manifest.folds:
+            np.testing.assert_array_equal(loaded.train(path),
+                                          manifest.train(path))
+            np.testing.assert_array_equal(loaded.test(path),
+                                          manifest.test(path))
+        self.assertEqual(loaded.paths(), ['cval%d' % i for i in range(n_inj)])
+        self.assertEqual(len(loaded.paths('cval3')), n_inj - 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import unittest
+import numpy as np
+from voxnet.mask import FlatMask, neighbor_offsets
+from voxnet.matrices import region_laplacian, masks_laplacian
+
+def dict_laplacian(voxels):
+    '''
+    Reference: 6-neighbor laplacian from a dict of the voxels, which keeps
+    the last index of a voxel listed more than once.
+    '''
+    lookup = dict((tuple(vox), idx) for idx, vox in enumerate(voxels))
+    L = np.zeros((len(voxels), len(voxels)))
+    for idx, vox in enumerate(voxels):
+        for offset in neighbor_offsets(6):
+            idx_nei = lookup.get(tuple(vox + offset))
+            if idx_nei is not None:
+                L[idx, idx_nei] = 1
+                L[idx, idx] -= 1
+    return L
+
+class TestRegionLaplacian(unittest.TestCase):
+    def test_matches_dict_lookup(self):
+        rng = np.random.RandomState(7)
+        voxels = np.array(np.nonzero(rng.rand(5, 6, 4) < 0.6)).T
+        L = region_laplacian(tuple(voxels.T))
+        np.testing.assert_array_equal(L.toarray(), dict_laplacian(voxels))
+
+    def test_overlapping_free_masks(self):
+        shape = (6, 6, 6)
+        a = np.zeros(shape, dtype=bool)
+        b = np.zeros(shape, dtype=bool)
+        a[1:4, 1:4, 1:4] = True
+        b[2:5, 2:5, 2:5] = True
+        masks = [ FlatMask.from_volume(a), FlatMask.from_volume(b) ]
+        voxels = np.vstack([ np.array(a.nonzero()).T,
+                             np.array(b.nonzero()).T ])
+        L = masks_laplacian(masks, 'free')
+        np.testing.assert_array_equal(L.toarray(), dict_laplacian(voxels))
+
+if __name__ == '__main__':
+    unittest.main()
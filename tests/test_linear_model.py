@@ -0,0 +1,73 @@
+import unittest
+import numpy as np
+from scipy import stats
+from scipy.optimize import nnls
+from voxnet.linear_model import LinearModel, support_ols
+
+def column_ols(A, b):
+    '''
+    Single-column least squares reference: coefficients, standard errors
+    and p-values as statsmodels.OLS computes them.
+    '''
+    x = np.linalg.lstsq(A, b, rcond=None)[0]
+    df_resid = A.shape[0] - np.linalg.matrix_rank(A)
+    scale = np.sum((b - np.dot(A, x))**2) / df_resid
+    se = np.sqrt(np.diag(np.linalg.pinv(np.dot(A.T, A))) * scale)
+    return x, se, 2 * stats.t.sf(np.abs(x / se), df_resid)
+
+class Ontology(object):
+    acronym_id_dict = {'VISp': 11}
+
+class TestSupportOLS(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.A = rng.rand(30, 8)
+        self.B = rng.rand(30, 12)
+        self.support = rng.rand(8, 12) < 0.5
+        # shared support patterns, a rank deficient one and an empty one
+        self.support[:, 1] = self.support[:, 0]
+        self.support[:, 2] = False
+        self.A[:, 7] = self.A[:, 6]
+        self.support[:, 3] = False
+        self.support[5:8, 3] = True
+
+    def test_matches_column_ols(self):
+        params, bse, pvalues = support_ols(self.A, self.B, self.support)
+        for jj in range(self.B.shape[1]):
+            rows = np.flatnonzero(self.support[:, jj])
+            outside = np.setdiff1d(np.arange(self.A.shape[1]), rows)
+            self.assertTrue(np.all(np.isnan(pvalues[outside, jj])))
+            if len(rows) == 0:
+                continue
+            x, se, p = column_ols(self.A[:, rows], self.B[:, jj])
+            np.testing.assert_allclose(params[rows, jj], x, rtol=1e-8,
+                                       atol=1e-10)
+            np.testing.assert_allclose(bse[rows, jj], se, rtol=1e-8)
+            np.testing.assert_allclose(pvalues[rows, jj], p, rtol=1e-6,
+                                       atol=1e-12)
+
+class TestRunRegression(unittest.TestCase):
+    def test_p_values(self):
+        rng = np.random.RandomState(1)
+        A = rng.rand(40, 6)
+        B = np.dot(A, rng.rand(6, 5) * (rng.rand(6, 5) < 0.5)) + \
+          0.05 * rng.rand(40, 5)
+        W = np.array([ nnls(A, B[:, jj])[0] for jj in range(5) ]).T
+        labels = [11, 12, 13, 14, 15, 16]
+        model = LinearModel.__new__(LinearModel)
+        model.W, model.P, model.ontology = W, [], Ontology()
+        model.row_labels = labels
+        model.col_labels = labels[:5]
+        # acronyms may come as unicode
+        model.run_regression(A, B, [u'VISp'] + labels[1:5],
+                             ['VISp'] + labels[1:], default_p_value=np.inf)
+        for jj in range(5):
+            rows = np.flatnonzero(W[:, jj])
+            self.assertTrue(np.all(np.isinf(np.delete(model.P[:, jj],
+                                                      rows))))
+            p = column_ols(A[:, rows], B[:, jj])[2]
+            np.testing.assert_allclose(model.P[rows, jj], p, rtol=1e-6,
+                                       atol=1e-12)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+import numpy as np
+import scipy.sparse as sp
+from voxnet.lossfun import OmegaMask, eval_losses, sum_losses, rel_MSE_2
+
+def dense_losses(W, X, Y, Omega, P_Y):
+    '''
+    Reference: the masked prediction, target and residual formed in full.
+    '''
+    keep = (Omega.toarray() == 0)
+    pred = np.dot(W, X) * keep
+    target = Y * keep
+    resid = pred - target
+    sq = lambda A: np.sum(A**2)
+    return [ sq(resid), sq(target), sq(pred), sq(P_Y.dot(resid)),
+             sq(P_Y.dot(target)), sq(P_Y.dot(pred)) ]
+
+class TestEvalLosses(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.W = rng.rand(20, 15)
+        self.X = rng.rand(15, 11)
+        self.Y = rng.rand(20, 11)
+        # sparse in some columns, dense in others, so that both ways of
+        # masking a block are used
+        Omega = rng.rand(20, 11) < 0.05
+        Omega[:, 3:5] = rng.rand(20, 2) < 0.8
+        self.Omega = sp.csc_matrix(Omega.astype(float))
+        self.P_Y = sp.csr_matrix(np.kron(np.eye(4), np.ones((1, 5))))
+        self.ref = dense_losses(self.W, self.X, self.Y, self.Omega, self.P_Y)
+
+    def check(self, losses):
+        np.testing.assert_allclose(losses[:6], self.ref, rtol=1e-12)
+        self.assertEqual(losses.n_inj, self.Y.shape[1])
+
+    def test_blocks(self):
+        for block_size in [None, 1, 3, 11]:
+            self.check(eval_losses(self.W, self.X, self.Y, self.Omega,
+                                   self.P_Y, block_size=block_size))
+
+    def test_reused_mask_and_sparse_Y(self):
+        omega = OmegaMask(self.Omega)
+        for k in range(2):
+            self.check(eval_losses(self.W, self.X, sp.csr_matrix(self.Y),
+                                   omega, self.P_Y, block_size=4))
+
+    def test_stored_zeros_are_kept(self):
+        Omega = sp.coo_matrix(self.Omega)
+        rows, cols = np.nonzero(self.Omega.toarray() == 0)
+        Omega = sp.coo_matrix((np.concatenate([Omega.data,
+                                               np.zeros(5)]),
+                               (np.concatenate([Omega.row, rows[:5]]),
+                                np.concatenate([Omega.col, cols[:5]]))),
+                              shape=Omega.shape)
+        self.assertEqual(Omega.nnz, self.Omega.nnz + 5)
+        self.check(eval_losses(self.W, self.X, self.Y, Omega, self.P_Y))
+        self.assertAlmostEqual(rel_MSE_2(self.W, self.X, self.Y, Omega),
+                               rel_MSE_2(self.W, self.X, self.Y, self.Omega))
+
+    def test_losses(self):
+        losses = eval_losses(self.W, self.X, self.Y, self.Omega)
+        sq_error, sq_target, sq_pred = self.ref[:3]
+        self.assertAlmostEqual(losses.mse, sq_error / self.Y.shape[1])
+        self.assertAlmostEqual(losses.rel_mse, sq_error / sq_target)
+        self.assertAlmostEqual(rel_MSE_2(self.W, self.X, self.Y, self.Omega),
+                               2 * sq_error / (sq_target + sq_pred))
+        self.assertTrue(np.isnan(losses.sq_error_reg))
+
+    def test_sum_over_rows(self):
+        parts = [ eval_losses(self.W[i0:i1], self.X, self.Y[i0:i1],
+                              self.Omega[i0:i1])
+                  for i0, i1 in [(0, 7), (7, 8), (8, 20)] ]
+        np.testing.assert_allclose(sum_losses(parts)[:3], self.ref[:3],
+                                   rtol=1e-12)
+
+if __name__ == '__main__':
+    unittest.main()
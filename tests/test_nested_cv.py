@@ -0,0 +1,49 @@
+import unittest
+import numpy as np
+from voxnet.nested_cv import select_lambda
+
+LAMBDAS = [1e-2, 1e0, 1e2]
+nan = np.nan
+
+class TestSelectLambda(unittest.TestCase):
+    def test_smallest_mean_error(self):
+        err_ipsi = np.array([[3., 2., 1.], [3., 2., 1.5]])
+        err_contra = np.array([[1., 1.5, 3.], [1., 1.5, 3.]])
+        self.assertEqual(select_lambda(err_ipsi, err_contra, LAMBDAS),
+                         (1e2, 1e-2))
+
+    def test_select_one_lambda(self):
+        # mean errors (3, 2, 1.25) and (1, 1.5, 3) sum to (4, 3.5, 4.25)
+        err_ipsi = np.array([[3., 2., 1.], [3., 2., 1.5]])
+        err_contra = np.array([[1., 1.5, 3.], [1., 1.5, 3.]])
+        self.assertEqual(select_lambda(err_ipsi, err_contra, LAMBDAS,
+                                       select_one_lambda=True),
+                         (1e0, 1e0))
+
+    def test_failed_fits_left_out(self):
+        # the failed fit would have the smallest error if counted as 0
+        err_ipsi = np.array([[3., nan, 2.], [3., 1., 2.]])
+        err_contra = np.array([[1., 2., 3.], [nan, 2., 3.]])
+        self.assertEqual(select_lambda(err_ipsi, err_contra, LAMBDAS),
+                         (1e0, 1e-2))
+
+    def test_all_nan_fold(self):
+        err_ipsi = np.array([[nan, nan, nan], [3., 1., 2.]])
+        err_contra = np.array([[nan, nan, nan], [1., 2., 3.]])
+        self.assertEqual(select_lambda(err_ipsi, err_contra, LAMBDAS),
+                         (1e0, 1e-2))
+
+    def test_all_nan_hemisphere(self):
+        err_ipsi = np.array([[nan, nan, nan], [nan, nan, nan]])
+        err_contra = np.array([[1., 2., 3.], [1., 2., 3.]])
+        lambda_ipsi, lambda_contra = select_lambda(err_ipsi, err_contra,
+                                                   LAMBDAS)
+        self.assertTrue(np.isnan(lambda_ipsi))
+        self.assertEqual(lambda_contra, 1e-2)
+        lambda_ipsi, lambda_contra = select_lambda(err_ipsi, err_contra,
+                                                   LAMBDAS,
+                                                   select_one_lambda=True)
+        self.assertTrue(np.isnan(lambda_ipsi) and np.isnan(lambda_contra))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import scipy.sparse as sp
+from voxnet.path import fit_path, skipped_lambdas
+
+class TestEarlyStop(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_skipped_lambdas_recorded(self):
+        rng = np.random.RandomState(5)
+        X = rng.rand(4, 6)
+        Y = rng.rand(3, 6)
+        L = sp.identity(4, format='csr'), sp.identity(3, format='csr')
+        # validation errors rising from the second lambda on
+        errors = iter([2.0, 3.0, 1.0, 1.0])
+        loss = lambda W, X, Y, Omega: next(errors)
+        errors_fn = os.path.join(self.tmp_dir, 'path_errors_ipsi.csv')
+        W_fn_fmt = os.path.join(self.tmp_dir, 'W_ipsi_%1.4e.h5')
+        lambdas = [1e-2, 1e0, 1e2, 1e1]
+        steps = fit_path(X, Y, L[0], L[1], lambdas, X_test=X, Y_test=Y,
+                         W_fn_fmt=W_fn_fmt, errors_fn=errors_fn, loss=loss,
+                         early_stop=True, max_iter=10)
+        self.assertEqual([ step.lam for step in steps ], [1e2, 1e1])
+        self.assertEqual(skipped_lambdas(errors_fn),
+                         set(['1.0000e+00', '1.0000e-02']))
+        for lam in lambdas:
+            self.assertEqual(os.path.exists(W_fn_fmt % lam), lam >= 1e1)
+        self.assertEqual(skipped_lambdas(errors_fn + '.missing'), set())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import unittest
+import numpy as np
+import scipy.sparse as sp
+from scipy.optimize import nnls
+from voxnet.regional import nnls_gram, loo_nnls, regional_loo_fits, \
+  fit_masked_regional
+from kronecker import kronecker_nnls
+
+def random_problem(rng, n_obs=25, n=8):
+    # a right-hand side with negative parts, so that constraints are active
+    A = rng.rand(n_obs, n)
+    b = A.dot(rng.rand(n) - 0.4) + 0.1 * rng.randn(n_obs)
+    return A, b
+
+class TestNNLS(unittest.TestCase):
+    def test_nnls_gram(self):
+        rng = np.random.RandomState(0)
+        for k in range(20):
+            A, b = random_problem(rng)
+            x_ref = nnls(A, b)[0]
+            G, c = A.T.dot(A), A.T.dot(b)
+            x, passive = nnls_gram(G, c)
+            np.testing.assert_allclose(x, x_ref, atol=1e-10)
+            self.assertTrue(np.array_equal(passive, x > 0))
+            # warm start from a wrong support
+            x, passive = nnls_gram(G, c, passive=rng.rand(len(c)) < 0.5)
+            np.testing.assert_allclose(x, x_ref, atol=1e-10)
+
+    def test_loo_nnls(self):
+        rng = np.random.RandomState(1)
+        n_refits = 0
+        for k in range(10):
+            A, b = random_problem(rng)
+            X_loo, refits = loo_nnls(A, b)
+            n_refits += refits
+            for i in range(A.shape[0]):
+                keep = np.arange(A.shape[0]) != i
+                np.testing.assert_allclose(X_loo[:, i],
+                                           nnls(A[keep], b[keep])[0],
+                                           atol=1e-10)
+        # both the rank-one updates and the refits have been checked
+        self.assertTrue(0 < n_refits < 10 * 25)
+
+    def test_regional_loo_fits(self):
+        rng = np.random.RandomState(2)
+        X = rng.rand(6, 20)
+        Y = rng.rand(5, 6).dot(X) * (rng.rand(5, 1) - 0.2) + \
+          0.05 * rng.rand(5, 20)
+        for n_jobs in [0, 1, 2]:
+            W, W_loo = regional_loo_fits(X, Y, n_jobs=n_jobs)
+            for j in range(Y.shape[0]):
+                np.testing.assert_allclose(W[j], nnls(X.T, Y[j])[0],
+                                           atol=1e-10)
+                for i in range(X.shape[1]):
+                    keep = np.arange(X.shape[1]) != i
+                    np.testing.assert_allclose(
+                        W_loo[i, j], nnls(X[:, keep].T, Y[j, keep])[0],
+                        atol=1e-10)
+
+class TestFitMaskedRegional(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(3)
+        self.X = rng.rand(12, 9)
+        self.P_X = sp.csr_matrix(np.kron(np.eye(3), np.ones((1, 4))))
+        self.P_Y_dag = sp.csr_matrix(np.kron(np.eye(4), np.ones((3, 1))))
+        W = rng.rand(4, 3) * (rng.rand(4, 3) < 0.6)
+        self.Y = self.P_Y_dag.dot(W).dot(self.P_X.dot(self.X)) + \
+          0.3 * (rng.rand(12, 9) - 0.5)
+        self.Omega = rng.rand(12, 9) < 0.2
+
+    def kronecker_nnls(self, keep=None):
+        # ||P_Omega(P_Y_dag W P_X X - Y)||^2
+        return kronecker_nnls((4, 3), [(self.P_Y_dag, self.P_X.dot(self.X),
+                                        self.Y, keep)])[0]
+
+    def test_matches_kronecker_nnls(self):
+        W_ref = self.kronecker_nnls(~self.Omega)
+        Omega = sp.csc_matrix(self.Omega.astype(float))
+        for W0 in [None, np.ones((4, 3))]:
+            result = fit_masked_regional(self.X, self.Y, self.P_Y_dag,
+                                         self.P_X, Omega, W0=W0,
+                                         max_iter=20000, tol=1e-12)
+            self.assertTrue(result.converged)
+            np.testing.assert_allclose(result.W, W_ref, atol=1e-8)
+
+    def test_no_mask(self):
+        W_ref = self.kronecker_nnls()
+        result = fit_masked_regional(self.X, self.Y, self.P_Y_dag, self.P_X,
+                                     max_iter=20000, tol=1e-12)
+        self.assertTrue(result.converged)
+        np.testing.assert_allclose(result.W, W_ref, atol=1e-8)
+
+if __name__ == '__main__':
+    unittest.main()
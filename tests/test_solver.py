@@ -0,0 +1,66 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import scipy.sparse as sp
+from voxnet.solver import fit_smooth_nnls
+from voxnet.utilities import h5read
+from kronecker import kronecker_nnls
+
+def path_laplacian(n):
+    # graph Laplacian of a chain of n voxels
+    L = sp.diags([-np.ones(n - 1), 2 * np.ones(n), -np.ones(n - 1)],
+                 [-1, 0, 1]).tolil()
+    L[0, 0] = L[n - 1, n - 1] = 1
+    return L.tocsr()
+
+class TestFitSmoothNNLS(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(4)
+        self.X = rng.rand(6, 10)
+        self.Y = rng.rand(5, 6).dot(self.X) * (rng.rand(5, 1) - 0.2) + \
+          0.1 * rng.randn(5, 10)
+        self.Lx = path_laplacian(6)
+        self.Ly = path_laplacian(5)
+        self.lam = 0.5
+        self.Omega = sp.csc_matrix((rng.rand(5, 10) < 0.2).astype(float))
+
+    def check(self, Omega, **kwargs):
+        # ||P_Omega(W X - Y)||^2 + lam ||Ly W||^2 + lam ||W Lx^T||^2
+        r = np.sqrt(self.lam)
+        keep = None if Omega is None else (Omega.toarray() == 0)
+        W_ref, f_ref = kronecker_nnls((5, 6), [
+            (np.eye(5), self.X, self.Y, keep),
+            (r * self.Ly, np.eye(6), np.zeros((5, 6)), None),
+            (r * np.eye(5), self.Lx.T, np.zeros((5, 6)), None)])
+        result = fit_smooth_nnls(self.X, self.Y, self.Lx, self.Ly, self.lam,
+                                 Omega, max_iter=20000, tol=1e-12, **kwargs)
+        self.assertTrue(result.converged)
+        np.testing.assert_allclose(result.W, W_ref, atol=1e-8)
+        np.testing.assert_allclose(result.objective, f_ref, rtol=1e-10)
+        return result
+
+    def test_matches_kronecker_nnls(self):
+        for Omega in [None, self.Omega]:
+            for restart in [True, False]:
+                self.check(Omega, restart=restart)
+
+    def test_backtracking(self):
+        # a step size far too long at first
+        for restart in [True, False]:
+            self.check(self.Omega, L0=1e-3, restart=restart)
+
+    def test_warm_start_and_checkpoint(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            fn = os.path.join(tmp_dir, 'W.h5')
+            result = self.check(self.Omega, W0=np.ones((5, 6)),
+                                checkpoint_fn=fn)
+            np.testing.assert_array_equal(h5read(fn), result.W)
+            self.assertEqual(os.listdir(tmp_dir), ['W.h5'])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import unittest
+import numpy as np
+from voxnet.volume_cache import VolumeCache
+
+class ArrayCache(object):
+    '''
+    mcc keeping and returning its own arrays, as an in-memory cache would.
+    '''
+    resolution = 100
+
+    def __init__(self, n_experiments=3):
+        rng = np.random.RandomState(6)
+        self.volumes = dict((expt_id, rng.rand(4, 5, 6))
+                            for expt_id in range(n_experiments))
+        self.reads = 0
+
+    def get_projection_density(self, expt_id):
+        self.reads += 1
+        return self.volumes[expt_id], {}
+
+class TestVolumeCache(unittest.TestCase):
+    def test_wrapped_volumes_stay_writeable(self):
+        mcc = ArrayCache()
+        cache = VolumeCache(mcc)
+        volume = cache.get_projection_density(0)[0]
+        np.testing.assert_array_equal(volume, mcc.volumes[0])
+        self.assertFalse(volume.flags.writeable)
+        mcc.volumes[0][0, 0, 0] = -1.0
+        self.assertNotEqual(cache.get_projection_density(0)[0][0, 0, 0],
+                            -1.0)
+        self.assertEqual(cache.resolution, 100)
+
+    def test_lru_eviction(self):
+        mcc = ArrayCache()
+        # room for two volumes
+        cache = VolumeCache(mcc, max_bytes=2 * 4 * 5 * 6 * 8)
+        for expt_id in [0, 1, 0, 2, 0, 1]:
+            cache.get_projection_density(expt_id)
+        # 1 was evicted by 2, and read again
+        self.assertEqual(mcc.reads, 4)
+        self.assertEqual(cache.stats()['hits'], 2)
+        self.assertEqual(cache.stats()['volumes'], 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import os
+import sys
+import unittest
+import numpy as np
+import scipy.sparse as sp
+from voxnet.synthetic import SyntheticConnectivityCache
+from voxnet.matrices import generate_voxel_matrices
+
+BASELINE_FN = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'data', 'voxel_matrices_baseline.npz')
+
+def as_dense(x):
+    if sp.issparse(x):
+        return x.toarray()
+    return np.asarray(x)
+
+class TestGenerateVoxelMatrices(unittest.TestCase):
+    '''
+    generate_voxel_matrices should reproduce the outputs of the original
+    structure-major implementation on the synthetic atlas exactly, serially
+    and with a process pool, with dense or sparse targets. The outputs are
+    saved in data/voxel_matrices_baseline.npz, see
+    data/make_voxel_matrices_baseline.py.
+    '''
+    @classmethod
+    def setUpClass(cls):
+        f = np.load(BASELINE_FN)
+        cls.baseline = {}
+        for name in f.files:
+            parts = name.split('/')
+            cls.baseline.setdefault(parts[0], {}) \
+              .setdefault(parts[1], {})['/'.join(parts[2:])] = f[name]
+
+    def baseline_field(self, key, field):
+        parts = self.baseline[key][field]
+        if '' in parts:
+            return parts['']
+        return sp.coo_matrix((parts['data'], (parts['row'], parts['col'])),
+                             shape=tuple(parts['shape'])).toarray()
+
+    def test_matches_baseline(self):
+        for key in sorted(self.baseline):
+            seed, laplacian, shell = key.split('_')
+            seed = int(seed[len('seed'):])
+            shell = shell[len('shell'):]
+            shell = None if shell == 'None' else int(shell)
+            mcc = SyntheticConnectivityCache(seed=seed)
+            for n_jobs in [0, 1, 2]:
+                for sparse_targets in [False, True]:
+                    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+                    try:
+                        ex = generate_voxel_matrices(
+                            mcc, mcc.structures(), mcc.structures(),
+                            source_coverage=0.3, min_voxels_per_injection=0,
+                            laplacian=laplacian, source_shell=shell,
+                            n_jobs=n_jobs, sparse_targets=sparse_targets)
+                    finally:
+                        sys.stdout.close()
+                        sys.stdout = stdout
+                    for field in self.baseline[key]:
+                        ref = self.baseline_field(key, field)
+                        new = as_dense(ex[field])
+                        msg = '%s, n_jobs %d, sparse %s: %s' % \
+                          (key, n_jobs, sparse_targets, field)
+                        self.assertEqual(new.shape, ref.shape, msg)
+                        self.assertTrue(np.array_equal(new, ref), msg)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,225 @@
+import os
+import numpy as np
+import scipy.sparse as sp
+from .lossfun import OmegaMask, eval_losses, sum_losses
+
+HEMISPHERES = ('ipsi', 'contra')
+METRICS = ('mse', 'rel_mse', 'rel_mse_2')
+TABLE_COLUMNS = ['outer', 'fold', 'lambda', 'hemisphere', 'metric', 'value']
+
+# Default size (in matrix entries) of the row blocks of W read at a time
+ROW_BLOCK_ENTRIES = 2**24
+
+class FoldTestData(object):
+    '''
+    Test matrices of an inner fold, read once and split into the row blocks
+    in which the fits W are streamed, with the Omega mask of each block
+    indexed once for all of them.
+
+    Parameters
+    ----------
+    save_dir, save_stem : str
+      run directory and file stem
+    path : str
+      fold path, e.g. 'cval0/cval1'
+    '''
+    def __init__(self, save_dir, save_stem, path):
+        from .folds import read_fold_matrices
+        mats = read_fold_matrices(save_dir, save_stem, path, 'test',
+                                  ['X', 'Y_ipsi', 'Y_contra', 'Omega'])
+        self.path = path
+        self.X = mats['X']
+        self.Y = { 'ipsi': mats['Y_ipsi'], 'contra': mats['Y_contra'] }
+        self.Omega = sp.csr_matrix(mats['Omega'])
+        self._blocks = {}
+
+    def row_blocks(self, hemisphere, block_rows):
+        '''
+        List of (i0, i1, Y rows, Omega mask of the rows or None).
+        '''
+        key = (hemisphere, block_rows)
+        if key not in self._blocks:
+            Y = self.Y[hemisphere]
+            if sp.issparse(Y):
+                Y = sp.csr_matrix(Y)
+            blocks = []
+            for i0 in range(0, Y.shape[0], block_rows):
+                i1 = min(i0 + block_rows, Y.shape[0])
+                if hemisphere == 'ipsi':
+                    omega = OmegaMask(self.Omega[i0:i1])
+                else:
+                    omega = None
+                blocks.append((i0, i1, Y[i0:i1], omega))
+            self._blocks[key] = blocks
+        return self._blocks[key]
+
+def W_files(fold_dir, hemisphere, lambda_val):
+    '''
+    Existing files of the fit of a fold, hemisphere and lambda: the fit,
+    then its checkpoint, which is used when the fit did not complete or
+    cannot be read.
+    '''
+    W_fn = os.path.join(fold_dir, "W_%s_%1.4e.h5" % (hemisphere, lambda_val))
+    return [ fn for fn in (W_fn, W_fn + '.CHECKPT') if os.path.exists(fn) ]
+
+def eval_losses_streamed(W_fn, data, hemisphere,
+                         row_block_entries=ROW_BLOCK_ENTRIES):
+    '''
+    Losses of the fit in W_fn on a fold's test data, reading W a block of
+    rows at a time.
+
+    Returns
+    -------
+    losses : lossfun.Losses, without regional sums
+    '''
+    import h5py
+    with h5py.File(W_fn, 'r') as f:
+        W = f['dataset']
+        block_rows = max(1, row_block_entries // max(W.shape[1], 1))
+        parts = [ eval_losses(W[i0:i1], data.X, Y, omega)
+                  for i0, i1, Y, omega in data.row_blocks(hemisphere,
+                                                          block_rows) ]
+    return sum_losses(parts)
+
+def evaluate_fold(save_dir, save_stem, path, lambda_list, n_threads=1,
+                  row_block_entries=ROW_BLOCK_ENTRIES):
+    '''
+    Errors of the fits of all lambdas and both hemispheres of one fold,
+    evaluated on n_threads threads (the products with X release the GIL)
+    after reading the test data once. Missing fits, and fits which
+    cannot be read (nor their checkpoint), get nan errors, except those a
+    regularization path skipped after an early stop (see
+    path.skipped_lambdas), which get infinite errors.
+
+    Returns
+    -------
+    rows : list of table rows, see TABLE_COLUMNS
+    '''
+    from multiprocessing.pool import ThreadPool
+    from .path import path_errors_fn, skipped_lambdas
+    from .utilities import n_processes
+    n_threads = n_processes(n_threads)
+    data = FoldTestData(save_dir, save_stem, path)
+    fold_dir = os.path.join(save_dir, *path.split('/'))
+    skipped = dict((hemisphere,
+                    skipped_lambdas(path_errors_fn(fold_dir, hemisphere)))
+                   for hemisphere in HEMISPHERES)
+    jobs = [ (lambda_val, hemisphere) for lambda_val in lambda_list
+             for hemisphere in HEMISPHERES ]
+    # split the rows of Y (and Omega) before the threads share them
+    for hemisphere in HEMISPHERES:
+        data.row_blocks(hemisphere,
+                        max(1, row_block_entries // max(data.X.shape[0], 1)))
+    def evaluate(job):
+        lambda_val, hemisphere = job
+        for W_fn in W_files(fold_dir, hemisphere, lambda_val):
+            try:
+                losses = eval_losses_streamed(W_fn, data, hemisphere,
+                                              row_block_entries)
+            except (IOError, OSError, KeyError):
+                print "    Error reading %s" % W_fn
+                continue
+            return [ getattr(losses, metric) for metric in METRICS ]
+        if '%1.4e' % lambda_val in skipped[hemisphere]:
+            return [ np.inf ] * len(METRICS)
+        return [ np.nan ] * len(METRICS)
+    if n_threads == 1:
+        values = [ evaluate(job) for job in jobs ]
+    else:
+        pool = ThreadPool(n_threads)
+        try:
+            values = pool.map(evaluate, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    outer = os.path.dirname(path)
+    rows = []
+    for (lambda_val, hemisphere), vals in zip(jobs, values):
+        for metric, value in zip(METRICS, vals):
+            rows.append([outer, path, lambda_val, hemisphere, metric, value])
+    return rows
+
+# Arguments of the process pool workers of evaluate_run, set once per
+# worker at fork
+_eval_worker_state = {}
+
+def _init_eval_worker(save_dir, save_stem, lambda_list, n_threads,
+                      row_block_entries):
+    _eval_worker_state['args'] = (save_dir, save_stem, lambda_list,
+                                  n_threads, row_block_entries)
+
+def _eval_worker(path):
+    save_dir, save_stem, lambda_list, n_threads, row_block_entries = \
+      _eval_worker_state['args']
+    return evaluate_fold(save_dir, save_stem, path, lambda_list,
+                         n_threads=n_threads,
+                         row_block_entries=row_block_entries)
+
+def evaluate_run(save_dir, save_stem, lambda_list, n_jobs=1, n_threads=1,
+                 table_fn=None, row_block_entries=ROW_BLOCK_ENTRIES):
+    '''
+    Validation errors of all inner fold fits of a run, one fold per process
+    of a pool of n_jobs (-1 for one per cpu), each with n_threads threads
+    over its lambdas and hemispheres.
+
+    Parameters
+    ----------
+    save_dir, save_stem : str
+      run directory and file stem
+    lambda_list : list of float
+    n_jobs : int, default=1
+    n_threads : int, default=1
+    table_fn : str, default=None
+      file to which the table is written, as Parquet if it ends in
+      '.parquet' (needs pyarrow or fastparquet) and as CSV otherwise
+    row_block_entries : int, default=ROW_BLOCK_ENTRIES
+      entries of W read at a time
+
+    Returns
+    -------
+    table : pandas DataFrame, one row per fold, lambda, hemisphere and
+      metric, with columns TABLE_COLUMNS
+    '''
+    import pandas as pd
+    import multiprocessing
+    from .nested_cv import nested_fold_paths
+    from .utilities import n_processes
+    folds = nested_fold_paths(save_dir, save_stem)
+    paths = [ inner for inners in folds.values() for inner in inners ]
+    n_jobs = n_processes(n_jobs)
+    if n_jobs == 1:
+        fold_rows = [ evaluate_fold(save_dir, save_stem, path, lambda_list,
+                                    n_threads, row_block_entries)
+                      for path in paths ]
+    else:
+        pool = multiprocessing.Pool(n_jobs, initializer=_init_eval_worker,
+                                    initargs=(save_dir, save_stem,
+                                              list(lambda_list), n_threads,
+                                              row_block_entries))
+        try:
+            fold_rows = pool.map(_eval_worker, paths)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    table = pd.DataFrame([ row for rows in fold_rows for row in rows ],
+                         columns=TABLE_COLUMNS)
+    if table_fn is not None:
+        if table_fn.endswith('.parquet'):
+            table.to_parquet(table_fn)
+        else:
+            table.to_csv(table_fn, index=False)
+    return table
+
+def error_matrix(table, outer, hemisphere, lambda_list, metric='rel_mse_2'):
+    '''
+    (n_inner x n_lambda) errors of an outer fold from an evaluate_run
+    table, for nested_cv.select_lambda.
+    '''
+    sub = table[(table['outer'] == outer) &
+                (table['hemisphere'] == hemisphere) &
+                (table['metric'] == metric)]
+    err = sub.pivot(index='fold', columns='lambda', values='value')
+    return err.reindex(columns=list(lambda_list)).values
@@ -0,0 +1,262 @@
+import os
+import numpy as np
+from collections import OrderedDict, namedtuple
+from .matrix_store import MatrixStore
+from .utilities import sparse_read, sparse_write, find_sparse_file
+
+# Matrices of a run which are split into folds, and their master files,
+# by the naming of create_voxel_matrices.py; Omega is sparse, in any of the
+# formats of utilities.SPARSE_EXTS
+FOLD_MATRICES = OrderedDict([('X', '_X.h5'),
+                             ('Y_ipsi', '_Y_ipsi.h5'),
+                             ('Y_contra', '_Y_contra.h5'),
+                             ('Omega', '_Omega')])
+SPARSE_MATRICES = ('Omega',)
+
+class FoldManifest(object):
+    '''
+    Train and test column (injection) indices of nested cross-validation
+    folds, in place of copies of the matrices for every fold. Folds are
+    named by their directory in the run, relative to it: 'cval0' for an
+    outer fold and 'cval0/cval1' for an inner fold of it. Indices always
+    refer to columns of the master matrices.
+    '''
+    def __init__(self):
+        self.folds = OrderedDict()
+
+    def add(self, path, train, test):
+        self.folds[path] = (np.asarray(train, dtype=int),
+                            np.asarray(test, dtype=int))
+
+    def train(self, path):
+        return self.folds[path][0]
+
+    def test(self, path):
+        return self.folds[path][1]
+
+    def paths(self, outer=None):
+        '''
+        Outer fold paths, or the paths of the inner folds of outer.
+        '''
+        if outer is None:
+            return [ p for p in self.folds if '/' not in p ]
+        return [ p for p in self.folds if os.path.dirname(p) == outer ]
+
+    def save(self, fn):
+        import h5py
+        with h5py.File(fn, 'w') as f:
+            for path, (train, test) in self.folds.items():
+                f.create_dataset(path + '/train', data=train)
+                f.create_dataset(path + '/test', data=test)
+            # a dataset, not an attribute: attributes are limited to 64KB,
+            # too few for the paths of leave-one-out folds
+            f.create_dataset('paths', data=list(self.folds.keys()),
+                             dtype=h5py.special_dtype(vlen=str))
+
+    @classmethod
+    def load(cls, fn):
+        import h5py
+        manifest = cls()
+        with h5py.File(fn, 'r') as f:
+            if 'paths' in f:
+                paths = f['paths'][()]
+            else:
+                # manifests written before the paths were a dataset
+                paths = f.attrs['paths']
+            for path in paths:
+                if not isinstance(path, str):
+                    path = path.decode()
+                manifest.add(path, f[path + '/train'][()],
+                             f[path + '/test'][()])
+        return manifest
+
+def manifest_fn(save_dir, save_stem):
+    return os.path.join(save_dir, save_stem + '_folds.h5')
+
+def fold_path(save_dir, fold_dir):
+    '''
+    Manifest path of a fold directory of the run in save_dir.
+    '''
+    rel = os.path.relpath(os.path.abspath(fold_dir),
+                          os.path.abspath(save_dir))
+    return rel.replace(os.sep, '/')
+
+class FoldReader(object):
+    '''
+    Lazy reader of fold matrices: columns of the master files are read only
+    when a fold's matrix is asked for, through MatrixStore for the HDF5
+    matrices. The sparse matrices (Omega) are small and read once.
+
+    Parameters
+    ----------
+    manifest : FoldManifest
+    matrix_fns : dict
+      master file of each matrix name
+    '''
+    def __init__(self, manifest, matrix_fns):
+        self.manifest = manifest
+        self.matrix_fns = dict(matrix_fns)
+        self._sparse = {}
+        self._stores = {}
+
+    @classmethod
+    def for_run(cls, save_dir, save_stem):
+        '''
+        Reader of the manifest and master files of a run directory.
+        '''
+        matrix_fns = {}
+        for name, suffix in FOLD_MATRICES.items():
+            fn = os.path.join(save_dir, save_stem + suffix)
+            if name in SPARSE_MATRICES:
+                fn = find_sparse_file(fn)
+            matrix_fns[name] = fn
+        return cls(FoldManifest.load(manifest_fn(save_dir, save_stem)),
+                   matrix_fns)
+
+    def columns(self, path, part):
+        if part == 'train':
+            return self.manifest.train(path)
+        elif part == 'test':
+            return self.manifest.test(path)
+        raise ValueError("part should be 'train' or 'test'")
+
+    def read(self, name, path, part, dense=False):
+        '''
+        Matrix name ('X', 'Y_ipsi', 'Y_contra' or 'Omega') of the train or
+        test part of fold path.
+        '''
+        fn = self.matrix_fns[name]
+        cols = self.columns(path, part)
+        if name in SPARSE_MATRICES:
+            if fn not in self._sparse:
+                self._sparse[fn] = sparse_read(fn)
+            mat = self._sparse[fn][:, cols]
+            if dense:
+                mat = mat.toarray()
+            return mat
+        if fn not in self._stores:
+            self._stores[fn] = MatrixStore(fn)
+        return self._stores[fn].columns(cols, dense=dense)
+
+    def materialize(self, path, out_dir, parts=('train',), sparse_ext='.mtx'):
+        '''
+        Write a fold's matrices to out_dir, with the file names the solver
+        commands use (X_train.h5, Omega_train.mtx, ...), sparse matrices in
+        the format of sparse_ext. Existing files are kept, so a fold shared
+        by several commands is written once.
+
+        Returns
+        -------
+        fns : dict of written (or existing) files, by '<name>_<part>'
+        '''
+        from .utilities import h5write
+        try:
+            os.makedirs(out_dir)
+        except OSError:
+            pass
+        fns = {}
+        for part in parts:
+            for name in self.matrix_fns:
+                if name in SPARSE_MATRICES:
+                    ext = sparse_ext
+                else:
+                    ext = os.path.splitext(self.matrix_fns[name])[1]
+                if name.startswith('Y_'):
+                    base = 'Y_%s_%s' % (part, name[2:])
+                else:
+                    base = '%s_%s' % (name, part)
+                fn = os.path.join(out_dir, base + ext)
+                if not os.path.exists(fn):
+                    # write to a temporary name so a concurrent reader
+                    # never sees a partial file
+                    tmp_fn = fn + '.tmp%d' % os.getpid() + ext
+                    mat = self.read(name, path, part)
+                    if name in SPARSE_MATRICES:
+                        sparse_write(tmp_fn, mat)
+                    else:
+                        h5write(tmp_fn, mat)
+                    os.rename(tmp_fn, fn)
+                fns['%s_%s' % (name, part)] = fn
+        return fns
+
+FoldProblem = namedtuple('FoldProblem',
+                         ['X_train', 'Y_train', 'Omega_train', 'X_test',
+                          'Y_test', 'Omega_test', 'Lx', 'Ly'])
+
+def read_fold_matrices(save_dir, save_stem, path, part, names):
+    '''
+    Matrices names (of FOLD_MATRICES) of the train or test part of a fold,
+    read through the run's fold manifest if it has one and from the copies
+    in the fold directory otherwise. X is dense.
+
+    Returns
+    -------
+    mats : dict by name
+    '''
+    from .utilities import h5read
+    mats = {}
+    if os.path.exists(manifest_fn(save_dir, save_stem)):
+        reader = FoldReader.for_run(save_dir, save_stem)
+        for name in names:
+            mats[name] = reader.read(name, path, part, dense=(name == 'X'))
+    else:
+        fold_dir = os.path.join(save_dir, *path.split('/'))
+        for name in names:
+            if name in SPARSE_MATRICES:
+                mats[name] = sparse_read(find_sparse_file(
+                    os.path.join(fold_dir, '%s_%s' % (name, part))))
+            elif name.startswith('Y_'):
+                mats[name] = h5read(os.path.join(
+                    fold_dir, 'Y_%s_%s.h5' % (part, name[2:])))
+            else:
+                mats[name] = h5read(os.path.join(
+                    fold_dir, '%s_%s.h5' % (name, part)), dense=True)
+    return mats
+
+def load_fold_problem(save_dir, save_stem, path, hemisphere):
+    '''
+    Training and test matrices of one fold and hemisphere ('ipsi' or
+    'contra'), with the Laplacians (see read_fold_matrices). Omega is only
+    used for the ipsilateral targets, as in the solver commands.
+
+    Returns
+    -------
+    problem : FoldProblem
+    '''
+    Lx = sparse_read(find_sparse_file(os.path.join(save_dir,
+                                                   save_stem + '_Lx')))
+    Ly = sparse_read(find_sparse_file(os.path.join(
+        save_dir, save_stem + '_Ly_' + hemisphere)))
+    names = ['X', 'Y_' + hemisphere]
+    if hemisphere == 'ipsi':
+        names.append('Omega')
+    fields = {}
+    for part in ('train', 'test'):
+        mats = read_fold_matrices(save_dir, save_stem, path, part, names)
+        fields['X_' + part] = mats['X']
+        fields['Y_' + part] = mats['Y_' + hemisphere]
+        fields['Omega_' + part] = mats.get('Omega')
+    return FoldProblem(Lx=Lx, Ly=Ly, **fields)
+
+def materialize_command(save_dir, save_stem, path, sparse_ext='.mtx'):
+    '''
+    Shell command writing the training matrices of a fold into its
+    directory, to be run before the external solver.
+    '''
+    import sys
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return 'PYTHONPATH=%s %s -m voxnet.folds %s %s %s %s' % \
+      (package_dir, sys.executable, os.path.abspath(save_dir), save_stem,
+       path, sparse_ext)
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) not in (4, 5):
+        print "usage: python -m voxnet.folds save_dir save_stem fold_path " \
+          "[sparse_ext]"
+        sys.exit(1)
+    save_dir, save_stem, path = sys.argv[1:4]
+    sparse_ext = sys.argv[4] if len(sys.argv) == 5 else '.mtx'
+    reader = FoldReader.for_run(save_dir, save_stem)
+    reader.materialize(path, os.path.join(save_dir, *path.split('/')),
+                       sparse_ext=sparse_ext)
@@ -1,11 +1,64 @@
 import h5py
 import numpy as np
-from friday_harbor.structure import Ontology
 import utilities
 import numpy.testing as nptest
 
+def support_ols(A, B, support):
+    '''
+    Ordinary least squares of each column of B on the columns of A in its
+    support, with the coefficients, standard errors and p-values of
+    statsmodels.OLS. Columns with the same support are fit together from
+    one SVD of their design matrix, which gives pinv(A_S) and
+    pinv(A_S^T A_S) with the cutoffs of np.linalg.pinv and
+    np.linalg.matrix_rank.
+
+    Parameters
+    ----------
+    A : (n_obs x n_reg) array
+    B : (n_obs x n_col) array
+    support : (n_reg x n_col) array of bool
+      columns of A regressed on, for each column of B
+
+    Returns
+    -------
+    params, bse, pvalues : (n_reg x n_col) arrays, nan outside of support
+    '''
+    from scipy import stats
+    params = np.empty(support.shape)
+    params.fill(np.nan)
+    bse = params.copy()
+    pvalues = params.copy()
+    # Group the columns by support pattern
+    groups = {}
+    for jj in range(support.shape[1]):
+        groups.setdefault(support[:, jj].tostring(), []).append(jj)
+    for cols in groups.values():
+        rows = np.flatnonzero(support[:, cols[0]])
+        if len(rows) == 0:
+            continue
+        A_S = A[:, rows]
+        b = B[:, cols]
+        U, s, Vt = np.linalg.svd(A_S, full_matrices=False)
+        keep = s > 1e-15 * s.max()
+        rank = np.sum(s > s.max() * max(A_S.shape) * np.finfo(s.dtype).eps)
+        U, s, Vt = U[:, keep], s[keep], Vt[keep]
+        x = np.dot(Vt.T, np.dot(U.T, b) / s[:, None])
+        df_resid = A_S.shape[0] - rank
+        resid = b - np.dot(A_S, x)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scale = np.sum(resid**2, axis=0) / df_resid
+            se = np.sqrt(np.outer(np.sum((Vt / s[:, None])**2, axis=0),
+                                  scale))
+            p = 2 * stats.t.sf(np.abs(x / se), df_resid)
+        block = np.ix_(rows, cols)
+        params[block] = x
+        bse[block] = se
+        pvalues[block] = p
+    return params, bse, pvalues
+
 class LinearModel(object):
     def __init__(self, W, col_labels, row_labels, data_dir='.', P=[]):
+        from friday_harbor.structure import Ontology
         self.data_dir=data_dir
         self.W = W
         self.col_labels = list(col_labels)
@@ -56,51 +109,39 @@ class LinearModel(object):
         row_ind = self.row_labels.index(row_val)
         return self.P[row_ind, col_ind]
     
+    def _label_indices(self, labels, own_labels):
+        # index in own_labels of each label, labels given as ids or acronyms
+        index = dict((label, ii) for ii, label in enumerate(own_labels))
+        acronyms = self.ontology.acronym_id_dict
+        return np.array([ index[acronyms[label] if isinstance(label, basestring)
+                                else label] for label in labels ],
+                        dtype=np.int64)
+
     def run_regression(self, A, B, col_labels, row_labels, 
                        default_p_value=np.Inf):
-        import statsmodels.api as sm
-        
+        '''
+        P-values of the coefficients of W from ordinary least squares of
+        each column of B on the columns of A in the support of the
+        corresponding column of W, see support_ols.
+        '''
         if self.P != []:
             raise Exception
         else:
-            double_check_w_dict = {}
-            p_value_dict = {}
-            for jj, col_and_curr_col_label in enumerate(zip(B.T, col_labels)):
-                col, curr_col_label = col_and_curr_col_label
-                b = col.T
-                
-                # For curr col, determine which rows should be kept for 
-                # regression
-                nonzero_ind_list = []
-                nonzero_label_list = []
-                for ii, curr_row_label in enumerate(row_labels):  
-                    if self.get_w_val(curr_row_label, curr_col_label) != 0.0:
-                        nonzero_ind_list.append(ii)
-                        nonzero_label_list.append(curr_row_label)
-                res = sm.OLS(b,A[:,nonzero_ind_list]).fit()
-                
-                # Create double-check dictionary:
-                for kk, curr_w in enumerate(res.params):
-                    double_check_w_dict[nonzero_label_list[kk], curr_col_label] = curr_w
-                
-                # Create p-value dictionary:
-                for kk, curr_p in enumerate(res.pvalues):
-                    p_value_dict[nonzero_label_list[kk], curr_col_label] = curr_p
-                
+            row_ind = self._label_indices(row_labels, self.row_labels)
+            col_ind = self._label_indices(col_labels, self.col_labels)
+            W = self.W[np.ix_(row_ind, col_ind)]
+            support = (W != 0.0)
+            params, bse, pvalues = support_ols(A, B, support)
+            
+            # Double-check coefficients:
+            nptest.assert_array_almost_equal(
+                W[support], params[support], 7,
+                err_msg='Optimization does not match regression')
             # Assign p-values to matrix:
-            P = np.zeros((np.shape(A)[1], np.shape(B)[1]))
-            for ii, curr_row_label in enumerate(self.row_labels):
-                for jj, curr_col_label in enumerate(self.col_labels):     
-                    if (curr_row_label, curr_col_label) in p_value_dict.keys():
-                        P[ii, jj] = p_value_dict[curr_row_label, curr_col_label]
-                    else:
-                        P[ii, jj] = default_p_value
-                    # Double-check coefficient:
-                    if self.get_w_val(curr_row_label, curr_col_label) != 0.0:
-                        w_opt = self.get_w_val(curr_row_label, curr_col_label)
-                        w_reg = double_check_w_dict[curr_row_label, 
-                                                    curr_col_label]
-                        nptest.assert_almost_equal(w_opt, w_reg, 7, err_msg='Optimization does not match regression')
+            P = np.empty((np.shape(A)[1], np.shape(B)[1]))
+            P.fill(default_p_value)
+            P[np.ix_(row_ind, col_ind)] = \
+              np.where(support, pvalues, default_p_value)
             self.P = P
 #     
 #     # Store results in a dictionary:
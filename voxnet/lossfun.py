@@ -1,27 +1,188 @@
 import numpy as np
-from scipy.linalg import norm
-from scipy.sparse import find as spfind
- 
+import scipy.sparse as sp
+from collections import namedtuple
+
+# Default size (in matrix entries) of the column blocks of eval_losses
+BLOCK_ENTRIES = 2**23
+
+class OmegaMask(object):
+    '''
+    Entries of Omega (nonzeros, left out of the losses), indexed by column
+    so that the entries of a block of columns are a slice of the index
+    arrays, with a cache of the boolean complement (kept entries) of the
+    blocks where Omega is too dense for index assignment to pay off.
+    Build one per Omega and reuse it for every W evaluated on it.
+
+    Parameters
+    ----------
+    Omega : (n_target x n_inj) sparse matrix
+    dense_fraction : float, default=0.1
+      fraction of a block's entries in Omega above which the block is
+      masked by multiplying with its cached complement
+    '''
+    def __init__(self, Omega, dense_fraction=0.1):
+        Omega = sp.csc_matrix(Omega, copy=True)
+        Omega.sum_duplicates()
+        # explicitly stored zeros (e.g. from .mtx or .h5 files) are kept
+        # entries, as in the find() of the older eval_error
+        Omega.eliminate_zeros()
+        self.shape = Omega.shape
+        self.indptr = Omega.indptr
+        self.rows = Omega.indices
+        self.cols = np.repeat(np.arange(Omega.shape[1]),
+                              np.diff(Omega.indptr))
+        self.dense_fraction = dense_fraction
+        self._keep = {}
+
+    def block_index(self, j0, j1):
+        '''
+        (rows, cols) of the entries of columns j0:j1, cols relative to j0.
+        '''
+        lo, hi = self.indptr[j0], self.indptr[j1]
+        return self.rows[lo:hi], self.cols[lo:hi] - j0
+
+    def keep(self, j0, j1):
+        '''
+        Boolean mask of the entries of columns j0:j1 not in Omega (cached).
+        '''
+        if (j0, j1) not in self._keep:
+            keep = np.ones((self.shape[0], j1 - j0), dtype=bool)
+            keep[self.block_index(j0, j1)] = False
+            self._keep[(j0, j1)] = keep
+        return self._keep[(j0, j1)]
+
+    def apply(self, A, j0, j1):
+        '''
+        Zero the entries of Omega in A, the block of columns j0:j1, in place.
+        '''
+        rows, cols = self.block_index(j0, j1)
+        if len(rows) > self.dense_fraction * A.size:
+            A *= self.keep(j0, j1)
+        else:
+            A[rows, cols] = 0.0
+        return A
+
+def as_omega_mask(Omega, shape):
+    if Omega is None or isinstance(Omega, OmegaMask):
+        mask = Omega
+    else:
+        mask = OmegaMask(Omega)
+    if mask is not None:
+        assert np.all(mask.shape == shape), "Omega shape incompatible with Y"
+    return mask
+
+class Losses(namedtuple('Losses', ['sq_error', 'sq_target', 'sq_pred',
+                                   'sq_error_reg', 'sq_target_reg',
+                                   'sq_pred_reg', 'n_inj'])):
+    '''
+    Sums of squares of the residual W X - Y, the targets Y and the
+    predictions W X, outside Omega, and of their regional projections
+    (nan without one), from which all the losses follow.
+    '''
+    __slots__ = ()
+
+    @property
+    def mse(self):
+        return self.sq_error / self.n_inj
+
+    @property
+    def rel_mse(self):
+        return self.sq_error / self.sq_target
+
+    @property
+    def rel_mse_2(self):
+        return 2. * self.sq_error / (self.sq_target + self.sq_pred)
+
+    @property
+    def mse_reg(self):
+        return self.sq_error_reg / self.n_inj
+
+    @property
+    def rel_mse_reg(self):
+        return self.sq_error_reg / self.sq_target_reg
+
+    @property
+    def rel_mse_2_reg(self):
+        return 2. * self.sq_error_reg / (self.sq_target_reg +
+                                         self.sq_pred_reg)
+
+def sum_losses(losses_list):
+    '''
+    Losses of a matrix from the Losses of blocks of its rows (targets).
+    Regional sums do not add up over rows and are left out (nan).
+    '''
+    sums = np.sum([ l[:3] for l in losses_list ], axis=0)
+    return Losses(*(list(sums) + [np.nan] * 3 + [losses_list[0].n_inj]))
+
+def eval_losses(W, X, Y, Omega=None, P_Y=None, block_size=None):
+    '''
+    All the sums of squares of the losses in one pass over blocks of
+    columns (injections), so that neither the prediction W X nor the
+    residual is ever formed for all of them.
+
+    Parameters
+    ----------
+    W : (n_target x n_source) array, or a scalar with X a scalar (constant
+      prediction, e.g. 0.0)
+    X : (n_source x n_inj) array
+    Y : (n_target x n_inj) array or sparse matrix
+    Omega : sparse matrix or OmegaMask, default=None
+      nonzeros mark entries left out of the losses; pass an OmegaMask to
+      reuse it across calls
+    P_Y : (n_region x n_target) array or sparse matrix, default=None
+      regional projection of the targets; the regional sums are of the
+      projections of the masked residual, targets and predictions
+    block_size : int, default=None
+      columns per block, by default about BLOCK_ENTRIES entries per block
+
+    Returns
+    -------
+    losses : Losses
+    '''
+    if sp.issparse(Y):
+        Y = sp.csc_matrix(Y)
+    n_target, n_inj = Y.shape
+    omega = as_omega_mask(Omega, Y.shape)
+    if block_size is None:
+        block_size = max(1, BLOCK_ENTRIES // max(n_target, 1))
+    constant = np.ndim(W) == 0 and np.ndim(X) == 0
+    sums = np.zeros(6)
+    for j0 in range(0, n_inj, block_size):
+        j1 = min(j0 + block_size, n_inj)
+        if constant:
+            pred = np.empty((n_target, j1 - j0))
+            pred.fill(np.dot(W, X))
+        else:
+            pred = np.dot(W, X[:, j0:j1])
+        if sp.issparse(Y):
+            target = Y[:, j0:j1].toarray()
+        else:
+            target = np.array(Y[:, j0:j1], dtype=np.float64)
+        if omega is not None:
+            omega.apply(pred, j0, j1)
+            omega.apply(target, j0, j1)
+        resid = pred - target
+        sums[:3] += [ np.vdot(resid, resid), np.vdot(target, target),
+                      np.vdot(pred, pred) ]
+        if P_Y is not None:
+            for k, A in enumerate((resid, target, pred)):
+                A_reg = P_Y.dot(A)
+                sums[3 + k] += np.vdot(A_reg, A_reg)
+    if P_Y is None:
+        sums[3:] = np.nan
+    return Losses(*(list(sums) + [n_inj]))
+
 def sq_error_fro(W,X,Y,Omega=None):
-    return eval_error(W,X,Y,Omega)**2
- 
+    return eval_losses(W,X,Y,Omega).sq_error
+
 def eval_error(W,X,Y,Omega=None):
-    r = np.dot(W,X)-Y
-    if Omega is not None:
-        assert np.all(Omega.shape == Y.shape), \
-          "Omega shape incompatible with Y"
-        Omega_idx=spfind(Omega)
-        r[Omega_idx[0],Omega_idx[1]] = 0.0
-    return norm(np.ravel(r),2)
- 
+    return np.sqrt(sq_error_fro(W,X,Y,Omega))
+
 def mean_sq_error_fro(W,X,Y,Omega=None):
-    ninj=Y.shape[1]
-    return sq_error_fro(W,X,Y,Omega)/ninj
- 
+    return eval_losses(W,X,Y,Omega).mse
+
 def rel_MSE(W,X,Y,Omega=None):
-    return mean_sq_error_fro(W,X,Y,Omega) / mean_sq_error_fro(0.0,0.0,Y,Omega)
- 
+    return eval_losses(W,X,Y,Omega).rel_mse
+
 def rel_MSE_2(W,X,Y,Omega=None):
-    return 2.*mean_sq_error_fro(W,X,Y,Omega) / \
-      ( mean_sq_error_fro(0.0,0.0,Y,Omega) + \
-        mean_sq_error_fro(0.0,0.0,np.dot(W,X),Omega) )
+    return eval_losses(W,X,Y,Omega).rel_mse_2
@@ -0,0 +1,272 @@
+import os
+import numpy as np
+import scipy.sparse as sp
+from collections import namedtuple
+from .utilities import dense_array
+from .solver import sq_operator_norm, load_solver_inputs
+
+LowRankResult = namedtuple('LowRankResult',
+                           ['U', 'V', 'objective', 'n_iter', 'converged'])
+
+class LowRankObjective(object):
+    '''
+    Objective of the voxel model for a factored W = U V^T,
+
+      f(U, V) = ||P_Omega(U V^T X - Y)||^2
+                + lam (||Ly U V^T||^2 + ||U V^T Lx^T||^2),
+
+    evaluated without forming W: the smoothness terms reduce to traces of
+    (rank x rank) Gram matrices, e.g. ||Ly U V^T||^2 = tr((Ly U)^T Ly U V^T V).
+
+    Parameters
+    ----------
+    X, Y, Lx, Ly, lam, Omega : see solver.SmoothObjective
+    '''
+    def __init__(self, X, Y, Lx, Ly, lam, Omega=None):
+        self.X = np.asarray(X, dtype=np.float64)
+        self.Y = dense_array(Y).astype(np.float64)
+        self.Lx = sp.csr_matrix(Lx)
+        self.Ly = sp.csr_matrix(Ly)
+        self.LxT = self.Lx.T.tocsr()
+        self.LyT = self.Ly.T.tocsr()
+        self.lam = float(lam)
+        if Omega is not None:
+            assert Omega.shape == self.Y.shape, \
+              "Omega shape incompatible with Y"
+            Omega = sp.coo_matrix(Omega)
+            self.omega_idx = (Omega.row, Omega.col)
+        else:
+            self.omega_idx = None
+        self.n_target = self.Y.shape[0]
+        self.n_source = self.X.shape[0]
+        self.Ly_sq_norm = sq_operator_norm(
+            lambda v: self.LyT.dot(self.Ly.dot(v)), self.n_target)
+        self.Lx_sq_norm = sq_operator_norm(
+            lambda v: self.LxT.dot(self.Lx.dot(v)), self.n_source)
+        self.X_sq_norm = sq_operator_norm(
+            lambda v: self.X.dot(self.X.T.dot(v)), self.n_source)
+
+    def residual(self, U, VtX):
+        R = U.dot(VtX) - self.Y
+        if self.omega_idx is not None:
+            R[self.omega_idx] = 0.0
+        return R
+
+    def value(self, U, V):
+        R = self.residual(U, V.T.dot(self.X))
+        LyU = self.Ly.dot(U)
+        LxV = self.Lx.dot(V)
+        return np.vdot(R, R) + self.lam * \
+          (np.vdot(LyU.T.dot(LyU), V.T.dot(V)) +
+           np.vdot(LxV.T.dot(LxV), U.T.dot(U)))
+
+    def grad_U(self, U, V):
+        '''
+        Gradient in U and its Lipschitz constant, for fixed V.
+        '''
+        VtX = V.T.dot(self.X)
+        R = self.residual(U, VtX)
+        VtV = V.T.dot(V)
+        LxV = self.Lx.dot(V)
+        LxVtLxV = LxV.T.dot(LxV)
+        G = 2.0 * (R.dot(VtX.T) +
+                   self.lam * (self.LyT.dot(self.Ly.dot(U)).dot(VtV) +
+                               U.dot(LxVtLxV)))
+        L = 2.0 * (np.linalg.norm(VtX, 2)**2 +
+                   self.lam * (self.Ly_sq_norm * np.linalg.norm(VtV, 2) +
+                               np.linalg.norm(LxVtLxV, 2)))
+        return G, L
+
+    def grad_V(self, U, V):
+        '''
+        Gradient in V and its Lipschitz constant, for fixed U.
+        '''
+        R = self.residual(U, V.T.dot(self.X))
+        UtU = U.T.dot(U)
+        LyU = self.Ly.dot(U)
+        LyUtLyU = LyU.T.dot(LyU)
+        G = 2.0 * (self.X.dot(R.T.dot(U)) +
+                   self.lam * (V.dot(LyUtLyU) +
+                               self.LxT.dot(self.Lx.dot(V)).dot(UtU)))
+        L = 2.0 * (self.X_sq_norm * np.linalg.norm(UtU, 2) +
+                   self.lam * (np.linalg.norm(LyUtLyU, 2) +
+                               self.Lx_sq_norm * np.linalg.norm(UtU, 2)))
+        return G, L
+
+def _write_factors_checkpoint(fn, U, V):
+    tmp_fn = fn + '.tmp%d.h5' % os.getpid()
+    save_factors(tmp_fn, U, V)
+    os.rename(tmp_fn, fn)
+
+def fit_low_rank(X, Y, Lx, Ly, lam, rank, Omega=None, U0=None, V0=None,
+                 max_iter=5000, tol=1e-7, momentum=True, nonneg=True, seed=0,
+                 checkpoint_fn=None, checkpoint_every=100, verbose=False):
+    '''
+    Low rank voxel model fit, W = U V^T with U (n_target x rank) and
+    V (n_source x rank), minimizing LowRankObjective by alternating
+    projected gradient steps on U and V, each with the step size of its
+    block Lipschitz constant, and extrapolation (momentum) which is undone
+    whenever the objective goes up. The dense W is never formed.
+
+    Parameters
+    ----------
+    X, Y, Lx, Ly, lam, Omega : see solver.SmoothObjective
+    rank : int
+    U0, V0 : arrays, default=None
+      warm start; by default small random nonnegative factors. If only one
+      is given, the other is its least squares fit to Y (leaving out Omega
+      and the smoothing terms)
+    max_iter : int, default=5000
+    tol : float, default=1e-7
+      stop when the relative decrease of the objective is below tol
+    momentum : bool, default=True
+    nonneg : bool, default=True
+      constrain U and V (hence W) to be nonnegative
+    seed : int, default=0
+      seed of the random initialization
+    checkpoint_fn : str, default=None
+      file to which the factors are written (save_factors) every
+      checkpoint_every iterations
+    checkpoint_every : int, default=100
+    verbose : bool, default=False
+
+    Returns
+    -------
+    result : LowRankResult(U, V, objective, n_iter, converged)
+    '''
+    obj = LowRankObjective(X, Y, Lx, Ly, lam, Omega)
+    if U0 is None and V0 is None:
+        rng = np.random.RandomState(seed)
+        scale = np.sqrt(max(np.abs(obj.Y).mean(), 1e-12) /
+                        (rank * max(np.abs(obj.X).mean(), 1e-12) *
+                         obj.n_source))
+        U = scale * rng.rand(obj.n_target, rank)
+        V = rng.rand(obj.n_source, rank)
+    elif V0 is None:
+        U = np.array(U0, dtype=np.float64)
+        assert U.shape == (obj.n_target, rank), "U0 shape does not match"
+        # U V^T X ~ Y: V^T X ~ pinv(U) Y, then V^T ~ pinv(U) Y pinv(X)
+        VtX = np.linalg.lstsq(U, obj.Y, rcond=None)[0]
+        V = np.linalg.lstsq(obj.X.T, VtX.T, rcond=None)[0]
+    elif U0 is None:
+        V = np.array(V0, dtype=np.float64)
+        assert V.shape == (obj.n_source, rank), "V0 shape does not match"
+        U = np.linalg.lstsq(V.T.dot(obj.X).T, obj.Y.T, rcond=None)[0].T
+    else:
+        U = np.array(U0, dtype=np.float64)
+        V = np.array(V0, dtype=np.float64)
+        assert U.shape == (obj.n_target, rank) and \
+          V.shape == (obj.n_source, rank), "U0, V0 shapes do not match"
+    def project(A):
+        if nonneg:
+            return np.maximum(A, 0.0)
+        return A
+    U = project(U)
+    V = project(V)
+    f = obj.value(U, V)
+    U_prev, V_prev = U, V
+    t = 1.0
+    converged = False
+    n_iter = 0
+    for n_iter in range(1, max_iter + 1):
+        if momentum:
+            t_new = 0.5 * (1.0 + np.sqrt(1.0 + 4.0 * t * t))
+            w = (t - 1.0) / t_new
+        else:
+            t_new, w = 1.0, 0.0
+        U_hat = U + w * (U - U_prev)
+        G, L = obj.grad_U(U_hat, V)
+        U_new = project(U_hat - G / max(L, 1e-300))
+        V_hat = V + w * (V - V_prev)
+        G, L = obj.grad_V(U_new, V_hat)
+        V_new = project(V_hat - G / max(L, 1e-300))
+        f_new = obj.value(U_new, V_new)
+        if f_new > f and w > 0:
+            # extrapolation made things worse: plain block steps instead
+            t_new = 1.0
+            G, L = obj.grad_U(U, V)
+            U_new = project(U - G / max(L, 1e-300))
+            G, L = obj.grad_V(U_new, V)
+            V_new = project(V - G / max(L, 1e-300))
+            f_new = obj.value(U_new, V_new)
+        U_prev, V_prev = U, V
+        U, V, t = U_new, V_new, t_new
+        decrease = (f - f_new) / max(abs(f), 1e-300)
+        f = f_new
+        if checkpoint_fn is not None and n_iter % checkpoint_every == 0:
+            _write_factors_checkpoint(checkpoint_fn, U, V)
+        if verbose and n_iter % checkpoint_every == 0:
+            print "  iteration %d: objective %e" % (n_iter, f)
+        if 0 <= decrease < tol:
+            converged = True
+            break
+    if checkpoint_fn is not None:
+        _write_factors_checkpoint(checkpoint_fn, U, V)
+    return LowRankResult(U, V, f, n_iter, converged)
+
+def save_factors(fn, U, V):
+    '''
+    Write the factors of W = U V^T to an HDF5 file (datasets 'U', 'V').
+    '''
+    import h5py
+    with h5py.File(fn, 'w') as f:
+        f.create_dataset('U', data=U)
+        f.create_dataset('V', data=V)
+
+def load_factors(fn):
+    '''
+    Read factors written by save_factors, as (U, V).
+    '''
+    import h5py
+    with h5py.File(fn, 'r') as f:
+        return f['U'][()], f['V'][()]
+
+def predict_low_rank(U, V, X):
+    '''
+    Predicted projections W X = U (V^T X), without forming W.
+    '''
+    return U.dot(V.T.dot(X))
+
+def main(argv):
+    '''
+    Command line, like solver.main with a rank:
+
+      [--init | factors_fn] [Omega_fn] X_fn Y_fn Lx_fn Ly_fn lambda rank
+        output_fn
+
+    The factors are checkpointed to output_fn.CHECKPT, and a run restarts
+    from an existing checkpoint.
+    '''
+    if len(argv) not in (8, 9):
+        print "usage: python -m voxnet.low_rank [--init | factors_fn] " \
+          "[Omega_fn] X_fn Y_fn Lx_fn Ly_fn lambda rank output_fn"
+        return 1
+    init_arg = argv[0]
+    if len(argv) == 9:
+        Omega_fn = argv[1]
+        args = argv[2:]
+    else:
+        Omega_fn = None
+        args = argv[1:]
+    X_fn, Y_fn, Lx_fn, Ly_fn, lam, rank, output_fn = args
+    X, Y, Lx, Ly, Omega = load_solver_inputs(X_fn, Y_fn, Lx_fn, Ly_fn,
+                                             Omega_fn)
+    checkpoint_fn = output_fn + '.CHECKPT'
+    if os.path.exists(checkpoint_fn):
+        U0, V0 = load_factors(checkpoint_fn)
+    elif init_arg != '--init':
+        U0, V0 = load_factors(init_arg)
+    else:
+        U0, V0 = None, None
+    result = fit_low_rank(X, Y, Lx, Ly, float(lam), int(rank), Omega=Omega,
+                          U0=U0, V0=V0, checkpoint_fn=checkpoint_fn,
+                          verbose=True)
+    save_factors(output_fn, result.U, result.V)
+    os.remove(checkpoint_fn)
+    print "Objective %e after %d iterations (converged: %s)" % \
+      (result.objective, result.n_iter, str(result.converged))
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main(sys.argv[1:]))
@@ -1,122 +1,335 @@
 import numpy as np
 
+class FlatMask(object):
+    '''
+    Mask stored as sorted raveled (C-order) indices into a fixed volume
+    shape, e.g. that of the annotation volume. Set operations are vectorized
+    over the index arrays; a boolean volume can be built on demand and is
+    kept for fast membership tests.
+
+    Parameters
+    ----------
+    idx : array of int
+      Flat indices of the voxels in the mask
+    shape : tuple
+      Shape of the volume the indices refer to
+    assume_sorted : bool (default = False)
+      If True, idx is taken to be sorted and unique already
+    '''
+    def __init__(self, idx, shape, assume_sorted=False):
+        idx = np.asarray(idx, dtype=np.int64).ravel()
+        if not assume_sorted:
+            idx = np.unique(idx)
+        self.idx = idx
+        self.shape = tuple(int(s) for s in shape)
+        self._volume = None
+
+    @classmethod
+    def from_nz(cls, mask_nz, shape, drop_outside=False):
+        '''
+        Build from a tuple of (x,y,z) coordinate arrays. If drop_outside,
+        coordinates falling outside of the volume are discarded instead of
+        raising.
+        '''
+        coords = [ np.asarray(c, dtype=np.int64) for c in mask_nz ]
+        if len(coords[0]) == 0:
+            return cls(np.array([], dtype=np.int64), shape, assume_sorted=True)
+        if drop_outside:
+            inside = np.ones(coords[0].shape, dtype=bool)
+            for c, n in zip(coords, shape):
+                inside &= (c >= 0) & (c < n)
+            coords = [ c[inside] for c in coords ]
+        return cls(np.ravel_multi_index(coords, shape), shape)
+
+    @classmethod
+    def from_volume(cls, volume):
+        ''' Build from the nonzero voxels of a volume. '''
+        return cls(np.flatnonzero(volume), volume.shape, assume_sorted=True)
+
+    def __len__(self):
+        return len(self.idx)
+
+    def __eq__(self, other):
+        return isinstance(other, FlatMask) and self.shape == other.shape \
+          and np.array_equal(self.idx, other.idx)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def nz(self):
+        ''' Tuple of (x,y,z) coordinate arrays, as returned by np.where. '''
+        return np.unravel_index(self.idx, self.shape)
+
+    def coords(self):
+        ''' num voxel x 3 array of voxel coordinates. '''
+        return np.array(self.nz()).T
+
+    def volume(self):
+        ''' Boolean volume backing the mask. Built once, then kept. '''
+        if self._volume is None:
+            vol = np.zeros(int(np.prod(self.shape)), dtype=bool)
+            vol[self.idx] = True
+            self._volume = vol.reshape(self.shape)
+        return self._volume
+
+    def values(self, data):
+        ''' Gather the values of a volume at the mask voxels. '''
+        assert data.shape == self.shape, "data shape incompatible with mask"
+        return np.take(data, self.idx)
+
+    def contains(self, idx):
+        '''
+        Membership test for an array of flat indices. Uses the boolean
+        volume if it has been built, binary search otherwise.
+        '''
+        idx = np.asarray(idx, dtype=np.int64)
+        if self._volume is not None:
+            return np.take(self._volume, idx)
+        return isin_sorted(idx, self.idx)
+
+    def _check_shape(self, others):
+        for m in others:
+            if m.shape != self.shape:
+                raise ValueError("mask shapes differ: %s and %s" %
+                                 (str(self.shape), str(m.shape)))
+
+    def union(self, *others):
+        self._check_shape(others)
+        if len(others) == 0:
+            return self
+        idx = np.unique(np.concatenate([self.idx]+[m.idx for m in others]))
+        return FlatMask(idx, self.shape, assume_sorted=True)
+
+    def intersection(self, *others):
+        self._check_shape(others)
+        idx = self.idx
+        for m in others:
+            idx = np.intersect1d(idx, m.idx, assume_unique=True)
+        return FlatMask(idx, self.shape, assume_sorted=True)
+
+    def difference(self, *others):
+        self._check_shape(others)
+        idx = self.idx
+        for m in others:
+            idx = idx[~m.contains(idx)]
+        return FlatMask(idx, self.shape, assume_sorted=True)
+
+def isin_sorted(values, sorted_idx):
+    '''
+    Boolean array, True where values are found in the sorted unique array
+    sorted_idx. Vectorized binary search.
+    '''
+    values = np.asarray(values)
+    if len(sorted_idx) == 0:
+        return np.zeros(values.shape, dtype=bool)
+    pos = np.searchsorted(sorted_idx, values)
+    pos[pos == len(sorted_idx)] = 0
+    return sorted_idx[pos] == values
+
+def as_flat_mask(mask, shape):
+    ''' Convert a tuple-of-arrays mask to a FlatMask (no-op for FlatMask). '''
+    if isinstance(mask, FlatMask):
+        if mask.shape != tuple(shape):
+            raise ValueError("mask shape incompatible with %s" % str(shape))
+        return mask
+    return FlatMask.from_nz(mask, shape)
+
+def as_nz(mask):
+    ''' Convert a FlatMask to a tuple of (x,y,z) arrays (no-op for tuples). '''
+    if isinstance(mask, FlatMask):
+        return mask.nz()
+    return mask
+
+def _flat_masks(masks):
+    '''
+    If any of the masks is a FlatMask, return all of them as FlatMasks on
+    that volume shape, otherwise None.
+    '''
+    shapes = [ m.shape for m in masks if isinstance(m, FlatMask) ]
+    if len(shapes) == 0:
+        return None
+    return [ as_flat_mask(m, shapes[0]) for m in masks ]
+
+def _tuple_masks_to_flat(masks, drop_outside=False):
+    '''
+    Ravel tuple-of-arrays masks into the smallest box containing all of
+    them, so that the vectorized FlatMask operations can be used.
+    '''
+    mask_bounds = [ [ np.max(coords) for coords in m ] for m in masks ]
+    shape = np.max(mask_bounds, 0) + 1
+    return [ FlatMask.from_nz(m, shape, drop_outside=drop_outside)
+             for m in masks ]
+
+def mask_isin(A, B):
+    '''
+    Boolean array over the voxels of mask A, in the order of A, which is
+    True where the voxel is also in mask B.
+    '''
+    flat = _flat_masks((A, B))
+    if flat is not None:
+        return flat[1].contains(flat[0].idx)
+    if len(A[0]) == 0:
+        return np.zeros((0,), dtype=bool)
+    if len(B[0]) == 0:
+        return np.zeros((len(A[0]),), dtype=bool)
+    flat = _tuple_masks_to_flat((A, B), drop_outside=True)
+    A_idx = np.ravel_multi_index(A, flat[0].shape)
+    return flat[1].contains(A_idx)
+
 def mask_union(*masks):
     ''' Find the union of all of the nonzero voxels given an input list of masks. '''
+    flat = _flat_masks(masks)
+    if flat is not None:
+        return flat[0].union(*flat[1:])
+
     masks = [ m for m in masks if len(m[0]) > 0 ]
 
     if len(masks) == 1:
         return masks[0]
 
-    mask_bounds = [ [ np.max(coords) for coords in m ] for m in masks ]
-
-    if len(mask_bounds) == 0:
+    if len(masks) == 0:
         return ((np.array([]), np.array([]), np.array([])))
 
-    max_bounds = np.max(mask_bounds, 0)
-
-    bg = np.zeros(max_bounds+1, dtype=np.uint8)
-
-    for mask in masks:
-        bg[mask] = 1
-
-    return np.where(bg > 0)
+    flat = _tuple_masks_to_flat(masks)
+    return flat[0].union(*flat[1:]).nz()
 
 def mask_intersection(*input_masks):
     ''' Find the intersection of all of the nonzero voxels given an input list of masks. '''
+    flat = _flat_masks(input_masks)
+    if flat is not None:
+        return flat[0].intersection(*flat[1:])
+
     masks = [ m for m in input_masks if len(m[0]) > 0 ]
 
     # if there are zero-length masks, the intersection is necessarily empty.
     if len(masks) < len(input_masks):
         return (np.array([]), np.array([]), np.array([]))
 
-    # find the smallest box that will contain all of the mask coordinates and
-    # initialize an array with those dimensions
-    mask_bounds = [ [ np.max(coords) for coords in m ] for m in masks ]
-    max_bounds = np.max(mask_bounds, 0)
+    flat = _tuple_masks_to_flat(masks)
+    return flat[0].intersection(*flat[1:]).nz()
 
-    # intialize some images with that size
-    images = [ np.zeros(max_bounds+1, dtype=np.bool) for m in masks ]
+def mask_difference(A, B):
+    ''' Find the difference between this mask and another. '''
+    flat = _flat_masks((A, B))
+    if flat is not None:
+        return flat[0].difference(flat[1])
 
-    # initialize them
-    for i, mask in enumerate(masks):
-        images[i][mask] = True
+    if len(A[0]) == 0:
+        return (np.array([]), np.array([]), np.array([]))
+    if len(B[0]) == 0:
+        return tuple(np.asarray(c) for c in A)
 
-    # logical_and them all together
-    intersection_image = np.logical_and.reduce(images)
+    # voxels of B outside of the volume cannot be in A, so drop them
+    flat = _tuple_masks_to_flat((A, B), drop_outside=True)
+    new_mask = flat[0].difference(flat[1])
+    if len(new_mask) == 0:
+        return (np.array([]), np.array([]), np.array([]))
+    return new_mask.nz()
 
-    return np.where(intersection_image)
+def structuring_element(radius, element='cube'):
+    '''
+    Boolean (2*radius+1)^3 structuring element for binary dilation.
 
-def mask_difference(A, B):
-    ''' Find the difference between this mask and another. '''
-    if len(A[0]) == 0:
-        xx, yy, zz = np.array([]), np.array([]), np.array([])
-    else:
-        A_set = set(zip(*A))
-        other_set = set(zip(*B))
+    Parameters
+    ----------
+      radius : int
+      element : 'cube' or 'ball'
+        A cube gives the same result as radius steps of 26-neighborhood
+        dilation, a ball keeps offsets within euclidean distance radius
 
-        new_set = set()
-        for x in A_set:
-            if not x in other_set:
-                new_set.add(x)
+    Returns
+    -------
+      structure : 3-array of bool
+    '''
+    offsets = np.indices((2*radius+1,)*3) - radius
+    if element == 'cube':
+        return np.ones(offsets.shape[1:], dtype=bool)
+    elif element == 'ball':
+        return np.sum(offsets**2, axis=0) <= radius**2
+    else:
+        raise ValueError("element should be 'cube' or 'ball'")
 
-        if len(new_set) == 0:
-            xx, yy, zz = np.array([]), np.array([]), np.array([]) 
-        else:
-            xx, yy, zz = zip(*list(new_set))
+def shell_mask(mask, radius=1, element='cube'):
+    '''
+    Expand a mask by a shell of radius voxels. The mask is dilated within
+    its bounding box, padded by radius, in a single binary dilation.
 
-    return (np.array(xx), np.array(yy), np.array(zz))
+    Earlier versions returned wrong shells (e.g. {(1,1,1),(5,5,5)} for the
+    voxel (5,5,5) at radius 1), so the Omega and target matrices of runs
+    with a source_shell differ from those of earlier versions.
 
-def shell_mask(mask, radius=1):
-    def unique_rows(a):
-        '''
-        http://stackoverflow.com/questions/8560440/removing-duplicate-columns-and-rows-from-a-numpy-2d-array
-        '''
-        a = np.ascontiguousarray(a)
-        unique_a = np.unique(a.view([('', a.dtype)]*a.shape[1]))
-        return unique_a.view(a.dtype).reshape((unique_a.shape[0], a.shape[1]))
+    Parameters
+    ----------
+      mask : (xs, ys, zs) or FlatMask
+      radius : int
+        width of the shell in voxels
+      element : 'cube' or 'ball'
+        shape of the structuring element, see structuring_element
 
-    neighborhood_size = 27
+    Returns
+    -------
+      new_mask : same type as mask. Voxels falling outside of the volume
+        are dropped (for (xs, ys, zs) masks, only negative coordinates).
+    '''
+    from scipy.ndimage import binary_dilation
     assert isinstance(radius, int), "radius should be type int"
     assert radius > 0, "radius should be >= 1"
-    voxels = np.array(mask,dtype=int).T
-    candidates = np.zeros((voxels.shape[0]*neighborhood_size,3),dtype=int)
-    for idx,vox in enumerate(voxels):
-        neighbors = possible_neighbors(vox,size=neighborhood_size-1)
-        candidates[neighborhood_size*idx:neighborhood_size*(idx+1),:] = \
-          np.vstack((neighbors,vox.reshape((1,3))))
-    shell_voxels = unique_rows(candidates)
-    new_mask = tuple([col for col in shell_voxels.T])
-    if radius == 1:
-        return new_mask
+    if isinstance(mask, FlatMask):
+        voxels = mask.coords()
+    else:
+        voxels = np.array(mask, dtype=np.int64).T
+    if len(voxels) == 0:
+        return mask
+    lower = voxels.min(axis=0) - radius
+    box = np.zeros(voxels.max(axis=0) - lower + radius + 1, dtype=bool)
+    box[tuple((voxels - lower).T)] = True
+    dilated = binary_dilation(box, structure=structuring_element(radius,
+                                                                 element))
+    shell_voxels = np.array(np.nonzero(dilated)) + lower.reshape((3,1))
+    if isinstance(mask, FlatMask):
+        return FlatMask.from_nz(shell_voxels, mask.shape, drop_outside=True)
+    inside = np.all(shell_voxels >= 0, axis=0)
+    return tuple([col for col in shell_voxels[:,inside]])
+
+def neighbor_offsets(size=6):
+    '''
+    Offsets to the neighbors of a voxel.
+
+    Parameters
+    ----------
+      size : int
+        6 (faces) or 26 (faces, edges and corners), size of neighborhood
+
+    Returns
+    -------
+      offsets: size x 3 numpy array
+    '''
+    if size==6:
+        return np.array([[1,0,0],
+                         [0,1,0],
+                         [0,0,1],
+                         [-1,0,0],
+                         [0,-1,0],
+                         [0,0,-1]])
+    elif size==26:
+        offsets=np.array([[dx,dy,dz]
+                          for dx in range(-1,2)
+                          for dy in range(-1,2)
+                          for dz in range(-1,2)])
+        return offsets[np.any(offsets != 0, axis=1)]
     else:
-        return shell_mask(new_mask, radius = (radius-1))
+        raise ValueError("neighborhood size should be 6 or 26")
 
 def possible_neighbors(vox,size=6):
     '''
     Parameters
     ----------
       vox: 1x3 numpy array
+      size : int
+        6 or 26, size of neighborhood to return
 
     Returns
     -------
       neighbors: size x3 numpy array, neighborhood voxel coordinates
-      size : int
-        6 or 26, size of neighborhood to return
     '''
-    if size==6:
-        neighbors=np.tile(vox,(6,1))
-        neighbors+=[[1,0,0],
-                    [0,1,0],
-                    [0,0,1],
-                    [-1,0,0],
-                    [0,-1,0],
-                    [0,0,-1]]
-    elif size==26:
-        neighbors=np.tile(vox,(26,1))
-        idx=0
-        for dx in range(-1,1):
-            for dy in range(-1,1):
-                for dz in range(-1,1):
-                    if not(dx==0 and dy==0 and dz==0):
-                        neighbors[idx,:]+=[dx,dy,dz]
-    return neighbors
+    return np.tile(vox,(size,1)) + neighbor_offsets(size)
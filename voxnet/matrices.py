@@ -1,15 +1,31 @@
 from .utilities import *
 from .mask import *
+from collections import namedtuple
+from .volume_cache import VolumeCache
+from .structure_masks import StructureMaskRegistry
+from .qc import experiment_qc_table, filter_qc_table
 import numpy as np
 
-def region_laplacian(mask):
+def region_laplacian(mask, size=6, spacing=None):
     '''
     Generate the laplacian matrix for a given region's voxels. This is the 
     graph laplacian of the neighborhood graph.
 
+    Neighbors are found by shifting the flat indices of the voxels within
+    their (padded) bounding box and looking the results up in the sorted
+    indices, one vectorized pass per neighbor offset. A voxel listed more
+    than once (overlapping regions, with 'free' laplacians) is linked to
+    by its last occurrence only.
+
     Parameters
     ----------
-      mask
+      mask : (xs, ys, zs), 3 x num voxel array, or FlatMask
+      size : int
+        6 or 26, size of neighborhood
+      spacing : length 3 array, default=None
+        Voxel spacing along each axis. If given, edges are weighted by the
+        inverse squared distance between voxel centers, otherwise all
+        edges have weight 1.
 
     Returns
     -------
@@ -17,23 +33,74 @@ def region_laplacian(mask):
         in the region mask
     '''
     import scipy.sparse as sp
-    voxels = np.array(mask).T
-    num_vox = mask_len(mask)
-    # num_vox=voxels.shape[0]
-    vox_lookup = {tuple(vox): idx for idx,vox in enumerate(voxels)}
-    L = sp.lil_matrix((num_vox,num_vox))
-    for idx,vox in enumerate(voxels):
-        candidates = possible_neighbors(vox)
-        deg = 0
-        for nei in candidates:
-            try:
-                idx_nei = vox_lookup[tuple(nei)]
-                deg += 1
-                L[idx,idx_nei] = 1
-            except KeyError:
-                pass
-        L[idx,idx] = -deg
-    return L.tocsc()
+    if isinstance(mask, FlatMask):
+        voxels = mask.coords()
+    else:
+        voxels = np.array(mask, dtype=np.int64).T
+    num_vox = len(voxels)
+    if num_vox == 0:
+        return sp.csc_matrix((0,0))
+    offsets = neighbor_offsets(size)
+    if spacing is None:
+        weights = np.ones((len(offsets),))
+    else:
+        weights = 1.0 / np.sum((offsets * np.asarray(spacing, dtype=float))**2,
+                               axis=1)
+    # pad the bounding box by one voxel so shifted indices cannot wrap
+    lower = voxels.min(axis=0) - 1
+    box_shape = voxels.max(axis=0) - lower + 2
+    flat = np.ravel_multi_index((voxels - lower).T, box_shape)
+    order = np.argsort(flat, kind='mergesort')
+    sorted_flat = flat[order]
+    strides = np.array([box_shape[1]*box_shape[2], box_shape[2], 1])
+    rows, cols, vals = [], [], []
+    for offset, weight in zip(offsets, weights):
+        nei = flat + np.dot(offset, strides)
+        # the sort is stable, so the last match is the last occurrence
+        pos = np.searchsorted(sorted_flat, nei, side='right') - 1
+        pos[pos < 0] = 0
+        hit = (sorted_flat[pos] == nei)
+        rows.append(np.flatnonzero(hit))
+        cols.append(order[pos[hit]])
+        vals.append(np.repeat(weight, len(rows[-1])))
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    vals = np.concatenate(vals)
+    deg = np.bincount(rows, weights=vals, minlength=num_vox)
+    diag = np.arange(num_vox)
+    L = sp.coo_matrix((np.concatenate((vals, -deg)),
+                       (np.concatenate((rows, diag)),
+                        np.concatenate((cols, diag)))),
+                      shape=(num_vox, num_vox)).tocsc()
+    L.eliminate_zeros()
+    return L
+
+def masks_laplacian(masks, laplacian='boundary', size=6, spacing=None):
+    '''
+    Laplacian over the voxels of several regions, ordered region by region
+    and, within a region, as in its mask.
+
+    Parameters
+    ----------
+      masks : list of masks
+      laplacian : 'boundary' or 'free'
+        If 'boundary', honor region boundaries (block-diagonal laplacian),
+        if 'free', neighbors are connected across regions
+      size, spacing : see region_laplacian
+
+    Returns
+    -------
+      L: csc_matrix
+    '''
+    import scipy.sparse as sp
+    if laplacian == 'boundary':
+        return sp.block_diag(tuple([ region_laplacian(m, size, spacing)
+                                     for m in masks ])).tocsc()
+    elif laplacian == 'free':
+        return region_laplacian(np.hstack(tuple([ as_nz(m) for m in masks ])),
+                                size, spacing)
+    else:
+        raise ValueError("laplacian should be 'boundary' or 'free'")
 
 def construct_Omega(injection_mask, region_mask):
     '''
@@ -50,18 +117,39 @@ def construct_Omega(injection_mask, region_mask):
     '''
     nvox = mask_len(region_mask)
     if mask_len(injection_mask) > 0:
-        omega = np.ones((nvox,))
-        irrelevant_indices = np.ones((nvox,))
-        list_relevant = zip(*injection_mask)
-        list_region = zip(*region_mask)
-        for ii,el in enumerate(list_region):
-            if el in list_relevant:
-                irrelevant_indices[ii] = 0
-        omega[irrelevant_indices == 1] = 0.0
+        omega = mask_isin(region_mask, injection_mask).astype(float)
     else:
         omega = np.zeros((nvox,))
     return omega
 
+def construct_Omega_block(region_mask, injection_masks):
+    '''
+    Construct the Omega entries for a region and a batch of injections in
+    one pass, directly in sparse form.
+
+    Parameters
+    ----------
+    region_mask : FlatMask
+    injection_masks : list of masks (FlatMask or (xs, ys, zs))
+
+    Returns
+    -------
+    Omega : num injection x num voxel coo_matrix, in the same order as the
+      voxels in region_mask, which is 1 where the voxel is in the injection
+    '''
+    import scipy.sparse as sp
+    injection_masks = [ as_flat_mask(m, region_mask.shape)
+                        for m in injection_masks ]
+    shape = (len(injection_masks), len(region_mask))
+    if shape[0] == 0:
+        return sp.coo_matrix(shape)
+    idx = np.concatenate([ m.idx for m in injection_masks ])
+    rows = np.repeat(np.arange(shape[0]),
+                     [ len(m) for m in injection_masks ])
+    hit = region_mask.contains(idx)
+    cols = np.searchsorted(region_mask.idx, idx[hit])
+    return sp.coo_matrix((np.ones(len(cols)), (rows[hit], cols)), shape=shape)
+
 # def gaussian_injection(X,Y,allvox):
 #     from scipy.optimize import fmin_l_bfgs_b,fmin_bfgs
 #     from scipy.linalg import cholesky,inv
@@ -148,6 +236,248 @@ def construct_Omega(injection_mask, region_mask):
 #     gaussian_injection=gaussian_injection/gaussian_injection.sum()*Ysum
 #     return gaussian_injection
 
+def get_experiment_list(mcc, source_ids, LIMS_id_list=None, cre=False):
+    '''
+    Experiments injected in the source structures, optionally restricted to
+    those in LIMS_id_list.
+    '''
+    ex_list = mcc.get_experiments(dataframe=True, cre=cre,
+                                  injection_structure_ids=source_ids)
+    if LIMS_id_list is not None:
+        ex_list = ex_list[ex_list['id'].isin(LIMS_id_list)]
+    return list(ex_list['id'])
+
+def filter_experiments(mcc, LIMS_id_list, source_mask,
+                       source_coverage=0.8, max_injection_volume=np.inf,
+                       epsilon=0.0, source_ids=None, n_jobs=1,
+                       qc_dir=None):
+    '''
+    Check for injection mask leaking into other regions and for too large
+    injection volumes. Returns the experiments which pass both checks.
+
+    Parameters
+    ----------
+    mcc : MouseConnectivityCache
+    LIMS_id_list : list
+      experiments to check
+    source_mask : union of the source region masks
+    source_coverage : float, default=0.8
+      fraction of injection density that should be contained in source_mask
+    max_injection_volume : float, default=np.inf
+      maximum injection volume (mm^3)
+    epsilon : float, default=0.0
+      injection fraction threshold for the injection masks
+    source_ids : list, default=None
+      source structure ids, keying the QC table stored in qc_dir
+    n_jobs : int, default=1
+      number of processes computing the QC table, -1 for all cpus
+    qc_dir : str, default=None
+      directory of stored QC tables, see qc.experiment_qc_table
+    '''
+    # Check for injection mask leaking into other region,
+    # restrict to experiments w/o much leakage
+    #
+    # Also check for too large injection volume.
+    qc_table = experiment_qc_table(mcc, LIMS_id_list, source_mask,
+                                   source_ids=source_ids, epsilon=epsilon,
+                                   n_jobs=n_jobs, qc_dir=qc_dir)
+    LIMS_id_list = filter_qc_table(qc_table, source_coverage=source_coverage,
+                                   max_injection_volume=max_injection_volume,
+                                   verbose=True)
+    inj_vols = sorted(qc_table['injection_volume'])
+    print "Injection volumes: " + str(inj_vols)
+    num_experiments = len(LIMS_id_list)
+    print "Final list includes %d experiments" % num_experiments
+    if num_experiments < 1:
+        raise Exception("number of filtered experiments is zero")
+    print "Final list:\n%s" % str(LIMS_id_list)
+    return LIMS_id_list
+
+VoxelIndexTables = namedtuple('VoxelIndexTables',
+                              ['source_idx', 'source_region',
+                               'target_ipsi_idx', 'target_contra_idx',
+                               'shape'])
+
+def voxel_index_tables(source_masks, target_ipsi_masks, target_contra_masks):
+    '''
+    Flat indices of the voxels making up the source, ipsilateral target and
+    contralateral target columns, region by region, and the region number
+    of each source column.
+
+    Parameters
+    ----------
+    source_masks, target_ipsi_masks, target_contra_masks : lists of FlatMask
+
+    Returns
+    -------
+    tables : VoxelIndexTables
+    '''
+    def _concat(masks):
+        return np.concatenate([ m.idx for m in masks ])
+    source_region = np.repeat(np.arange(len(source_masks)),
+                              [ len(m) for m in source_masks ])
+    return VoxelIndexTables(_concat(source_masks), source_region,
+                            _concat(target_ipsi_masks),
+                            _concat(target_contra_masks),
+                            source_masks[0].shape)
+
+def voxel_matrix_rows(mcc, LIMS_id, tables, epsilon=0.0, source_shell=None):
+    '''
+    Computes one experiment's rows of the voxel matrices: its injection mask
+    (and shell) once, then the densities at all source and target columns.
+
+    Parameters
+    ----------
+    mcc : MouseConnectivityCache
+    LIMS_id : int
+      experiment id
+    tables : VoxelIndexTables
+    epsilon : float, default=0.0
+      injection fraction threshold for the injection mask
+    source_shell : int, default=None
+      radius of the shell around the injection mask
+
+    Returns
+    -------
+    x : source row, injection density in the injection mask
+    y_ipsi, y_contra : target rows, projection density outside of the
+      injection mask (and shell)
+    omega_cols : source columns which are in the injection mask (and shell)
+    region_nvox : number of injection mask voxels in each source region
+    counts : DataErrorCounts of the source and target voxels
+    '''
+    inj_mask = get_injection_mask_nz(mcc, LIMS_id, threshold=epsilon,
+                                     flat=True)
+    if source_shell is not None:
+        shell = shell_mask(inj_mask, radius=source_shell)
+    else:
+        shell = inj_mask
+    # Source: density at the injected voxels of each region
+    in_injection = inj_mask.contains(tables.source_idx)
+    region_nvox = np.bincount(tables.source_region[in_injection],
+                              minlength=tables.source_region.max()+1)
+    x = np.take(mcc.get_injection_density(LIMS_id)[0], tables.source_idx)
+    x[~in_injection] = 0.0
+    x, counts = clean_error_codes(x)
+    # Omega only covers regions which the injection itself reaches
+    in_shell = shell.contains(tables.source_idx) & \
+      (region_nvox > 0)[tables.source_region]
+    omega_cols = np.flatnonzero(in_shell)
+    # Target: density outside of the injection
+    proj_density = mcc.get_projection_density(LIMS_id)[0]
+    target_rows = []
+    for target_idx in (tables.target_ipsi_idx, tables.target_contra_idx):
+        y = np.take(proj_density, target_idx)
+        y[shell.contains(target_idx)] = 0.0
+        y, target_counts = clean_error_codes(y)
+        counts += target_counts
+        target_rows.append(y)
+    return (x, target_rows[0], target_rows[1], omega_cols, region_nvox,
+            counts)
+
+# State of the process pool workers of generate_voxel_matrices, set once per
+# worker by _init_row_worker so that mcc and the tables are not sent per job
+_row_worker_state = {}
+
+def _init_row_worker(mcc, tables, epsilon, source_shell, outputs):
+    _row_worker_state['mcc'] = mcc
+    _row_worker_state['tables'] = tables
+    _row_worker_state['epsilon'] = epsilon
+    _row_worker_state['source_shell'] = source_shell
+    _row_worker_state['outputs'] = \
+      [ np.memmap(fn, dtype=np.float64, mode='r+', shape=shape)
+        for fn, shape in outputs ]
+
+def _row_worker(job):
+    '''
+    Computes the rows of experiment job=(ii, LIMS_id) and writes the dense
+    ones straight into row ii of the memory-mapped outputs. Only the small
+    per-row results are sent back.
+    '''
+    ii, LIMS_id = job
+    state = _row_worker_state
+    rows = voxel_matrix_rows(state['mcc'], LIMS_id, state['tables'],
+                             epsilon=state['epsilon'],
+                             source_shell=state['source_shell'])
+    for output, row in zip(state['outputs'], rows[:3]):
+        output[ii] = row
+        output.flush()
+    return (ii,) + rows[3:]
+
+def parallel_voxel_matrix_rows(mcc, LIMS_id_list, tables, epsilon=0.0,
+                               source_shell=None, n_jobs=-1, tmp_dir=None,
+                               sparse_targets=False):
+    '''
+    Runs voxel_matrix_rows for all experiments on a process pool. Workers
+    write the source and target rows into memory-mapped arrays in a
+    temporary directory, so rows are never pickled back, and row ii always
+    holds experiment LIMS_id_list[ii].
+
+    Parameters
+    ----------
+    mcc : MouseConnectivityCache
+      inherited by the workers (fork); each worker keeps its own caches
+    LIMS_id_list : list
+      experiments, in row order
+    tables : VoxelIndexTables
+    epsilon, source_shell : see voxel_matrix_rows
+    n_jobs : int, default=-1
+      number of worker processes, -1 for one per cpu
+    tmp_dir : str, default=None
+      where to put the memory-mapped arrays (default: system temp dir)
+    sparse_targets : bool, default=False
+      return Y_ipsi and Y_contra as CSR matrices, converted from the
+      memory-mapped rows without a dense copy in memory
+
+    Returns
+    -------
+    (X, Y_ipsi, Y_contra) : experiments x columns arrays
+    results : list of (omega_cols, region_nvox, counts), one per experiment
+    '''
+    import multiprocessing
+    import os
+    import shutil
+    import tempfile
+    import scipy.sparse as sp
+    n_jobs = n_processes(n_jobs)
+    n_exp = len(LIMS_id_list)
+    work_dir = tempfile.mkdtemp(prefix='voxnet_rows_', dir=tmp_dir)
+    try:
+        outputs = []
+        for name, ncol in [('X', len(tables.source_idx)),
+                           ('Y_ipsi', len(tables.target_ipsi_idx)),
+                           ('Y_contra', len(tables.target_contra_idx))]:
+            fn = os.path.join(work_dir, name + '.dat')
+            np.memmap(fn, dtype=np.float64, mode='w+',
+                      shape=(n_exp, ncol)).flush()
+            outputs.append((fn, (n_exp, ncol)))
+        pool = multiprocessing.Pool(n_jobs, initializer=_init_row_worker,
+                                    initargs=(mcc, tables, epsilon,
+                                              source_shell, outputs))
+        results = [None] * n_exp
+        try:
+            for res in pool.imap_unordered(_row_worker,
+                                           list(enumerate(LIMS_id_list))):
+                results[res[0]] = res[1:]
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        matrices = [ np.memmap(fn, dtype=np.float64, mode='r', shape=shape)
+                     for fn, shape in outputs ]
+        matrices[0] = np.array(matrices[0])
+        for k in (1, 2):
+            if sparse_targets:
+                matrices[k] = sp.csr_matrix(matrices[k])
+            else:
+                matrices[k] = np.array(matrices[k])
+        matrices = tuple(matrices)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return matrices, results
+
 def generate_voxel_matrices(mcc,
                             sources, targets, 
                             min_voxels_per_injection = 50,
@@ -155,18 +485,30 @@ def generate_voxel_matrices(mcc,
                             LIMS_id_list             = None,
                             source_shell             = None,
                             laplacian                = None,
+                            laplacian_size           = 6,
+                            laplacian_spacing        = None,
                             verbose                  = False,
                             filter_by_ex_target      = True,
                             fit_gaussian             = False,
                             cre                      = False,
                             max_injection_volume     = np.inf,
-                            epsilon                  = 0.0):
+                            epsilon                  = 0.0,
+                            volume_cache_bytes       = 2**30,
+                            structure_masks          = None,
+                            n_jobs                   = 1,
+                            tmp_dir                  = None,
+                            qc_dir                   = None,
+                            sparse_targets           = False):
     '''
     Generates the source and target expression matrices for a set of
     injections, which can then be used to fit the linear model, etc.
     Differs from 'generate_region_matrices' in that they are voxel-resolution,
     i.e. signals are not integrated across regions.
 
+    Each experiment is visited once: its injection mask (and shell) is
+    computed a single time and its densities are scattered into all source
+    and target columns through precomputed region index tables.
+
     Parameters
     ----------
     mcc : MouseConnectivityCache
@@ -186,6 +528,11 @@ def generate_voxel_matrices(mcc,
       account for extent of dendrites; integer sets radius in voxels
     laplacian : 'boundary', 'free', or default=None
       Return laplacian matrices? If 'boundary', honor region boundaries.
+    laplacian_size : int, default=6
+      6 or 26, neighborhood size used for the laplacians
+    laplacian_spacing : length 3 array, default=None
+      voxel spacing for inverse squared distance edge weights, see
+      region_laplacian; default gives all edges weight 1
     verbose : bool, default=False
       print progress
     filter_by_ex_target : bool, default=True
@@ -196,300 +543,200 @@ def generate_voxel_matrices(mcc,
       use Cre injection data?
     max_injection_volume : float, default=np.inf
       filter out experiments with very large injection volumes (mm^3)
+    epsilon : float, default=0.0
+      injection fraction threshold for the injection masks
+    volume_cache_bytes : int, default=2**30
+      memory budget of the VolumeCache put in front of mcc, so experiment
+      volumes are not re-read for every structure; 0 disables caching
+    structure_masks : StructureMaskRegistry, default=None
+      source of the structure masks; by default a new in-memory registry
+    n_jobs : int, default=1
+      number of processes computing experiment rows, -1 for one per cpu;
+      see parallel_voxel_matrix_rows
+    tmp_dir : str, default=None
+      directory for the memory-mapped rows when n_jobs != 1
+    qc_dir : str, default=None
+      directory in which experiment QC tables are stored and reused, so
+      changing source_coverage or max_injection_volume does not re-read
+      the injections; see qc.experiment_qc_table
+    sparse_targets : bool, default=False
+      build the target matrices as scipy.sparse CSR matrices instead of
+      dense arrays; projection density is zero outside of a few regions,
+      so this keeps whole-brain targets in memory
         
     Returns
     -------
     experiment_dict, with fields 'experiment_source_matrix',
         'experiment_target_matrix_ipsi', 'experiment_target_matrix_contra',
         'col_label_list_source', 'col_label_list_target', 'row_label_list',
-        'source_laplacian', 'Omega',
+        'source_laplacian', 'Omega', 'data_error_counts',
         'target_laplacian' (if laplacian==True)
+      'data_error_counts' is a (num experiments x 3) array with the number
+      of source and target voxels carrying LIMS error codes -1, -2 and -3
     '''
 
     import scipy.sparse as sp
     from warnings import warn
 
-    
     assert isinstance(source_shell, int) or (source_shell is None),\
       "source_shell should be int or None"
+    n_jobs = n_processes(n_jobs)
 
-    # ontology = mcc.get_ontology()
-    volume_per_voxel = float(mcc.resolution)**3 * 1e-9
+    if volume_cache_bytes and not isinstance(mcc, VolumeCache):
+        mcc = VolumeCache(mcc, max_bytes=volume_cache_bytes)
+    if structure_masks is None:
+        structure_masks = StructureMaskRegistry(mcc)
 
     if verbose:
         print "Creating experiment list"
-    if LIMS_id_list is None:
-        ex_list = mcc.get_experiments(dataframe=True, cre=cre,
-                                      injection_structure_ids=sources.id)
-        LIMS_id_list=list(ex_list['id'])
-    else:
-        ex_list = mcc.get_experiments(dataframe=True, cre=cre,
-                                      injection_structure_ids=sources.id)
-        ex_list=ex_list[ex_list['id'].isin(LIMS_id_list)]
-        LIMS_id_list=list(ex_list['id'])
+    LIMS_id_list = get_experiment_list(mcc, sources.id, LIMS_id_list, cre)
 
     # Get the region masks
     if verbose:
-        print "Computing region sizes from masks"
-    # region_mask_dict = {}
-    region_mask_ipsi_dict = {}
-    region_mask_contra_dict = {}
-    region_nvox = {}
-    region_ipsi_nvox = {}
-    region_contra_nvox = {}
-    nsource = 0 # total voxels in sources
-    nsource_ipsi = 0 
-    ntarget_ipsi = 0 # total voxels in ipsi targets
-    ntarget_contra = 0 # total voxels in contra targets
-    source_indices = {}
-    source_ipsi_indices = {}
-    target_ipsi_indices = {}
-    target_contra_indices = {}
-    for struct_id in sources.id:
-        region_nvox[struct_id] = mask_len(get_structure_mask_nz(mcc, struct_id))
-        region_ipsi_nvox[struct_id] = \
-          mask_len(get_structure_mask_nz(mcc, struct_id, ipsi=True))
-        region_contra_nvox[struct_id] = \
-          mask_len(get_structure_mask_nz(mcc, struct_id, contra=True))
-        source_indices[struct_id] = \
-          np.arange(nsource, nsource+region_nvox[struct_id])
-        source_ipsi_indices[struct_id] = \
-          np.arange(nsource_ipsi, nsource_ipsi+region_ipsi_nvox[struct_id])
-        nsource += region_nvox[struct_id]
-        nsource_ipsi += region_ipsi_nvox[struct_id]
-    for struct_id in targets.id:
-        region_nvox[struct_id] = mask_len(get_structure_mask_nz(mcc, struct_id))
-        region_ipsi_nvox[struct_id] = \
-          mask_len(get_structure_mask_nz(mcc, struct_id, ipsi=True))
-        region_contra_nvox[struct_id] = \
-          mask_len(get_structure_mask_nz(mcc, struct_id, contra=True))
-        target_ipsi_indices[struct_id] = \
-          np.arange(ntarget_ipsi,ntarget_ipsi+region_ipsi_nvox[struct_id])
-        target_contra_indices[struct_id] = \
-          np.arange(ntarget_contra,ntarget_contra+region_contra_nvox[struct_id])
-        ntarget_ipsi += region_ipsi_nvox[struct_id]
-        ntarget_contra += region_contra_nvox[struct_id]
+        print "Computing region index tables"
+    source_ids = np.array(sources.id)
+    target_ids = np.array(targets.id)
+    source_masks = [ structure_masks.get(sid, ipsi=True) for sid in sources.id ]
+    target_ipsi_masks = [ structure_masks.get(sid, ipsi=True)
+                          for sid in targets.id ]
+    target_contra_masks = [ structure_masks.get(sid, contra=True)
+                            for sid in targets.id ]
+    tables = voxel_index_tables(source_masks, target_ipsi_masks,
+                                target_contra_masks)
+    nsource_ipsi = len(tables.source_idx)
+    ntarget_ipsi = len(tables.target_ipsi_idx)
+    ntarget_contra = len(tables.target_contra_idx)
 
     # Compute source mask union
-    # TODO: compute iteratively for large instances
     union_of_source_masks = \
-      mask_union( *[ get_structure_mask_nz(mcc, sid)
-                     for sid in sources.id ] )
+      mask_union( *[ structure_masks.get(sid) for sid in sources.id ] )
 
-    # Check for injection mask leaking into other region,
-    # restrict to experiments w/o much leakage
-    #
-    # Also check for too large injection volume.
-    LIMS_id_list_new = []
-    inj_vols = []
-    for LIMS_id in LIMS_id_list:
-        inj_mask = get_injection_mask_nz(mcc, LIMS_id, threshold=epsilon)
-        total_pd = integrate_in_mask(mcc.get_injection_fraction(LIMS_id)[0],
-                                     inj_mask)
-        total_source_pd = \
-          integrate_in_mask(mcc.get_injection_fraction(LIMS_id)[0],
-                            mask_intersection(inj_mask, union_of_source_masks))
-        source_frac = total_source_pd / total_pd
-        injection_volume = total_pd * volume_per_voxel
-        inj_vols.append(injection_volume)
-        print "  Analyzing experiment %d" % LIMS_id
-        print "    source_frac = %f" % source_frac
-        print "    injection volume = %f" % injection_volume
-        delete_injection = False
-        if source_frac < source_coverage:
-            print "  Experiment %d has too little coverage" % LIMS_id
-            delete_injection = True
-        if injection_volume > max_injection_volume:
-            print "  Experiment %d has too much injection volume" % LIMS_id
-            delete_injection = True
-        if not delete_injection:
-            LIMS_id_list_new.append(LIMS_id)
-    inj_vols.sort()
-    print "Injection volumes: " + str(inj_vols)
-    LIMS_id_list = LIMS_id_list_new
-    del LIMS_id_list_new
+    LIMS_id_list = filter_experiments(mcc, LIMS_id_list, union_of_source_masks,
+                                      source_coverage=source_coverage,
+                                      max_injection_volume=max_injection_volume,
+                                      epsilon=epsilon, source_ids=source_ids,
+                                      n_jobs=n_jobs, qc_dir=qc_dir)
     num_experiments = len(LIMS_id_list)
-    print "Final list includes %d experiments" % num_experiments
-    if num_experiments < 1:
-        raise Exception("number of filtered experiments is zero")
-    print "Final list:\n%s" % str(LIMS_id_list)
 
     # Fit densities with gaussians if required
     if fit_gaussian:
         warn("gaussian fitting not implemented")
-    # # First pass here:
-    #     ProjD_dict_gaussian={}
-    #     for curr_id in LIMS_id_list:
-    #         pd=ProjD_dict[curr_id]
-    #         # first clean error values
-    #         pd[pd==-1]=0.0
-    #         where_neg2=np.where(pd==-2)
-    #         if np.any(where_neg2):
-    #             warn("projection density error -2, missing tile in LIMS experiment %d" % curr_id)
-    #         pd[where_neg2]=0.0
-    #         where_neg3=np.where(pd==-3)
-    #         if np.any(where_neg3):
-    #             warn("projection density error -3, no data in LIMS experiment %d" % curr_id)
-    #         pd[where_neg3]=0.0
-    #         # now fit gaussian injections
-    #         X=np.where(pd)
-    #         Y=pd[X]
-    #         print "Fitting gaussian for experiment %d" % curr_id
-    #         new_pd_vec=gaussian_injection(np.array(X).T,Y)
-    #         new_pd=np.zeros(pd.shape)
-    #         new_pd[X]=new_pd_vec
-    #         ProjD_dict_gaussian[curr_id]=new_pd
-    
+
     # Initialize matrices:
-    structures_above_threshold_ind_list = []
-    experiment_source_matrix_pre = np.zeros((len(LIMS_id_list), nsource_ipsi))
-    Omega = np.zeros((len(LIMS_id_list), nsource_ipsi))
-    col_label_list_source = np.zeros((nsource_ipsi, 1))
-    voxel_coords_source = np.zeros((nsource_ipsi, 3))
+    data_error_counts = np.zeros((num_experiments, len(LIMS_ERROR_CODES)),
+                                 dtype=int)
+    region_nvox = np.zeros((num_experiments, len(source_masks)), dtype=int)
+    Omega_rows = []
+    Omega_cols = []
 
-    # Source :
+    # One pass per experiment, scattering into all source and target columns
     if verbose:
-        print "Getting source densities"
-    for jj, struct_id in enumerate(sources.id):
-        # Get the region mask:
-        curr_region_mask = get_structure_mask_nz(mcc, struct_id, ipsi=True)
-        ipsi_injection_volume_list = []
+        print "Getting source and target densities"
+    if n_jobs == 1:
+        experiment_source_matrix = np.zeros((num_experiments, nsource_ipsi))
+        if sparse_targets:
+            y_ipsi_rows = []
+            y_contra_rows = []
+        else:
+            experiment_target_matrix_ipsi = np.zeros((num_experiments,
+                                                      ntarget_ipsi))
+            experiment_target_matrix_contra = np.zeros((num_experiments,
+                                                        ntarget_contra))
+        row_results = []
         for ii, curr_LIMS_id in enumerate(LIMS_id_list):
-            # Get the injection mask:
-            # We don't count the shell voxels
-            curr_experiment_mask = get_injection_mask_nz(mcc, curr_LIMS_id,
-                                                         threshold=epsilon)
-            # Compute density, source:
-            intersection_mask = mask_intersection(curr_experiment_mask, 
-                                                  curr_region_mask)
-            if mask_len(intersection_mask) > 0:
-                indices = source_ipsi_indices[struct_id]
-                ipsi_injection_volume_list.append(mask_len(intersection_mask))
-                col_label_list_source[indices] = struct_id
-                these_coords = np.array(curr_region_mask).T
-                voxel_coords_source[indices,] = these_coords
-                experiment_source_matrix_pre[ii,indices] = \
-                  data_in_mask_and_region(
-                      mcc.get_injection_density(curr_LIMS_id)[0],
-                      intersection_mask, curr_region_mask
-                      )
-                Omega[ii,indices] = \
-                  construct_Omega(
-                      mask_intersection(
-                          get_injection_mask_nz(mcc, curr_LIMS_id,
-                                                threshold=epsilon,
-                                                shell=source_shell),
-                          curr_region_mask),
-                      curr_region_mask
-                      )
-        
-        # Determine if current structure should be included in source list:
-        ipsi_injection_volume_array = np.array(ipsi_injection_volume_list)
-        num_exp_above_thresh =\
-          len(np.nonzero(
-              ipsi_injection_volume_array >= min_voxels_per_injection )[0] )
-        if num_exp_above_thresh > 0:
-            structures_above_threshold_ind_list.append(jj)
-            if verbose:
-                print("structure %s above threshold") % struct_id
-    
-    Omega = sp.csc_matrix(Omega)
+            x, y_ipsi, y_contra, omega_cols, nvox, counts = \
+              voxel_matrix_rows(mcc, curr_LIMS_id, tables, epsilon=epsilon,
+                                source_shell=source_shell)
+            experiment_source_matrix[ii] = x
+            if sparse_targets:
+                y_ipsi_rows.append(sp.csr_matrix(y_ipsi))
+                y_contra_rows.append(sp.csr_matrix(y_contra))
+            else:
+                experiment_target_matrix_ipsi[ii] = y_ipsi
+                experiment_target_matrix_contra[ii] = y_contra
+            row_results.append((omega_cols, nvox, counts))
+        if sparse_targets:
+            experiment_target_matrix_ipsi = \
+              sp.vstack(y_ipsi_rows, format='csr')
+            experiment_target_matrix_contra = \
+              sp.vstack(y_contra_rows, format='csr')
+    else:
+        (experiment_source_matrix, experiment_target_matrix_ipsi,
+         experiment_target_matrix_contra), row_results = \
+          parallel_voxel_matrix_rows(mcc, LIMS_id_list, tables,
+                                     epsilon=epsilon,
+                                     source_shell=source_shell,
+                                     n_jobs=n_jobs, tmp_dir=tmp_dir,
+                                     sparse_targets=sparse_targets)
+    for ii, (omega_cols, nvox, counts) in enumerate(row_results):
+        region_nvox[ii] = nvox
+        data_error_counts[ii] = counts
+        Omega_rows.append(np.repeat(ii, len(omega_cols)))
+        Omega_cols.append(omega_cols)
 
-    experiment_source_matrix = experiment_source_matrix_pre
-    row_label_list = np.array(LIMS_id_list)
-     
-    # Target:
+    Omega_rows = np.concatenate(Omega_rows)
+    Omega_cols = np.concatenate(Omega_cols)
+    Omega = sp.csc_matrix((np.ones(len(Omega_cols)), (Omega_rows, Omega_cols)),
+                          shape=(num_experiments, nsource_ipsi))
+
+    # Source columns are only labeled for regions reached by an injection
+    injected = (region_nvox > 0)
     if verbose:
-        print "Getting target densities"
-    experiment_target_matrix_ipsi = np.zeros((len(LIMS_id_list),
-                                              ntarget_ipsi))
-    experiment_target_matrix_contra = np.zeros((len(LIMS_id_list), 
-                                                ntarget_contra))
-    col_label_list_target_ipsi = np.zeros((ntarget_ipsi,1))
-    col_label_list_target_contra = np.zeros((ntarget_contra,1))
-    voxel_coords_target_ipsi = np.zeros((ntarget_ipsi,3))
-    voxel_coords_target_contra = np.zeros((ntarget_contra,3))
-    for jj, struct_id in enumerate(targets.id):
-        # Get the region mask:
-        curr_region_mask_ipsi = get_structure_mask_nz(mcc, struct_id, ipsi=True)
-        curr_region_mask_contra = get_structure_mask_nz(mcc, struct_id,
-                                                        contra=True)
-        for ii, curr_LIMS_id in enumerate(row_label_list):
-            # Get the injection mask:
-            curr_experiment_mask = get_injection_mask_nz(mcc, curr_LIMS_id,
-                                                         threshold=epsilon,
-                                                         shell=source_shell)
-            # Compute regional density, target, ipsi:
-            difference_mask = \
-              mask_difference(curr_region_mask_ipsi,curr_experiment_mask)
-            indices_ipsi = target_ipsi_indices[struct_id]
-            pd_at_diff = \
-              data_in_mask_and_region(
-                  mcc.get_projection_density(curr_LIMS_id)[0],
-                  difference_mask, curr_region_mask_ipsi
-                  )
-            experiment_target_matrix_ipsi[ii, indices_ipsi] = pd_at_diff
-            col_label_list_target_ipsi[indices_ipsi] = struct_id
-            voxel_coords_target_ipsi[indices_ipsi,] = \
-              np.array(curr_region_mask_ipsi).T
-            # Compute regional density, target, contra:    
-            difference_mask = \
-              mask_difference(curr_region_mask_contra, curr_experiment_mask)
-            indices_contra = target_contra_indices[struct_id]
-            pd_at_diff = \
-              data_in_mask_and_region(
-                  mcc.get_projection_density(curr_LIMS_id)[0],
-                  difference_mask, curr_region_mask_contra)
-            experiment_target_matrix_contra[ii, indices_contra] = pd_at_diff
-            col_label_list_target_contra[indices_contra] = struct_id
-            voxel_coords_target_contra[indices_contra,] = \
-              np.array(curr_region_mask_contra).T
+        above_threshold = np.any(injected &
+                                 (region_nvox >= min_voxels_per_injection),
+                                 axis=0)
+        for struct_id in source_ids[above_threshold]:
+            print "structure %s above threshold" % struct_id
+    labeled = np.any(injected, axis=0)[tables.source_region]
+    col_label_list_source = np.zeros((nsource_ipsi, 1))
+    col_label_list_source[labeled, 0] = \
+      source_ids[tables.source_region[labeled]]
+    voxel_coords_source = np.zeros((nsource_ipsi, 3))
+    voxel_coords_source[labeled] = \
+      np.array(np.unravel_index(tables.source_idx[labeled], tables.shape)).T
+
+    col_label_list_target_ipsi = \
+      np.repeat(target_ids, [ len(m) for m in target_ipsi_masks ]) \
+        .reshape((ntarget_ipsi, 1)).astype(float)
+    col_label_list_target_contra = \
+      np.repeat(target_ids, [ len(m) for m in target_contra_masks ]) \
+        .reshape((ntarget_contra, 1)).astype(float)
+    voxel_coords_target_ipsi = \
+      np.array(np.unravel_index(tables.target_ipsi_idx, tables.shape),
+               dtype=float).T
+    voxel_coords_target_contra = \
+      np.array(np.unravel_index(tables.target_contra_idx, tables.shape),
+               dtype=float).T
+    row_label_list = np.array(LIMS_id_list)
 
     if verbose:
+        for ii, curr_LIMS_id in enumerate(row_label_list):
+            counts = DataErrorCounts(*data_error_counts[ii])
+            if counts.missing_tile > 0 or counts.no_data > 0:
+                print "  Experiment %d: %d missing tile, %d no data voxels" \
+                  % (curr_LIMS_id, counts.missing_tile, counts.no_data)
         print "Getting laplacians"
     # Laplacians
-    if laplacian == 'boundary':
-        Lx = \
-          sp.block_diag(tuple(
-              [region_laplacian(get_structure_mask_nz(mcc, region, ipsi=True))
-               for region in sources.id]
-              ))
-        Ly_ipsi = \
-          sp.block_diag(tuple(
-              [region_laplacian(get_structure_mask_nz(mcc, region, ipsi=True))
-               for region in targets.id]
-              ))
-        Ly_contra = \
-          sp.block_diag(tuple(
-              [region_laplacian(get_structure_mask_nz(mcc, region, contra=True))
-               for region in targets.id]
-              ))
-    elif laplacian == 'free':
-        #m = mask_union(*[region_mask_ipsi_dict[sid] for sid in targets.id])
-        m = np.hstack(tuple([get_structure_mask_nz(mcc, region, ipsi=True)
-                             for region in sources.id]))
-        Lx = region_laplacian(m)
-        m = np.hstack(tuple([get_structure_mask_nz(mcc, region, ipsi=True)
-                             for region in targets.id]))
-        Ly_ipsi = region_laplacian(m)
-        m = np.hstack(tuple([get_structure_mask_nz(mcc, region, contra=True)
-                             for region in targets.id]))
-        Ly_contra = region_laplacian(m)
-    Lx=sp.csc_matrix(Lx)
-    Ly_ipsi=sp.csc_matrix(Ly_ipsi)
-    Ly_contra=sp.csc_matrix(Ly_contra)
+    if laplacian:
+        Lx = masks_laplacian(source_masks, laplacian,
+                             laplacian_size, laplacian_spacing)
+        Ly_ipsi = masks_laplacian(target_ipsi_masks, laplacian,
+                                  laplacian_size, laplacian_spacing)
+        Ly_contra = masks_laplacian(target_contra_masks, laplacian,
+                                    laplacian_size, laplacian_spacing)
     if verbose:
+        if isinstance(mcc, VolumeCache):
+            print "Volume cache: %(hits)d hits, %(misses)d misses" \
+              % mcc.stats()
         print "Done."
 
-    # Include only structures with sufficient injection information, and 
-    # experiments with one nonzero entry in row:
     experiment_dict={}
     experiment_dict['experiment_source_matrix']=experiment_source_matrix
     experiment_dict['experiment_target_matrix_ipsi']=\
       experiment_target_matrix_ipsi
     experiment_dict['experiment_target_matrix_contra']=\
       experiment_target_matrix_contra
-    experiment_dict['col_label_list_source']=col_label_list_source 
+    experiment_dict['col_label_list_source']=col_label_list_source
     experiment_dict['col_label_list_target_ipsi']=col_label_list_target_ipsi
     experiment_dict['col_label_list_target_contra']=col_label_list_target_contra
     experiment_dict['row_label_list']=row_label_list
@@ -497,13 +744,58 @@ def generate_voxel_matrices(mcc,
     experiment_dict['voxel_coords_target_ipsi']=voxel_coords_target_ipsi
     experiment_dict['voxel_coords_target_contra']=voxel_coords_target_contra
     experiment_dict['Omega']=Omega
+    experiment_dict['data_error_counts']=data_error_counts
     if laplacian:
         experiment_dict['Lx']=Lx
         experiment_dict['Ly_ipsi']=Ly_ipsi
         experiment_dict['Ly_contra']=Ly_contra
-    
+
     return experiment_dict
 
+RegionLabels = namedtuple('RegionLabels', ['idx', 'label', 'n_labels'])
+
+def region_labels(masks):
+    '''
+    Flat indices of the voxels of a list of regions, with the number of the
+    region of each, so that a volume is integrated over all the regions in
+    one np.bincount. Regions may overlap (e.g. nested structures); a voxel
+    then appears once for each region it belongs to.
+
+    Parameters
+    ----------
+    masks : list of FlatMask
+
+    Returns
+    -------
+    labels : RegionLabels
+    '''
+    label = np.repeat(np.arange(len(masks)), [ len(m) for m in masks ])
+    return RegionLabels(np.concatenate([ m.idx for m in masks ]), label,
+                        len(masks))
+
+def region_integrals(data, labels, exclude=None):
+    '''
+    Integrals of a volume over every region of labels, as integrate_in_mask
+    for each region, in one pass.
+
+    Parameters
+    ----------
+    data : 3-array of values
+    labels : RegionLabels
+    exclude : FlatMask, default=None
+      voxels left out of all the integrals, e.g. the injection shell
+
+    Returns
+    -------
+    sums : array of one integral per region
+    '''
+    values = np.take(data, labels.idx)
+    if exclude is not None and len(exclude) > 0:
+        values[exclude.contains(labels.idx)] = 0.0
+    values, _ = clean_error_codes(values)
+    return np.bincount(labels.label, weights=values,
+                       minlength=labels.n_labels)
+
 def generate_region_matrices(mcc,
                              source_id_list,
                              target_id_list, 
@@ -511,7 +803,8 @@ def generate_region_matrices(mcc,
                              LIMS_id_list = None,
                              source_shell=None,
                              cre = False,
-                             verbose = False):
+                             verbose = False,
+                             structure_masks = None):
     '''
     Generates the source and target expression matrices for a set of
     injections, which can then be used to fit the linear model, etc.
@@ -534,6 +827,8 @@ def generate_region_matrices(mcc,
         whether to use mask which draws a shell around source regions to
         account for extent of dendrites, set to an integer or None (default)
         for no shell
+      structure_masks : StructureMaskRegistry
+        source of the structure masks; by default a new in-memory registry
         
     Returns
     -------
@@ -544,6 +839,8 @@ def generate_region_matrices(mcc,
     from warnings import warn
     
     #ontology = mcc.get_ontology()
+    if structure_masks is None:
+        structure_masks = StructureMaskRegistry(mcc)
 
     if verbose:
         print "Creating experiment list"    
@@ -557,94 +854,59 @@ def generate_region_matrices(mcc,
         ex_list = ex_list[ex_list['id'].isin(LIMS_id_list)]
         LIMS_id_list = list(ex_list['id'])
     
-    # Get the region masks
+    # Label the voxels of every region once; each experiment's regional
+    # integrals are then a single np.bincount
     if verbose:
-        print "Getting region masks"
-    region_mask_dict={}
-    region_mask_ipsi_dict={}
-    region_mask_contra_dict={}
-    for struct_id in source_id_list + target_id_list:
-        region_mask_dict[struct_id] = get_structure_mask_nz(mcc, struct_id)
-        region_mask_ipsi_dict[struct_id] = \
-          get_structure_mask_nz(mcc, struct_id, ipsi=True)
-        region_mask_contra_dict[struct_id] = \
-          get_structure_mask_nz(mcc, struct_id, contra=True)
+        print "Labelling region voxels"
+    source_labels = region_labels([ structure_masks.get(struct_id)
+                                    for struct_id in source_id_list ])
+    target_labels = region_labels(
+        [ structure_masks.get(struct_id, ipsi=True)
+          for struct_id in target_id_list ] +
+        [ structure_masks.get(struct_id, contra=True)
+          for struct_id in target_id_list ])
+    n_target = len(target_id_list)
 
-    # Initialize matrices:
-    above_thresh = []
-    experiment_source_matrix_pre = np.zeros(( len(LIMS_id_list),
-                                              len(source_id_list) ))
-    
     # Source:
     if verbose:
         print "Getting source densities"
-    for jj, curr_structure_id in enumerate(source_id_list):
-        print "  region %d" % curr_structure_id
-        # Get the region mask:
-        curr_region_mask = region_mask_dict[curr_structure_id]
-        ipsi_injection_volume_list = []
-        for ii, curr_LIMS_id in enumerate(LIMS_id_list):
-            # # Get the injection mask:
-            # curr_experiment_mask = \
-            #   get_injection_mask_nz(mcc, curr_LIMS_id, shell=source_shell)
-            # intersection_mask = \
-            #   mask_intersection(curr_experiment_mask, curr_region_mask)
-            # # Compute integrated density, source:
-            # experiment_source_matrix_pre[ii, jj] = \
-            #   integrate_in_mask(mcc.get_injection_density(curr_LIMS_id)[0],
-            #                     intersection_mask)
-            expt_inj_density = mcc.get_injection_density(curr_LIMS_id)[0]
-            experiment_source_matrix_pre[ii, jj] = \
-              integrate_in_mask(expt_inj_density, curr_region_mask)
-            ipsi_injection_volume_list.append(np.sum(expt_inj_density > 0))
-        # Determine if current structure should be included in source list:
-        ipsi_injection_volume_array = np.array(ipsi_injection_volume_list)
-        num_exp_above_thresh = \
-          len( np.nonzero(
-              ipsi_injection_volume_array >= min_voxels_per_injection)[0])
-        if num_exp_above_thresh > 0:
-            above_thresh.append(jj)
-            
-    # Determine which experiments should be included:
-    nonzero_expts = [] 
-    for ii, row in enumerate(experiment_source_matrix_pre):
-        if row.sum() > 0.0:
-            nonzero_expts.append(ii)
+    experiment_source_matrix_pre = np.zeros(( len(LIMS_id_list),
+                                              len(source_id_list) ))
+    injection_nvox = np.zeros(len(LIMS_id_list), dtype=np.int64)
+    for ii, curr_LIMS_id in enumerate(LIMS_id_list):
+        expt_inj_density = mcc.get_injection_density(curr_LIMS_id)[0]
+        experiment_source_matrix_pre[ii] = \
+          region_integrals(expt_inj_density, source_labels)
+        injection_nvox[ii] = np.sum(expt_inj_density > 0)
+    # The injection volume threshold does not depend on the region, so the
+    # source regions are either all kept or all rejected
+    if not np.any(injection_nvox >= min_voxels_per_injection):
+        raise Exception('no injection has min_voxels_per_injection voxels')
 
-    if len(above_thresh) < len(source_id_list):
-        raise Exception('length of above_thresh < source_id_list')
-    
-    experiment_source_matrix = \
-      experiment_source_matrix_pre[:,above_thresh][nonzero_expts,:]
+    # Determine which experiments should be included:
+    nonzero_expts = np.flatnonzero(experiment_source_matrix_pre.sum(axis=1)
+                                   > 0.0)
+    experiment_source_matrix = experiment_source_matrix_pre[nonzero_expts,:]
     row_label_list = np.array(LIMS_id_list)[nonzero_expts]
-    col_label_list_source = np.array(source_id_list)[above_thresh]
-    
+    col_label_list_source = np.array(source_id_list)
+
     # Target:
     if verbose:
-        print "Getting target densities"    
-    experiment_target_matrix_ipsi = np.zeros(( len(row_label_list), 
-                                               len(target_id_list) ))
-    experiment_target_matrix_contra = np.zeros(( len(row_label_list), 
-                                                 len(target_id_list) ))
-    for jj, curr_structure_id in enumerate(target_id_list):
-        # Get the region mask:
-        curr_region_mask_ipsi = region_mask_ipsi_dict[curr_structure_id]
-        curr_region_mask_contra = region_mask_contra_dict[curr_structure_id]
-        for ii, curr_LIMS_id in enumerate(row_label_list):
-            # Get the injection mask:
-            curr_experiment_mask = \
-              get_injection_mask_nz(mcc, curr_LIMS_id, shell=source_shell)
-            this_PD = mcc.get_projection_density(curr_LIMS_id)[0]
-            # Compute integrated density, target, ipsi:
-            difference_mask = mask_difference(curr_region_mask_ipsi,
-                                              curr_experiment_mask)
-            experiment_target_matrix_ipsi[ii, jj] = \
-              integrate_in_mask(this_PD, difference_mask)
-            # Compute integrated density, target, contra:    
-            difference_mask = mask_difference(curr_region_mask_contra,
-                                              curr_experiment_mask)
-            experiment_target_matrix_contra[ii, jj] = \
-              integrate_in_mask(this_PD, difference_mask) 
+        print "Getting target densities"
+    experiment_target_matrix_ipsi = np.zeros(( len(row_label_list),
+                                               n_target ))
+    experiment_target_matrix_contra = np.zeros(( len(row_label_list),
+                                                 n_target ))
+    for ii, curr_LIMS_id in enumerate(row_label_list):
+        # Exclude the injection (and shell) from the targets
+        curr_experiment_mask = \
+          get_injection_mask_nz(mcc, curr_LIMS_id, shell=source_shell,
+                                flat=True)
+        this_PD = mcc.get_projection_density(curr_LIMS_id)[0]
+        target_sums = region_integrals(this_PD, target_labels,
+                                       exclude=curr_experiment_mask)
+        experiment_target_matrix_ipsi[ii] = target_sums[:n_target]
+        experiment_target_matrix_contra[ii] = target_sums[n_target:]
 
     if verbose:
         print "done, saving."
@@ -660,9 +922,9 @@ def generate_region_matrices(mcc,
     experiment_dict['col_label_list_target'] = np.array(target_id_list)
     experiment_dict['row_label_list'] = row_label_list
     experiment_dict['W0_ipsi'] = \
-      np.zeros(experiment_source_matrix.shape[1],
-               experiment_target_matrix_ipsi.shape[1])
+      np.zeros((experiment_source_matrix.shape[1],
+                experiment_target_matrix_ipsi.shape[1]))
     experiment_dict['W0_contra'] = \
-      np.zeros(experiment_source_matrix.shape[1],
-               experiment_target_matrix_contra.shape[1])
+      np.zeros((experiment_source_matrix.shape[1],
+                experiment_target_matrix_contra.shape[1]))
     return experiment_dict
@@ -0,0 +1,194 @@
+import numpy as np
+from .utilities import write_dictionary_to_group, read_dictionary_from_group
+
+# Target size of one chunk, in bytes; chunks span whole columns (injections)
+# where they fit, so reading a fold's columns reads whole chunks
+CHUNK_BYTES = 2**20
+
+def column_chunks(shape, itemsize, chunk_bytes=CHUNK_BYTES):
+    '''
+    Chunk shape for column access to a matrix of a given shape: as many rows
+    as fit in chunk_bytes (all of them if possible), then as many columns.
+    '''
+    nrow, ncol = shape
+    per_chunk = max(1, chunk_bytes // itemsize)
+    rows = max(1, min(nrow, per_chunk))
+    cols = max(1, min(ncol, per_chunk // rows))
+    return (rows, cols)
+
+def _compression_args(compression, compression_opts=None):
+    '''
+    h5py dataset arguments for a compression name: None, 'gzip', 'lzf' or
+    'lz4' (needs the hdf5plugin package).
+    '''
+    if compression is None:
+        return {}
+    if compression == 'lz4':
+        try:
+            import hdf5plugin
+        except ImportError:
+            raise ImportError("lz4 compression needs the hdf5plugin package")
+        return dict(hdf5plugin.LZ4())
+    args = {'compression': compression}
+    if compression_opts is not None:
+        args['compression_opts'] = compression_opts
+    return args
+
+def write_matrix(fn, mat, row_labels=None, col_labels=None, row_coords=None,
+                 metadata=None, compression=None, compression_opts=None,
+                 chunked=None):
+    '''
+    Write a dense or sparse matrix to an HDF5 file, with its labels, voxel
+    coordinates and metadata. The matrix itself uses the h5write layout, so
+    the file is also readable by h5read, h5read_columns and the solver.
+
+    Parameters
+    ----------
+    fn : str
+    mat : 2-d array or scipy.sparse matrix
+      usually voxels x injections
+    row_labels : array, default=None
+      label of each row, e.g. the structure id of each voxel
+    col_labels : array, default=None
+      label of each column, e.g. the experiment ids
+    row_coords : (nrows x 3) array, default=None
+      voxel coordinates of the rows
+    metadata : dict, default=None
+      stored in the group 'metadata'
+    compression : None, 'gzip', 'lzf' or 'lz4', default=None
+    compression_opts : default=None
+      e.g. the gzip level
+    chunked : bool, default=None
+      chunk dense matrices by columns (see column_chunks); implied by
+      compression. Unchunked, uncompressed matrices can be memory-mapped
+      by MatrixStore.
+    '''
+    import h5py
+    import scipy.sparse as sp
+    comp = _compression_args(compression, compression_opts)
+    if chunked is None:
+        chunked = compression is not None
+    with h5py.File(fn, 'w') as f:
+        if sp.issparse(mat):
+            if mat.format not in ('csr', 'csc'):
+                mat = mat.tocsr()
+            for name in ('data', 'indices'):
+                arr = getattr(mat, name)
+                if len(arr) > 0 and (chunked or comp):
+                    f.create_dataset(name, data=arr,
+                                     chunks=(min(len(arr), CHUNK_BYTES //
+                                                 arr.itemsize),), **comp)
+                else:
+                    f.create_dataset(name, data=arr)
+            f.create_dataset('indptr', data=mat.indptr)
+            f.attrs['format'] = mat.format
+            f.attrs['shape'] = mat.shape
+        else:
+            mat = np.asarray(mat)
+            if chunked and mat.size > 0:
+                f.create_dataset('dataset', data=mat,
+                                 chunks=column_chunks(mat.shape,
+                                                      mat.itemsize), **comp)
+            else:
+                f.create_dataset('dataset', data=mat)
+        if row_labels is not None:
+            f.create_dataset('row_labels', data=np.ravel(row_labels))
+        if col_labels is not None:
+            f.create_dataset('col_labels', data=np.ravel(col_labels))
+        if row_coords is not None:
+            f.create_dataset('row_coords', data=np.asarray(row_coords))
+        if metadata:
+            write_dictionary_to_group(f, metadata, create_name='metadata')
+
+class MatrixStore(object):
+    '''
+    Reader of a matrix file written by write_matrix (or h5write). The file
+    stays open and nothing is read until asked for; columns are read from
+    a memory map of the file when the matrix is stored uncompressed and
+    unchunked, through h5py selections otherwise.
+
+    Parameters
+    ----------
+    fn : str
+    '''
+    def __init__(self, fn):
+        import h5py
+        self.fn = fn
+        self._file = h5py.File(fn, 'r')
+        self.sparse = 'dataset' not in self._file
+        if self.sparse:
+            self.format = self._file.attrs['format']
+            if not isinstance(self.format, str):
+                self.format = self.format.decode()
+            self.shape = tuple(self._file.attrs['shape'])
+            self.dtype = self._file['data'].dtype
+        else:
+            self.format = 'dense'
+            self.shape = self._file['dataset'].shape
+            self.dtype = self._file['dataset'].dtype
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _optional(self, name):
+        if name in self._file:
+            return self._file[name][()]
+        return None
+
+    @property
+    def row_labels(self):
+        return self._optional('row_labels')
+
+    @property
+    def col_labels(self):
+        return self._optional('col_labels')
+
+    @property
+    def row_coords(self):
+        return self._optional('row_coords')
+
+    @property
+    def metadata(self):
+        if 'metadata' in self._file:
+            return read_dictionary_from_group(self._file['metadata'])
+        return {}
+
+    def memmap(self):
+        '''
+        Read-only np.memmap of a dense matrix stored contiguously and
+        uncompressed, or None if it is not stored that way.
+        '''
+        if self.sparse:
+            return None
+        ds = self._file['dataset']
+        if ds.chunks is not None or ds.compression is not None:
+            return None
+        offset = ds.id.get_offset()
+        if offset is None:
+            return None
+        return np.memmap(self.fn, mode='r', dtype=ds.dtype, shape=ds.shape,
+                         offset=offset)
+
+    def columns(self, cols, dense=False):
+        '''
+        Columns cols of the matrix, in the order given.
+        '''
+        from .utilities import h5read_columns
+        cols = np.asarray(cols, dtype=int)
+        mm = self.memmap()
+        if mm is not None:
+            return np.array(mm[:, cols])
+        return h5read_columns(self.fn, cols, dense=dense)
+
+    def array(self, dense=False):
+        '''
+        The whole matrix.
+        '''
+        from .utilities import h5read
+        return h5read(self.fn, dense=dense)
@@ -0,0 +1,328 @@
+import os
+import glob
+import numpy as np
+from collections import OrderedDict
+from .utilities import h5read, h5write, n_processes
+from .solver import fit_smooth_nnls
+
+HEMISPHERES = ('ipsi', 'contra')
+
+# Job states of a JobManifest
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+def jobs_fn(save_dir, save_stem):
+    return os.path.join(save_dir, save_stem + '_jobs.json')
+
+class JobManifest(object):
+    '''
+    State of the fits of a nested cross-validation run, stored as JSON and
+    rewritten (atomically) whenever a job changes state. Jobs are keyed by
+    their output file, relative to the run directory, e.g.
+    'cval0/cval1/W_ipsi_1.0000e+03.h5'.
+
+    Each job is a dict with the fold path, hemisphere, lambda, output file
+    (W_fn), warm start file (W0_fn, or None) and, once run, its status,
+    objective, iteration count and error on the fold's test set.
+    '''
+    def __init__(self, fn):
+        import json
+        self.fn = fn
+        self.jobs = OrderedDict()
+        if os.path.exists(fn):
+            with open(fn) as f:
+                self.jobs = json.load(f, object_pairs_hook=OrderedDict)
+
+    def add(self, key, **fields):
+        '''
+        Add a job, unless it is already known (from an earlier run).
+        '''
+        if key not in self.jobs:
+            job = dict(status=PENDING, objective=None, n_iter=None,
+                       error=None, message=None)
+            job.update(fields)
+            self.jobs[key] = job
+        return self.jobs[key]
+
+    def update(self, key, **fields):
+        self.jobs[key].update(fields)
+        self.save()
+
+    def todo(self, keys):
+        '''
+        Jobs of keys which have not completed, or whose output is gone.
+        '''
+        return [ key for key in keys
+                 if self.jobs[key]['status'] != DONE or
+                 not os.path.exists(self.jobs[key]['W_fn']) ]
+
+    def save(self):
+        import json
+        tmp_fn = self.fn + '.tmp%d' % os.getpid()
+        with open(tmp_fn, 'w') as f:
+            json.dump(self.jobs, f, indent=1)
+        os.rename(tmp_fn, self.fn)
+
+def nested_fold_paths(save_dir, save_stem):
+    '''
+    Outer fold paths of a run and the inner fold paths of each, from the
+    fold manifest if the run has one and from its directories otherwise.
+
+    Returns
+    -------
+    folds : OrderedDict of lists of inner paths, by outer path
+    '''
+    from .folds import FoldManifest, manifest_fn, fold_path
+    folds = OrderedDict()
+    if os.path.exists(manifest_fn(save_dir, save_stem)):
+        manifest = FoldManifest.load(manifest_fn(save_dir, save_stem))
+        for outer in manifest.paths():
+            folds[outer] = manifest.paths(outer)
+    else:
+        for outer_dir in sorted(glob.glob(os.path.join(save_dir, 'cval*'))):
+            outer = fold_path(save_dir, outer_dir)
+            folds[outer] = [ fold_path(save_dir, d) for d in
+                             sorted(glob.glob(os.path.join(outer_dir,
+                                                           'cval*'))) ]
+    return folds
+
+# State of the process pool workers of run_jobs: the run and the last fold
+# problem read, reused by consecutive jobs of the same fold
+_fit_worker_state = {}
+
+def _init_fit_worker(save_dir, save_stem, loss, solver_args):
+    _fit_worker_state['run'] = (save_dir, save_stem, loss, solver_args)
+    _fit_worker_state['problem'] = (None, None)
+
+def _fold_problem(path, hemisphere):
+    from .folds import load_fold_problem
+    key, problem = _fit_worker_state['problem']
+    if key != (path, hemisphere):
+        save_dir, save_stem = _fit_worker_state['run'][:2]
+        problem = load_fold_problem(save_dir, save_stem, path, hemisphere)
+        _fit_worker_state['problem'] = ((path, hemisphere), problem)
+    return problem
+
+def _fit_worker(args):
+    '''
+    Fit one job; failures are returned rather than raised, so that one bad
+    fit does not stop the run.
+    '''
+    import traceback
+    key, job = args
+    loss, solver_args = _fit_worker_state['run'][2:]
+    try:
+        problem = _fold_problem(job['path'], job['hemisphere'])
+        W_fn = job['W_fn']
+        checkpoint_fn = W_fn + '.CHECKPT'
+        if os.path.exists(checkpoint_fn):
+            W0 = h5read(checkpoint_fn)
+        elif job['W0_fn'] is not None and os.path.exists(job['W0_fn']):
+            W0 = h5read(job['W0_fn'])
+        else:
+            W0 = None
+        result = fit_smooth_nnls(problem.X_train, problem.Y_train,
+                                 problem.Lx, problem.Ly, job['lam'],
+                                 Omega=problem.Omega_train, W0=W0,
+                                 checkpoint_fn=checkpoint_fn, **solver_args)
+        tmp_fn = W_fn + '.tmp%d.h5' % os.getpid()
+        h5write(tmp_fn, result.W)
+        os.rename(tmp_fn, W_fn)
+        os.remove(checkpoint_fn)
+        error = loss(result.W, problem.X_test, problem.Y_test,
+                     problem.Omega_test)
+        return key, dict(status=DONE, objective=float(result.objective),
+                         n_iter=result.n_iter, error=float(error),
+                         message=None)
+    except Exception:
+        return key, dict(status=FAILED, message=traceback.format_exc())
+
+def run_jobs(manifest, keys, save_dir, save_stem, n_jobs=1, loss=None,
+             solver_args=None, verbose=False):
+    '''
+    Run the jobs of keys which have not completed on a pool of n_jobs
+    processes (-1 for one per cpu), recording their state in the manifest.
+    A job interrupted earlier restarts from its checkpoint.
+    '''
+    import multiprocessing
+    if loss is None:
+        from .lossfun import rel_MSE_2
+        loss = rel_MSE_2
+    if solver_args is None:
+        solver_args = {}
+    todo = manifest.todo(keys)
+    if verbose:
+        print "  %d of %d fits to run" % (len(todo), len(keys))
+    if len(todo) == 0:
+        return
+    for key in todo:
+        manifest.jobs[key]['status'] = RUNNING
+    manifest.save()
+    args = [ (key, manifest.jobs[key]) for key in todo ]
+    initargs = (save_dir, save_stem, loss, solver_args)
+    n_jobs = n_processes(n_jobs)
+    if n_jobs == 1:
+        _init_fit_worker(*initargs)
+        results = (_fit_worker(a) for a in args)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(n_jobs, initializer=_init_fit_worker,
+                                    initargs=initargs)
+        results = pool.imap_unordered(_fit_worker, args)
+    try:
+        for key, fields in results:
+            manifest.update(key, **fields)
+            if verbose:
+                if fields['status'] == DONE:
+                    print "  %s: error %e, %d iterations" % \
+                      (key, fields['error'], fields['n_iter'])
+                else:
+                    print "  %s failed:\n%s" % (key, fields['message'])
+        if pool is not None:
+            pool.close()
+    except:
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.join()
+
+def select_lambda(err_ipsi, err_contra, lambda_list, select_one_lambda=False):
+    '''
+    Lambdas with the smallest mean error over inner folds.
+
+    Parameters
+    ----------
+    err_ipsi, err_contra : (n_inner x n_lambda) arrays
+      validation errors, nan for failed fits
+    lambda_list : list of float
+    select_one_lambda : bool, default=False
+      select the lambda minimizing the sum of ipsi and contra errors for
+      both
+
+    Returns
+    -------
+    lambda_ipsi, lambda_contra : float
+      nan when no fit of a hemisphere (of either, with select_one_lambda)
+      has a valid error
+    '''
+    import warnings
+    def argmin_lambda(err):
+        if not np.any(np.isfinite(err)):
+            return np.nan
+        return lambda_list[np.nanargmin(err)]
+    with warnings.catch_warnings():
+        # lambdas without any valid error have a nan mean
+        warnings.simplefilter('ignore', RuntimeWarning)
+        err_ipsi_mean = np.nanmean(err_ipsi, axis=0)
+        err_contra_mean = np.nanmean(err_contra, axis=0)
+    if select_one_lambda:
+        lam = argmin_lambda(err_ipsi_mean + err_contra_mean)
+        return lam, lam
+    return argmin_lambda(err_ipsi_mean), argmin_lambda(err_contra_mean)
+
+def run_nested_cv(save_dir, save_stem, lambda_list, select_one_lambda=False,
+                  lambda_fn=None, n_jobs=1, loss=None, verbose=False,
+                  **solver_args):
+    '''
+    Nested cross-validation of the voxel model of a run made by
+    create_voxel_matrices.py, in place of the model fitting commands and
+    model_select_and_fit.py: all inner fold fits (fold, lambda, hemisphere)
+    are run on a process pool, the lambdas with the smallest mean inner
+    validation error are selected, and each outer fold is refit on its
+    training set, warm-started from its last inner fold's fit.
+
+    Progress is kept in the run's JobManifest (<save_stem>_jobs.json), so
+    calling this again after an interruption only runs the fits which did
+    not complete, resuming those which have a checkpoint.
+
+    Parameters
+    ----------
+    save_dir, save_stem : str
+      run directory and file stem
+    lambda_list : list of float
+    select_one_lambda : bool, default=False
+      see select_lambda
+    lambda_fn : str, default=None
+      file in each outer fold directory to which the selected lambdas are
+      written, as read by region_model_fits_and_voxel_errors.py
+    n_jobs : int, default=1
+      number of worker processes, -1 for one per cpu
+    loss : function(W, X, Y, Omega), default=None
+      validation error, default lossfun.rel_MSE_2
+    verbose : bool, default=False
+    solver_args :
+      passed on to solver.fit_smooth_nnls
+
+    Returns
+    -------
+    selected : OrderedDict of (lambda_ipsi, lambda_contra) by outer path
+    '''
+    folds = nested_fold_paths(save_dir, save_stem)
+    manifest = JobManifest(jobs_fn(save_dir, save_stem))
+    def add_job(path, hemisphere, lam, W_name, W0_fn=None):
+        key = path + '/' + W_name
+        manifest.add(key, path=path, hemisphere=hemisphere, lam=float(lam),
+                     W_fn=os.path.join(os.path.abspath(save_dir),
+                                       *key.split('/')),
+                     W0_fn=W0_fn)
+        return key
+    inner_keys = OrderedDict()
+    # all the lambdas of a fold and hemisphere in a row, so that a worker
+    # reuses the fold problem it read for the previous job
+    for outer, inners in folds.items():
+        for inner in inners:
+            for hemisphere in HEMISPHERES:
+                for lam in lambda_list:
+                    inner_keys[(inner, hemisphere, lam)] = \
+                      add_job(inner, hemisphere, lam,
+                              'W_%s_%1.4e.h5' % (hemisphere, lam))
+    manifest.save()
+    if verbose:
+        print "Running inner cross-validation fits"
+    run_jobs(manifest, list(inner_keys.values()), save_dir, save_stem,
+             n_jobs=n_jobs, loss=loss, solver_args=solver_args,
+             verbose=verbose)
+    selected = OrderedDict()
+    final_keys = []
+    for outer, inners in folds.items():
+        err = {}
+        for hemisphere in HEMISPHERES:
+            err[hemisphere] = np.array(
+                [ [ manifest.jobs[inner_keys[(inner, hemisphere, lam)]]
+                    ['error'] for lam in lambda_list ]
+                  for inner in inners ], dtype=np.float64)
+        lambda_ipsi, lambda_contra = select_lambda(err['ipsi'],
+                                                   err['contra'],
+                                                   lambda_list,
+                                                   select_one_lambda)
+        selected[outer] = (lambda_ipsi, lambda_contra)
+        if verbose:
+            print "%s: selected lambda_ipsi=%1.4e, lambda_contra=%1.4e" % \
+              (outer, lambda_ipsi, lambda_contra)
+        if lambda_fn is not None:
+            with open(os.path.join(save_dir, *(outer.split('/') +
+                                               [lambda_fn])), 'w') as f:
+                f.write(str(lambda_ipsi) + '\n')
+                f.write(str(lambda_contra) + '\n')
+        for hemisphere, lam in zip(HEMISPHERES,
+                                   (lambda_ipsi, lambda_contra)):
+            if np.isnan(lam):
+                if verbose:
+                    print "%s: no valid %s inner fit, not refitting" % \
+                      (outer, hemisphere)
+                continue
+            W0_fn = manifest.jobs[inner_keys[(inners[-1], hemisphere,
+                                              lam)]]['W_fn']
+            final_keys.append(add_job(outer, hemisphere, lam,
+                                      'W_%s_opt_%1.4e.h5' % (hemisphere, lam),
+                                      W0_fn=W0_fn))
+    manifest.save()
+    if verbose:
+        print "Fitting the selected models"
+    run_jobs(manifest, final_keys, save_dir, save_stem, n_jobs=n_jobs,
+             loss=loss, solver_args=solver_args, verbose=verbose)
+    return selected
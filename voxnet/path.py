@@ -0,0 +1,185 @@
+import os
+import numpy as np
+from collections import namedtuple
+from .utilities import h5read
+from .solver import fit_smooth_nnls, _write_checkpoint
+
+PathStep = namedtuple('PathStep',
+                      ['lam', 'W_fn', 'error', 'objective', 'n_iter'])
+
+def fit_path(X, Y, Lx, Ly, lambda_list, Omega=None, X_test=None,
+             Y_test=None, Omega_test=None, W_fn_fmt=None, errors_fn=None,
+             loss=None, early_stop=False, patience=1, W0=None,
+             verbose=False, **solver_args):
+    '''
+    Fits the smoothness-regularized voxel model along a regularization path,
+    from the largest lambda to the smallest, each fit warm-started from the
+    previous solution. Each W and its validation error are written as soon
+    as they are computed; a W file which already exists (and can be read)
+    is read instead of refit, so an interrupted path resumes where it
+    stopped. W files are written under a temporary name and renamed, so an
+    interrupted write never leaves a partial fit behind.
+
+    Parameters
+    ----------
+    X, Y, Lx, Ly, Omega : training problem, see solver.SmoothObjective
+    lambda_list : list of float
+    X_test, Y_test, Omega_test : default=None
+      validation data; errors are only computed when given
+    W_fn_fmt : str, default=None
+      file name format of the fits, e.g. 'W_ipsi_%1.4e.h5'
+    errors_fn : str, default=None
+      CSV file with one line (lambda, error, objective, n_iter) per fit;
+      the lambdas left after an early stop get an infinite error
+    loss : function(W, X, Y, Omega), default=None
+      validation error, default lossfun.rel_MSE_2; Omega is passed as a
+      lossfun.OmegaMask
+    early_stop : bool, default=False
+      stop once the validation error has risen for patience consecutive
+      lambdas
+    patience : int, default=1
+    W0 : array, default=None
+      warm start of the first (largest) lambda
+    verbose : bool, default=False
+    solver_args :
+      passed on to solver.fit_smooth_nnls
+
+    Returns
+    -------
+    steps : list of PathStep, in the order fit
+    '''
+    if loss is None:
+        from .lossfun import rel_MSE_2
+        loss = rel_MSE_2
+    validate = X_test is not None and Y_test is not None
+    if Omega_test is not None:
+        # index Omega once for all the lambdas
+        from .lossfun import OmegaMask
+        Omega_test = OmegaMask(Omega_test)
+    if errors_fn is not None:
+        fid = open(errors_fn, 'w')
+        fid.write('lambda,error,objective,n_iter\n')
+        fid.flush()
+    steps = []
+    W = W0
+    best_error = np.inf
+    n_rising = 0
+    lambdas = sorted(lambda_list, reverse=True)
+    try:
+        for k, lam in enumerate(lambdas):
+            W_fn = W_fn_fmt % lam if W_fn_fmt is not None else None
+            W_done = None
+            if W_fn is not None and os.path.exists(W_fn):
+                try:
+                    W_done = h5read(W_fn)
+                except (IOError, OSError, KeyError):
+                    if verbose:
+                        print "  cannot read %s, refitting" % W_fn
+            if W_done is not None:
+                W = W_done
+                objective, n_iter = np.nan, 0
+            else:
+                result = fit_smooth_nnls(X, Y, Lx, Ly, lam, Omega=Omega,
+                                         W0=W, **solver_args)
+                W, objective, n_iter = result.W, result.objective, \
+                  result.n_iter
+                if W_fn is not None:
+                    _write_checkpoint(W_fn, W)
+            if validate:
+                error = loss(W, X_test, Y_test, Omega_test)
+            else:
+                error = np.nan
+            steps.append(PathStep(lam, W_fn, error, objective, n_iter))
+            if errors_fn is not None:
+                fid.write('%1.4e,%.10e,%.10e,%d\n' % (lam, error, objective,
+                                                      n_iter))
+                fid.flush()
+            if verbose:
+                print "  lambda=%1.4e: error %e, %d iterations" % \
+                  (lam, error, n_iter)
+            if early_stop and validate:
+                if error < best_error:
+                    best_error = error
+                    n_rising = 0
+                else:
+                    n_rising += 1
+                    if n_rising >= patience:
+                        if verbose:
+                            print "  validation error rising, stopping"
+                        # the lambdas not fit lose any selection
+                        if errors_fn is not None:
+                            for lam_left in lambdas[k+1:]:
+                                fid.write('%1.4e,inf,nan,0\n' % lam_left)
+                        break
+    finally:
+        if errors_fn is not None:
+            fid.close()
+    return steps
+
+def path_errors_fn(fold_dir, hemisphere):
+    return os.path.join(fold_dir, 'path_errors_%s.csv' % hemisphere)
+
+def skipped_lambdas(errors_fn):
+    '''
+    Lambdas (formatted as in the W file names) which a path stopped early
+    before fitting, from its errors file; empty if there is none.
+    '''
+    skipped = set()
+    if not os.path.exists(errors_fn):
+        return skipped
+    with open(errors_fn) as f:
+        f.readline()
+        for line in f:
+            fields = line.strip().split(',')
+            if len(fields) == 4 and np.isposinf(float(fields[1])):
+                skipped.add('%1.4e' % float(fields[0]))
+    return skipped
+
+def fit_fold_path(save_dir, save_stem, path, hemisphere, lambda_list,
+                  early_stop=False, verbose=False, **solver_args):
+    '''
+    Regularization path of one inner fold and hemisphere of a run made by
+    create_voxel_matrices.py. The fits are written to the fold directory
+    with the names of the solver commands (W_<hemisphere>_<lambda>.h5), so
+    model_select_and_fit.py reads them as before, and the validation errors
+    to path_errors_<hemisphere>.csv.
+    '''
+    from .folds import load_fold_problem
+    problem = load_fold_problem(save_dir, save_stem, path, hemisphere)
+    fold_dir = os.path.join(save_dir, *path.split('/'))
+    return fit_path(problem.X_train, problem.Y_train, problem.Lx, problem.Ly,
+                    lambda_list, Omega=problem.Omega_train,
+                    X_test=problem.X_test, Y_test=problem.Y_test,
+                    Omega_test=problem.Omega_test,
+                    W_fn_fmt=os.path.join(fold_dir,
+                                          'W_%s_%%1.4e.h5' % hemisphere),
+                    errors_fn=path_errors_fn(fold_dir, hemisphere),
+                    early_stop=early_stop, verbose=verbose, **solver_args)
+
+def path_command(save_dir, save_stem, path, hemisphere, lambda_list,
+                 early_stop=False):
+    '''
+    Shell command fitting the path of one fold and hemisphere.
+    '''
+    import sys
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    args = [ os.path.abspath(save_dir), save_stem, path, hemisphere ]
+    if early_stop:
+        args.append('--early_stop')
+    args += [ '%1.4e' % lam for lam in lambda_list ]
+    return 'PYTHONPATH=%s %s -m voxnet.path %s' % \
+      (package_dir, sys.executable, ' '.join(args))
+
+if __name__ == '__main__':
+    import sys
+    argv = sys.argv[1:]
+    early_stop = '--early_stop' in argv
+    argv = [ a for a in argv if a != '--early_stop' ]
+    if len(argv) < 5:
+        print "usage: python -m voxnet.path save_dir save_stem fold_path " \
+          "hemisphere [--early_stop] lambda [lambda ...]"
+        sys.exit(1)
+    save_dir, save_stem, path, hemisphere = argv[:4]
+    lambda_list = [ float(lam) for lam in argv[4:] ]
+    fit_fold_path(save_dir, save_stem, path, hemisphere, lambda_list,
+                  early_stop=early_stop, verbose=True)
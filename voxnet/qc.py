@@ -0,0 +1,177 @@
+import os
+import numpy as np
+from .mask import FlatMask, mask_intersection
+from .utilities import integrate_in_mask, n_processes
+
+QC_COLUMNS = ['source_frac', 'injection_volume',
+              'invalid', 'missing_tile', 'no_data']
+
+def experiment_qc(mcc, LIMS_id, source_mask, epsilon=0.0):
+    '''
+    Quality control values of one experiment, from a single read of its
+    injection fraction and data mask.
+
+    Parameters
+    ----------
+    mcc : MouseConnectivityCache
+    LIMS_id : int
+      experiment id
+    source_mask : FlatMask
+      union of the source region masks
+    epsilon : float, default=0.0
+      injection fraction threshold for the injection mask
+
+    Returns
+    -------
+    qc : list of values, in the order of QC_COLUMNS: fraction of the
+      injection inside source_mask, injection volume (mm^3) and the counts
+      of LIMS error codes -1, -2, -3 in the injection mask
+    '''
+    volume_per_voxel = float(mcc.resolution)**3 * 1e-9
+    inj_frac = mcc.get_injection_fraction(LIMS_id)[0]
+    # same mask as get_injection_mask_nz, without reading inj_frac again
+    data_mask = mcc.get_data_mask(LIMS_id)[0]
+    inj_mask = FlatMask.from_volume(np.logical_and(inj_frac > epsilon,
+                                                   data_mask))
+    total_pd, counts = integrate_in_mask(inj_frac, inj_mask,
+                                         return_counts=True)
+    total_source_pd = integrate_in_mask(inj_frac,
+                                        mask_intersection(inj_mask,
+                                                          source_mask))
+    if total_pd > 0:
+        source_frac = total_source_pd / total_pd
+    else:
+        source_frac = 0.0
+    return [source_frac, total_pd * volume_per_voxel] + list(counts)
+
+# State of the process pool workers of experiment_qc_table, set once per
+# worker at fork
+_qc_worker_state = {}
+
+def _init_qc_worker(mcc, source_mask, epsilon):
+    _qc_worker_state['mcc'] = mcc
+    _qc_worker_state['source_mask'] = source_mask
+    _qc_worker_state['epsilon'] = epsilon
+
+def _qc_worker(LIMS_id):
+    return experiment_qc(_qc_worker_state['mcc'], LIMS_id,
+                         _qc_worker_state['source_mask'],
+                         epsilon=_qc_worker_state['epsilon'])
+
+def qc_table_fn(qc_dir, source_ids, epsilon, resolution):
+    '''
+    File of the QC table for a source set, epsilon and resolution.
+    '''
+    import hashlib
+    key = '%s %r %s' % (' '.join([ str(int(s)) for s in sorted(source_ids) ]),
+                        float(epsilon), str(resolution))
+    digest = hashlib.md5(key.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(qc_dir, 'experiment_qc_%s.csv' % digest)
+
+def experiment_qc_table(mcc, LIMS_id_list, source_mask, source_ids=None,
+                        epsilon=0.0, n_jobs=1, qc_dir=None):
+    '''
+    QC table of a list of experiments, computed in parallel. If qc_dir is
+    given, the table is stored there as CSV, keyed by source set, epsilon
+    and resolution, and only experiments missing from the stored table are
+    computed.
+
+    Parameters
+    ----------
+    mcc : MouseConnectivityCache
+    LIMS_id_list : list
+      experiments
+    source_mask : FlatMask
+      union of the source region masks
+    source_ids : list, default=None
+      source structure ids, required with qc_dir to key the table
+    epsilon : float, default=0.0
+      injection fraction threshold for the injection masks
+    n_jobs : int, default=1
+      number of worker processes, -1 for one per cpu
+    qc_dir : str, default=None
+      directory in which to store the table
+
+    Returns
+    -------
+    table : pandas DataFrame indexed by experiment id (in the order of
+      LIMS_id_list), with columns QC_COLUMNS
+    '''
+    import pandas as pd
+    import multiprocessing
+    fn = None
+    table = pd.DataFrame(columns=QC_COLUMNS)
+    if qc_dir is not None:
+        assert source_ids is not None, "source_ids are needed with qc_dir"
+        fn = qc_table_fn(qc_dir, source_ids, epsilon, mcc.resolution)
+        if os.path.exists(fn):
+            # round_trip reads back the exact fractions written
+            table = pd.read_csv(fn, index_col=0,
+                                float_precision='round_trip')
+    todo = [ LIMS_id for LIMS_id in LIMS_id_list
+             if LIMS_id not in table.index ]
+    if len(todo) > 0:
+        n_jobs = n_processes(n_jobs)
+        if n_jobs == 1:
+            rows = [ experiment_qc(mcc, LIMS_id, source_mask, epsilon)
+                     for LIMS_id in todo ]
+        else:
+            pool = multiprocessing.Pool(n_jobs, initializer=_init_qc_worker,
+                                        initargs=(mcc, source_mask, epsilon))
+            try:
+                rows = pool.map(_qc_worker, todo)
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        new = pd.DataFrame(rows, index=todo, columns=QC_COLUMNS)
+        table = pd.concat([table, new])
+        if fn is not None:
+            try:
+                os.makedirs(qc_dir)
+            except OSError:
+                pass
+            # write then rename, so a reader never sees a partial table
+            tmp_fn = fn + '.tmp%d' % os.getpid()
+            table.to_csv(tmp_fn, index_label='id')
+            os.rename(tmp_fn, fn)
+    for col in QC_COLUMNS[2:]:
+        table[col] = table[col].astype(int)
+    return table.loc[list(LIMS_id_list)]
+
+def filter_qc_table(table, source_coverage=0.8, max_injection_volume=np.inf,
+                    verbose=False):
+    '''
+    Experiments of a QC table with enough injection in the sources and not
+    too large an injection volume.
+
+    Parameters
+    ----------
+    table : pandas DataFrame, see experiment_qc_table
+    source_coverage : float, default=0.8
+      fraction of injection density that should be contained in sources
+    max_injection_volume : float, default=np.inf
+      maximum injection volume (mm^3)
+    verbose : bool, default=False
+      print the QC values of each experiment
+
+    Returns
+    -------
+    LIMS_id_list : list of the experiments kept, in table order
+    '''
+    low_coverage = table['source_frac'] < source_coverage
+    large_volume = table['injection_volume'] > max_injection_volume
+    for LIMS_id in table.index:
+        if verbose:
+            print "  Analyzing experiment %d" % LIMS_id
+            print "    source_frac = %f" % table.loc[LIMS_id, 'source_frac']
+            print "    injection volume = %f" % \
+              table.loc[LIMS_id, 'injection_volume']
+        if low_coverage[LIMS_id]:
+            print "  Experiment %d has too little coverage" % LIMS_id
+        if large_volume[LIMS_id]:
+            print "  Experiment %d has too much injection volume" % LIMS_id
+    return [ int(LIMS_id) for LIMS_id in
+             table.index[~(low_coverage | large_volume).values] ]
@@ -0,0 +1,432 @@
+import numpy as np
+import scipy.linalg as la
+import scipy.sparse as sp
+
+class RegionProjection(object):
+    '''
+    Sparse linear map between voxels and regions, e.g. the (n_reg x n_vox)
+    region indicator matrix summing voxels into their regions. Products
+    with dense arguments are dense arrays, with sparse arguments sparse
+    matrices.
+
+    Parameters
+    ----------
+    matrix : array or sparse matrix
+    '''
+    def __init__(self, matrix):
+        self.matrix = sp.csr_matrix(matrix)
+        self.shape = self.matrix.shape
+
+    @classmethod
+    def from_labels(cls, label_list):
+        '''
+        Region indicator matrix of voxel labels, regions in sorted label
+        order.
+        '''
+        labels = np.ravel(label_list)
+        regions, inverse = np.unique(labels, return_inverse=True)
+        n_vox = len(labels)
+        matrix = sp.csr_matrix((np.ones(n_vox), (inverse, np.arange(n_vox))),
+                               shape=(len(regions), n_vox))
+        projection = cls(matrix)
+        projection.regions = regions
+        return projection
+
+    @property
+    def T(self):
+        return RegionProjection(self.matrix.T)
+
+    def dot(self, A):
+        if sp.issparse(A):
+            return self.matrix.dot(A)
+        return self.matrix.dot(np.asarray(A))
+
+    def pinv(self):
+        '''
+        Pseudoinverse of a region indicator matrix P, P^T (P P^T)^-1: P P^T
+        is diagonal with the region sizes, so this spreads the value of a
+        region evenly over its voxels.
+        '''
+        sizes = np.asarray(self.matrix.sum(axis=1)).ravel()
+        return RegionProjection(self.matrix.T.dot(sp.diags(1.0 / sizes)))
+
+    def toarray(self):
+        return self.matrix.toarray()
+
+def construct_proj_op(label_list):
+    '''
+    Region indicator operator of voxel labels and its pseudoinverse, as
+    RegionProjection.
+
+    Returns
+    -------
+    proj : (n_reg x n_vox) RegionProjection
+    proj_pinv : (n_vox x n_reg) RegionProjection
+    '''
+    proj = RegionProjection.from_labels(label_list)
+    return proj, proj.pinv()
+
+def _solve_psd(G, c):
+    '''
+    Solution of G z = c for a positive semidefinite G, by Cholesky, or
+    least squares if G is singular.
+    '''
+    try:
+        return la.cho_solve(la.cho_factor(G), c)
+    except la.LinAlgError:
+        return la.lstsq(G, c)[0]
+
+def _support_solution(G, c, x, P):
+    '''
+    From a nonnegative x supported on P, the least squares solution on P,
+    or, where it has nonpositive entries, the point where the segment to it
+    leaves the nonnegative orthant, dropping the entries reaching zero from
+    P (in place) and repeating. This is the inner loop of Lawson and Hanson.
+    '''
+    while np.any(P):
+        z = np.zeros(len(c))
+        z[P] = _solve_psd(G[np.ix_(P, P)], c[P])
+        if np.all(z[P] > 0):
+            return z
+        neg = np.where(P & (z <= 0))[0]
+        ratios = x[neg] / (x[neg] - z[neg])
+        alpha = ratios.min()
+        x = x + alpha * (z - x)
+        x[neg[ratios == alpha]] = 0.0
+        P &= x > 0
+        x[~P] = 0.0
+    return np.zeros(len(c))
+
+def nnls_tol(G, c):
+    return 10 * np.finfo(np.float64).eps * len(c) * \
+      max(np.abs(G).max() if G.size else 0.0, np.abs(c).max(), 1.0)
+
+def nnls_gram(G, c, passive=None, max_iter=None, tol=None):
+    '''
+    Nonnegative least squares min_{x >= 0} ||A x - b||^2 in Gram form,
+    G = A^T A and c = A^T b, by the active set method of Lawson and Hanson,
+    optionally warm-started from a passive set (the support of a nearby
+    solution), which typically leaves only a few exchanges to make.
+
+    Parameters
+    ----------
+    G : (n x n) array
+    c : (n,) array
+    passive : (n,) boolean array, default=None
+      initial guess of the support of the solution
+    max_iter : int, default=None
+      maximum number of variables added to the support (default 3 n)
+    tol : float, default=None
+      tolerance on the gradient, default nnls_tol(G, c)
+
+    Returns
+    -------
+    x : (n,) array
+    passive : (n,) boolean array, support of x
+    '''
+    n = len(c)
+    if max_iter is None:
+        max_iter = 3 * n
+    if tol is None:
+        tol = nnls_tol(G, c)
+    x = np.zeros(n)
+    P = np.zeros(n, dtype=bool)
+    if passive is not None and np.any(passive):
+        P = np.array(passive, dtype=bool)
+        x[P] = np.maximum(_solve_psd(G[np.ix_(P, P)], c[P]), 0.0)
+        P = x > 0
+        x = _support_solution(G, c, x, P)
+    for it in range(max_iter):
+        w = c - G.dot(x)
+        w[P] = -np.inf
+        k = np.argmax(w)
+        if not w[k] > tol:
+            break
+        P[k] = True
+        x = _support_solution(G, c, x, P)
+    return x, P
+
+def loo_nnls(A, b, G=None, c=None, x=None, passive=None, tol=None,
+             inverse_cache=None):
+    '''
+    Leave-one-out NNLS solutions of A x = b, leaving out each row of A in
+    turn. The fit without row i has Gram matrix G - a_i a_i^T, so on the
+    support of the full fit it follows from the full fit by a rank-one
+    (Sherman-Morrison) update,
+
+      x_(-i) = x + G_P^-1 a_i r_i / (1 - a_i^T G_P^-1 a_i),
+
+    with r_i the full fit residual of row i. Where that is not a
+    nonnegative least squares solution (negative coefficients or a
+    violated optimality condition off the support), the fit is redone by
+    nnls_gram, warm-started from the full support.
+
+    Parameters
+    ----------
+    A : (n_obs x n) array
+    b : (n_obs,) array
+    G, c : default=None
+      A^T A and A^T b, if already computed
+    x, passive : default=None
+      full data solution and its support, if already computed
+    tol : float, default=None
+      see nnls_gram
+    inverse_cache : dict, default=None
+      inverses of G on supports, by support, shared between calls with the
+      same A
+
+    Returns
+    -------
+    X_loo : (n x n_obs) array, column i is the fit without row i
+    n_refits : int, number of fits which needed the active set method
+    '''
+    if G is None:
+        G = A.T.dot(A)
+    if c is None:
+        c = A.T.dot(b)
+    if tol is None:
+        tol = nnls_tol(G, c)
+    if x is None or passive is None:
+        x, passive = nnls_gram(G, c, tol=tol)
+    n_obs, n = A.shape
+    P = passive
+    A_P = A[:, P]
+    X_loo = np.zeros((n, n_obs))
+    feasible = np.ones(n_obs, dtype=bool)
+    if np.any(P):
+        key = P.tobytes()
+        if inverse_cache is not None and key in inverse_cache:
+            G_inv = inverse_cache[key]
+        else:
+            G_inv = la.pinvh(G[np.ix_(P, P)])
+            if inverse_cache is not None:
+                inverse_cache[key] = G_inv
+        U = G_inv.dot(A_P.T)
+        d = 1.0 - np.sum(A_P.T * U, axis=0)
+        r = A_P.dot(x[P]) - b
+        feasible &= d > np.sqrt(np.finfo(np.float64).eps)
+        d[~feasible] = 1.0
+        X_P = x[P][:, np.newaxis] + U * (r / d)[np.newaxis, :]
+        X_loo[P] = X_P
+        feasible &= np.all(X_P >= 0, axis=0)
+        fit = np.sum(A_P.T * X_P, axis=0)
+    else:
+        X_P = np.zeros((0, n_obs))
+        fit = np.zeros(n_obs)
+    if not np.all(P):
+        # gradient off the support, c_i - G_i x_i with G_i = G - a_i a_i^T
+        # and c_i = c - a_i b_i
+        A_A = A[:, ~P]
+        grad = c[~P][:, np.newaxis] - G[np.ix_(~P, P)].dot(X_P) - \
+          A_A.T * (b - fit)[np.newaxis, :]
+        feasible &= np.all(grad <= tol, axis=0)
+    refits = np.where(~feasible)[0]
+    for i in refits:
+        a = A[i]
+        X_loo[:, i] = nnls_gram(G - np.outer(a, a), c - a * b[i],
+                                passive=P, tol=tol)[0]
+    return X_loo, len(refits)
+
+# State of the process pool workers of regional_loo_fits, set once per
+# worker at fork
+_loo_worker_state = {}
+
+def _init_loo_worker(A, B):
+    _loo_worker_state['A'] = A
+    _loo_worker_state['B'] = B
+    _loo_worker_state['G'] = A.T.dot(A)
+    _loo_worker_state['inverses'] = {}
+
+def _loo_worker(cols):
+    A = _loo_worker_state['A']
+    B = _loo_worker_state['B']
+    G = _loo_worker_state['G']
+    out = []
+    n_refits = 0
+    for j in cols:
+        b = B[:, j]
+        c = A.T.dot(b)
+        x, passive = nnls_gram(G, c)
+        X_loo, n = loo_nnls(A, b, G, c, x, passive,
+                            inverse_cache=_loo_worker_state['inverses'])
+        out.append((x, X_loo))
+        n_refits += n
+    return cols, out, n_refits
+
+def regional_loo_fits(X, Y, n_jobs=1, verbose=False):
+    '''
+    Leave-one-out fits of the nonnegative regional model Y = W X, one
+    target region (row of Y) at a time, each fit by loo_nnls, the target
+    regions split among n_jobs processes (-1 for one per cpu).
+
+    Parameters
+    ----------
+    X : (n_source_regions x n_inj) array
+    Y : (n_target_regions x n_inj) array
+    n_jobs : int, default=1
+    verbose : bool, default=False
+
+    Returns
+    -------
+    W : (n_target_regions x n_source_regions) array, fit to all injections
+    W_loo : (n_inj x n_target_regions x n_source_regions) array, W_loo[i]
+      fit without injection i
+    '''
+    import multiprocessing
+    from .utilities import n_processes
+    A = np.asarray(X, dtype=np.float64).T
+    B = np.asarray(Y, dtype=np.float64).T
+    n_inj, n_x = A.shape
+    n_y = B.shape[1]
+    W = np.zeros((n_y, n_x))
+    W_loo = np.zeros((n_inj, n_y, n_x))
+    n_jobs = n_processes(n_jobs)
+    chunks = [ list(c) for c in np.array_split(np.arange(n_y),
+                                               max(1, min(n_y, 4 * n_jobs)))
+               if len(c) > 0 ]
+    if n_jobs == 1:
+        _init_loo_worker(A, B)
+        results = [ _loo_worker(cols) for cols in chunks ]
+    else:
+        pool = multiprocessing.Pool(n_jobs, initializer=_init_loo_worker,
+                                    initargs=(A, B))
+        try:
+            results = pool.map(_loo_worker, chunks)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    n_refits = 0
+    for cols, out, n in results:
+        n_refits += n
+        for j, (x, X_loo) in zip(cols, out):
+            W[j] = x
+            W_loo[:, j, :] = X_loo.T
+    if verbose:
+        print "Leave-one-out fits: %d of %d needed the active set method" % \
+          (n_refits, n_inj * n_y)
+    return W, W_loo
+
+class MaskedRegionalOperator(object):
+    '''
+    Linear map of the regional model with voxel targets,
+
+      W -> P_Omega(P_Y_dag W P_X X),
+
+    (W is n_target_regions x n_source_regions), and its adjoint
+    R -> P_Y_dag^T P_Omega(R) (P_X X)^T, applied as products with the
+    factors, never forming the (n_target_vox n_inj) x (R_y R_x) Kronecker
+    matrix of the map.
+
+    Parameters
+    ----------
+    X : (n_source_vox x n_inj) array
+    P_Y_dag : (n_target_vox x n_target_regions) array or sparse matrix
+    P_X : (n_source_regions x n_source_vox) array or sparse matrix
+    Omega : (n_target_vox x n_inj) sparse matrix or lossfun.OmegaMask,
+      default=None
+      nonzeros mark entries left out
+    '''
+    def __init__(self, X, P_Y_dag, P_X, Omega=None):
+        from .lossfun import as_omega_mask
+        self.X_reg = np.asarray(P_X.dot(X), dtype=np.float64)
+        self.P_Y_dag = P_Y_dag
+        self.shape = (P_Y_dag.shape[0], self.X_reg.shape[1])
+        self.omega = as_omega_mask(Omega, self.shape)
+        self.W_shape = (P_Y_dag.shape[1], self.X_reg.shape[0])
+
+    def mask(self, A):
+        if self.omega is not None:
+            self.omega.apply(A, 0, A.shape[1])
+        return A
+
+    def matvec(self, W):
+        return self.mask(np.asarray(self.P_Y_dag.dot(W.dot(self.X_reg))))
+
+    def rmatvec(self, R):
+        return np.asarray(self.P_Y_dag.T.dot(self.mask(R))).dot(
+            self.X_reg.T)
+
+    def sq_norm(self, n_iter=20, seed=0):
+        '''
+        Upper bound of the squared operator norm, from those of the factors
+        (the mask only lowers it).
+        '''
+        from .solver import sq_operator_norm
+        P = self.P_Y_dag
+        p_norm = sq_operator_norm(lambda v: P.T.dot(P.dot(v)), P.shape[1],
+                                  n_iter, seed)
+        X_reg = self.X_reg
+        x_norm = sq_operator_norm(lambda v: X_reg.dot(X_reg.T.dot(v)),
+                                  X_reg.shape[0], n_iter, seed)
+        return p_norm * x_norm
+
+def fit_masked_regional(X, Y, P_Y_dag, P_X, Omega=None, W0=None,
+                        max_iter=5000, tol=1e-8, verbose=False):
+    '''
+    Nonnegative regional model fit to voxel targets outside Omega,
+
+      min_{W >= 0} ||P_Omega(P_Y_dag W P_X X - Y)||^2,
+
+    by accelerated projected gradient (FISTA) with momentum restarts, using
+    MaskedRegionalOperator for all products.
+
+    Parameters
+    ----------
+    X : (n_source_vox x n_inj) array
+    Y : (n_target_vox x n_inj) array or sparse matrix
+    P_Y_dag, P_X, Omega : see MaskedRegionalOperator
+    W0 : (n_target_regions x n_source_regions) array, default=None
+      warm start (default: zeros)
+    max_iter : int, default=5000
+    tol : float, default=1e-8
+      stop when the relative change of W in an iteration is below tol
+    verbose : bool, default=False
+
+    Returns
+    -------
+    result : solver.SolverResult(W, objective, n_iter, converged)
+    '''
+    from .solver import SolverResult
+    from .utilities import dense_array
+    op = MaskedRegionalOperator(X, P_Y_dag, P_X, Omega)
+    Y = op.mask(dense_array(Y).astype(np.float64))
+    if W0 is None:
+        W = np.zeros(op.W_shape)
+    else:
+        W = np.maximum(np.array(W0, dtype=np.float64), 0.0)
+    step = 1.0 / max(2.0 * op.sq_norm(), 1e-300)
+    def objective_and_residual(W):
+        R = op.matvec(W) - Y
+        return np.vdot(R, R), R
+    f_W, R_W = objective_and_residual(W)
+    Z, R_Z = W, R_W
+    t = 1.0
+    converged = False
+    n_iter = 0
+    for n_iter in range(1, max_iter + 1):
+        G = 2.0 * op.rmatvec(R_Z)
+        W_new = np.maximum(Z - step * G, 0.0)
+        f_new, R_new = objective_and_residual(W_new)
+        if f_new > f_W and Z is not W:
+            # momentum overshot: restart from the last iterate
+            Z, R_Z = W, R_W
+            t = 1.0
+            continue
+        t_new = 0.5 * (1.0 + np.sqrt(1.0 + 4.0 * t * t))
+        beta = (t - 1.0) / t_new
+        diff = W_new - W
+        Z = W_new + beta * diff
+        # the residual is affine in W, extrapolate it too
+        R_Z = (1.0 + beta) * R_new - beta * R_W
+        change = np.linalg.norm(diff) / max(np.linalg.norm(W_new), 1e-300)
+        W, f_W, R_W, t = W_new, f_new, R_new, t_new
+        if verbose and n_iter % 100 == 0:
+            print "  iteration %d: objective %e, change %e" % \
+              (n_iter, f_W, change)
+        if change < tol:
+            converged = True
+            break
+    return SolverResult(W, f_W, n_iter, converged)
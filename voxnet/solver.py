@@ -0,0 +1,268 @@
+import os
+import numpy as np
+import scipy.sparse as sp
+from collections import namedtuple
+from .utilities import h5read, h5write, sparse_read, dense_array
+
+SolverResult = namedtuple('SolverResult',
+                          ['W', 'objective', 'n_iter', 'converged'])
+
+def sq_operator_norm(matvec, n, n_iter=20, seed=0):
+    '''
+    Largest eigenvalue of a symmetric positive semidefinite operator given
+    by its product with vectors of length n (e.g. the squared spectral norm
+    of A, with matvec(v) = A^T A v), by power iterations.
+    '''
+    rng = np.random.RandomState(seed)
+    v = rng.randn(n)
+    s = 0.0
+    for i in range(n_iter):
+        u = matvec(v)
+        s = np.linalg.norm(u)
+        if s == 0:
+            return 0.0
+        v = u / s
+    return s
+
+class SmoothObjective(object):
+    '''
+    Smoothness-regularized, masked least squares objective of the voxel
+    model,
+
+      f(W) = ||P_Omega(W X - Y)||^2 + lam (||Ly W||^2 + ||W Lx^T||^2),
+
+    where P_Omega zeros the entries marked in Omega (the injection sites).
+    Only dense matrix products with X and sparse products with the
+    Laplacians are used.
+
+    Parameters
+    ----------
+    X : (n_source x n_inj) array
+    Y : (n_target x n_inj) array or sparse matrix
+    Lx : (n_source x n_source) sparse matrix
+    Ly : (n_target x n_target) sparse matrix
+    lam : float
+      regularization parameter
+    Omega : (n_target x n_inj) sparse matrix, default=None
+      nonzeros mark entries left out of the loss
+    '''
+    def __init__(self, X, Y, Lx, Ly, lam, Omega=None):
+        self.X = np.asarray(X, dtype=np.float64)
+        self.Y = dense_array(Y).astype(np.float64)
+        self.Lx = sp.csr_matrix(Lx)
+        self.Ly = sp.csr_matrix(Ly)
+        self.LxT = self.Lx.T.tocsr()
+        self.LyT = self.Ly.T.tocsr()
+        self.lam = float(lam)
+        assert self.X.shape[1] == self.Y.shape[1], \
+          "X and Y have different numbers of injections"
+        if Omega is not None:
+            assert Omega.shape == self.Y.shape, \
+              "Omega shape incompatible with Y"
+            Omega = sp.coo_matrix(Omega)
+            self.omega_idx = (Omega.row, Omega.col)
+        else:
+            self.omega_idx = None
+        self.shape = (self.Y.shape[0], self.X.shape[0])
+
+    def residual(self, W):
+        R = W.dot(self.X) - self.Y
+        if self.omega_idx is not None:
+            R[self.omega_idx] = 0.0
+        return R
+
+    def value_and_parts(self, W):
+        '''
+        Objective at W, with the products reused by gradient. The parts
+        (masked residual, Ly W, Lx W^T) are affine in W, so those of a
+        combination of iterates are the same combination of their parts.
+        '''
+        R = self.residual(W)
+        LyW = self.Ly.dot(W)
+        LxWT = self.Lx.dot(W.T)
+        parts = (R, LyW, LxWT)
+        return self.value_from_parts(parts), parts
+
+    def value_from_parts(self, parts):
+        R, LyW, LxWT = parts
+        return np.vdot(R, R) + self.lam * (np.vdot(LyW, LyW) +
+                                           np.vdot(LxWT, LxWT))
+
+    def value(self, W):
+        return self.value_and_parts(W)[0]
+
+    def gradient(self, W, parts=None):
+        if parts is None:
+            parts = self.value_and_parts(W)[1]
+        R, LyW, LxWT = parts
+        return 2.0 * (R.dot(self.X.T) +
+                      self.lam * (self.LyT.dot(LyW) +
+                                  self.LxT.dot(LxWT).T))
+
+    def lipschitz_estimate(self, n_iter=20, seed=0):
+        '''
+        Estimate of the Lipschitz constant of the gradient,
+        2 (||X||^2 + lam (||Ly||^2 + ||Lx||^2)), by power iterations. The
+        mask only lowers it.
+        '''
+        X = self.X
+        x_norm = sq_operator_norm(lambda v: X.dot(X.T.dot(v)), X.shape[0],
+                                  n_iter, seed)
+        ly_norm = sq_operator_norm(lambda v: self.LyT.dot(self.Ly.dot(v)),
+                                   self.Ly.shape[1], n_iter, seed)
+        lx_norm = sq_operator_norm(lambda v: self.LxT.dot(self.Lx.dot(v)),
+                                   self.Lx.shape[1], n_iter, seed)
+        return 2.0 * (x_norm + self.lam * (ly_norm + lx_norm))
+
+def _write_checkpoint(fn, W):
+    # write then rename, so a reader never sees a partial checkpoint
+    tmp_fn = fn + '.tmp%d.h5' % os.getpid()
+    h5write(tmp_fn, W)
+    os.rename(tmp_fn, fn)
+
+def fit_smooth_nnls(X, Y, Lx, Ly, lam, Omega=None, W0=None, max_iter=5000,
+                    tol=1e-6, L0=None, backtrack=2.0, restart=True,
+                    checkpoint_fn=None, checkpoint_every=100, verbose=False):
+    '''
+    Nonnegative, smoothness-regularized voxel model fit,
+
+      min_{W >= 0} ||P_Omega(W X - Y)||^2 + lam (||Ly W||^2 + ||W Lx^T||^2),
+
+    by accelerated projected gradient (FISTA) with backtracking on the step
+    size and, optionally, restarts of the momentum when the objective goes
+    up.
+
+    Parameters
+    ----------
+    X, Y, Lx, Ly, lam, Omega : see SmoothObjective
+    W0 : (n_target x n_source) array, default=None
+      warm start (default: zeros)
+    max_iter : int, default=5000
+    tol : float, default=1e-6
+      stop when the relative change of W in an iteration is below tol
+    L0 : float, default=None
+      initial Lipschitz constant (default: SmoothObjective estimate)
+    backtrack : float, default=2.0
+      factor increasing the Lipschitz constant when a step is too long
+    restart : bool, default=True
+      reset the momentum whenever the objective increases
+    checkpoint_fn : str, default=None
+      file to which W is written (h5write) every checkpoint_every
+      iterations; pass it back as W0 with h5read to resume
+    checkpoint_every : int, default=100
+    verbose : bool, default=False
+      print the objective at every checkpoint interval
+
+    Returns
+    -------
+    result : SolverResult(W, objective, n_iter, converged)
+    '''
+    obj = SmoothObjective(X, Y, Lx, Ly, lam, Omega)
+    if W0 is None:
+        W = np.zeros(obj.shape)
+    else:
+        W = np.maximum(np.array(W0, dtype=np.float64), 0.0)
+        assert W.shape == obj.shape, "W0 has shape %s, expected %s" % \
+          (str(W.shape), str(obj.shape))
+    L = obj.lipschitz_estimate() if L0 is None else float(L0)
+    if L <= 0:
+        L = 1.0
+    f_W, parts_W = obj.value_and_parts(W)
+    Z, f_Z, parts_Z = W, f_W, parts_W
+    t = 1.0
+    converged = False
+    n_iter = 0
+    for n_iter in range(1, max_iter + 1):
+        G = obj.gradient(Z, parts_Z)
+        # backtracking on the quadratic upper bound at Z, up to rounding
+        # (f_Z comes from extrapolated parts)
+        slack = 1e-12 * abs(f_Z)
+        while True:
+            W_new = np.maximum(Z - G / L, 0.0)
+            D = W_new - Z
+            f_new, parts_new = obj.value_and_parts(W_new)
+            if f_new <= f_Z + np.vdot(G, D) + 0.5 * L * np.vdot(D, D) + slack:
+                break
+            L *= backtrack
+        if restart and f_new > f_W and Z is not W:
+            # momentum overshot: restart from the last iterate (a plain
+            # step from W can only go up by rounding, and is kept)
+            Z, f_Z, parts_Z = W, f_W, parts_W
+            t = 1.0
+            continue
+        t_new = 0.5 * (1.0 + np.sqrt(1.0 + 4.0 * t * t))
+        beta = (t - 1.0) / t_new
+        step = W_new - W
+        Z = W_new + beta * step
+        # extrapolate the parts too, instead of recomputing them at Z
+        parts_Z = tuple([ (1.0 + beta) * a - beta * b
+                          for a, b in zip(parts_new, parts_W) ])
+        f_Z = obj.value_from_parts(parts_Z)
+        change = np.linalg.norm(step) / max(np.linalg.norm(W_new), 1.0)
+        W, f_W, parts_W, t = W_new, f_new, parts_new, t_new
+        if checkpoint_fn is not None and n_iter % checkpoint_every == 0:
+            _write_checkpoint(checkpoint_fn, W)
+        if verbose and n_iter % checkpoint_every == 0:
+            print "  iteration %d: objective %e, change %e" % \
+              (n_iter, f_W, change)
+        if change < tol:
+            converged = True
+            break
+    if checkpoint_fn is not None:
+        _write_checkpoint(checkpoint_fn, W)
+    return SolverResult(W, f_W, n_iter, converged)
+
+def load_solver_inputs(X_fn, Y_fn, Lx_fn, Ly_fn, Omega_fn=None):
+    '''
+    Read the solver inputs as written by create_voxel_matrices.py (or a
+    materialized fold): X and Y from HDF5, the Laplacians and Omega in any
+    format of utilities.sparse_read.
+    '''
+    X = h5read(X_fn, dense=True)
+    Y = h5read(Y_fn)
+    Lx = sparse_read(Lx_fn)
+    Ly = sparse_read(Ly_fn)
+    Omega = sparse_read(Omega_fn) if Omega_fn is not None else None
+    return X, Y, Lx, Ly, Omega
+
+def main(argv):
+    '''
+    Command line with the arguments of the external solver:
+
+      [--W0_init | W0_fn] [Omega_fn] X_fn Y_fn Lx_fn Ly_fn lambda output_fn
+
+    --W0_init starts from zeros. W is checkpointed to output_fn.CHECKPT,
+    and a run restarts from an existing checkpoint.
+    '''
+    if len(argv) not in (7, 8):
+        print "usage: python -m voxnet.solver [--W0_init | W0_fn] " \
+          "[Omega_fn] X_fn Y_fn Lx_fn Ly_fn lambda output_fn"
+        return 1
+    W0_arg = argv[0]
+    if len(argv) == 8:
+        Omega_fn = argv[1]
+        args = argv[2:]
+    else:
+        Omega_fn = None
+        args = argv[1:]
+    X_fn, Y_fn, Lx_fn, Ly_fn, lam, output_fn = args
+    X, Y, Lx, Ly, Omega = load_solver_inputs(X_fn, Y_fn, Lx_fn, Ly_fn,
+                                             Omega_fn)
+    checkpoint_fn = output_fn + '.CHECKPT'
+    if os.path.exists(checkpoint_fn):
+        W0 = h5read(checkpoint_fn)
+    elif W0_arg != '--W0_init':
+        W0 = h5read(W0_arg)
+    else:
+        W0 = None
+    result = fit_smooth_nnls(X, Y, Lx, Ly, float(lam), Omega=Omega, W0=W0,
+                             checkpoint_fn=checkpoint_fn, verbose=True)
+    h5write(output_fn, result.W)
+    os.remove(checkpoint_fn)
+    print "Objective %e after %d iterations (converged: %s)" % \
+      (result.objective, result.n_iter, str(result.converged))
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main(sys.argv[1:]))
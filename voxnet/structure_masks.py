@@ -0,0 +1,101 @@
+import os
+import numpy as np
+from .mask import FlatMask
+
+def ontology_digest(mcc):
+    '''
+    Short digest of the ontology served by mcc (structure ids and their
+    paths in the structure tree), used to key persisted structure masks.
+    '''
+    import hashlib
+    df = mcc.get_ontology().df
+    key = df[['id', 'structure_id_path']].to_csv(index=False)
+    return hashlib.md5(key.encode('utf-8')).hexdigest()[:12]
+
+class StructureMaskRegistry(object):
+    '''
+    Computes the full, ipsilateral and contralateral FlatMasks of each
+    structure once, from a single read of its structure mask, and serves
+    them for the rest of the run. If cache_dir is given, the masks are also
+    persisted there, keyed by resolution and ontology version, and reused
+    by later runs.
+
+    Parameters
+    ----------
+    mcc : MouseConnectivityCache
+      container object for connectivity data
+    cache_dir : str (default = None)
+      directory in which to persist the masks, None to keep them in memory
+      only
+    ontology_version : str (default = None)
+      version key of the ontology; by default a digest of the ontology
+      served by mcc, see ontology_digest
+    '''
+    def __init__(self, mcc, cache_dir=None, ontology_version=None):
+        self.mcc = mcc
+        self._masks = {}
+        self.cache_dir = None
+        if cache_dir is not None:
+            if ontology_version is None:
+                ontology_version = ontology_digest(mcc)
+            self.cache_dir = os.path.join(
+                cache_dir, 'structure_masks_%s_%s' %
+                (str(mcc.resolution), ontology_version))
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                pass
+
+    def _cache_fn(self, structure_id):
+        return os.path.join(self.cache_dir, '%d.npz' % structure_id)
+
+    def _load(self, structure_id):
+        if self.cache_dir is not None:
+            try:
+                with np.load(self._cache_fn(structure_id)) as f:
+                    shape = tuple(f['shape'])
+                    return dict((side, FlatMask(f[side], shape,
+                                                assume_sorted=True))
+                                for side in ('full', 'ipsi', 'contra'))
+            except Exception:
+                # missing, partial or corrupt cache file: rebuild the masks
+                pass
+        mask = self.mcc.get_structure_mask(structure_id)
+        full = FlatMask.from_volume(mask[0])
+        midline_coord = mask[1]['sizes'][2]//2
+        # the last axis varies fastest in C order
+        z = full.idx % full.shape[2]
+        masks = {'full': full,
+                 'ipsi': FlatMask(full.idx[z >= midline_coord], full.shape,
+                                  assume_sorted=True),
+                 'contra': FlatMask(full.idx[z < midline_coord], full.shape,
+                                    assume_sorted=True)}
+        if self.cache_dir is not None:
+            # write then rename, so a reader never sees a partial file
+            fn = self._cache_fn(structure_id)
+            tmp_fn = fn + '.tmp%d.npz' % os.getpid()
+            np.savez(tmp_fn, shape=np.array(full.shape),
+                     **dict((side, m.idx) for side, m in masks.items()))
+            os.rename(tmp_fn, fn)
+        return masks
+
+    def get(self, structure_id, ipsi=False, contra=False):
+        '''
+        Returns the FlatMask of a structure. As in get_structure_mask_nz,
+        if both ipsi == contra == True or False, return both hemispheres.
+        '''
+        if structure_id not in self._masks:
+            self._masks[structure_id] = self._load(structure_id)
+        if ipsi == contra:
+            return self._masks[structure_id]['full']
+        elif ipsi:
+            return self._masks[structure_id]['ipsi']
+        else:
+            return self._masks[structure_id]['contra']
+
+    def nz(self, structure_id, ipsi=False, contra=False):
+        ''' As get, but returns a tuple of (x,y,z) coordinates. '''
+        return self.get(structure_id, ipsi=ipsi, contra=contra).nz()
+
+    def __len__(self):
+        return len(self._masks)
@@ -0,0 +1,78 @@
+import numpy as np
+
+class SyntheticConnectivityCache(object):
+    '''
+    Small synthetic stand-in for MouseConnectivityCache, for checking the
+    matrix builders without the Allen data. Structures are boxes placed
+    symmetrically about the midline; each experiment has a spherical
+    injection in the right hemisphere, a projection density decaying away
+    from it and a sprinkling of LIMS error codes.
+
+    Parameters
+    ----------
+    shape : tuple (default = (18, 14, 24))
+      volume shape
+    n_structures : int (default = 4)
+    n_experiments : int (default = 8)
+    seed : int (default = 0)
+      seed of the random number generator
+    '''
+    def __init__(self, shape=(18, 14, 24), n_structures=4, n_experiments=8,
+                 seed=0):
+        rng = np.random.RandomState(seed)
+        self.resolution = 100
+        self.shape = tuple(shape)
+        self._header = {'sizes': list(shape)}
+        x, y, z = np.indices(shape)
+        midline = shape[2]//2
+        dist_midline = np.abs(z - midline + 0.5)
+        self.structure_ids = [ 101 + i for i in range(n_structures) ]
+        self._structures = {}
+        for i, sid in enumerate(self.structure_ids):
+            self._structures[sid] = \
+              ((x >= 2 + 3*i) & (x < 5 + 3*i) & (y >= 2) & (y < 11) &
+               (dist_midline > 1) & (dist_midline < 9)).astype(np.uint8)
+        self._experiments = {}
+        for e in range(n_experiments):
+            center = (rng.randint(3, 3 + 3*n_structures), rng.randint(3, 10),
+                      rng.randint(midline + 2, shape[2] - 2))
+            r2 = (x - center[0])**2 + (y - center[1])**2 + (z - center[2])**2
+            inj_frac = np.clip(1.0 - r2/5.0, 0, 1)
+            proj_density = np.exp(-r2/40.0) * rng.rand(*shape)
+            for code, rate in zip((-1, -2, -3), (0.03, 0.01, 0.005)):
+                proj_density[rng.rand(*shape) < rate] = code
+            self._experiments[1000 + e] = {
+                'injection_fraction': inj_frac,
+                'injection_density': inj_frac * rng.rand(*shape),
+                'projection_density': proj_density,
+                'data_mask': (rng.rand(*shape) > 0.02).astype(np.uint8)}
+
+    def structures(self, ids=None):
+        ''' DataFrame of structures, with an 'id' column like an ontology. '''
+        import pandas as pd
+        if ids is None:
+            ids = self.structure_ids
+        return pd.DataFrame({'id': list(ids)})
+
+    def get_experiments(self, dataframe=True, cre=False,
+                        injection_structure_ids=None):
+        import pandas as pd
+        return pd.DataFrame({'id': sorted(self._experiments.keys())})
+
+    def get_structure_mask(self, structure_id):
+        return (self._structures[structure_id].copy(), dict(self._header))
+
+    def _volume(self, kind, expt_id):
+        return (self._experiments[expt_id][kind].copy(), dict(self._header))
+
+    def get_injection_fraction(self, expt_id):
+        return self._volume('injection_fraction', expt_id)
+
+    def get_injection_density(self, expt_id):
+        return self._volume('injection_density', expt_id)
+
+    def get_projection_density(self, expt_id):
+        return self._volume('projection_density', expt_id)
+
+    def get_data_mask(self, expt_id):
+        return self._volume('data_mask', expt_id)
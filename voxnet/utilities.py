@@ -1,5 +1,26 @@
 # Kameron Decker Harris
 # modified from code by Nicholas Cain
+from collections import namedtuple
+
+# LIMS error codes found in the data volumes
+LIMS_ERROR_CODES = (-1, -2, -3)
+
+class DataErrorCounts(namedtuple('DataErrorCounts',
+                                 ['invalid', 'missing_tile', 'no_data'])):
+    '''
+    Number of voxels carrying each of the LIMS error codes: -1 (invalid),
+    -2 (missing tile) and -3 (no data). Counts add elementwise, so they can
+    be accumulated over regions of an experiment.
+    '''
+    __slots__ = ()
+
+    def __add__(self, other):
+        return DataErrorCounts(*[a + b for a, b in zip(self, other)])
+
+    def total(self):
+        return sum(self)
+
+NO_DATA_ERRORS = DataErrorCounts(0, 0, 0)
 
 def pickle(data, file_name):
     import pickle as pkl    
@@ -24,27 +45,258 @@ def write_dictionary_to_group(group, dictionary, create_name = None):
 def read_dictionary_from_group(group):
     dictionary = {}
     for name in group:
-        dictionary[str(name)] = group[name].value
+        dictionary[str(name)] = group[name][()]
     return dictionary
 
 def h5write(fn,mat):
+    '''
+    Write a matrix to an HDF5 file. Dense arrays go in the dataset
+    'dataset'; sparse matrices are stored in CSR or CSC layout, as datasets
+    'data', 'indices' and 'indptr' with 'format' and 'shape' attributes.
+    '''
     import h5py
+    import scipy.sparse as sp
     with h5py.File(fn, 'w') as f:
-        f.create_dataset('dataset', data=mat)
+        if sp.issparse(mat):
+            if mat.format not in ('csr', 'csc'):
+                mat = mat.tocsr()
+            f.create_dataset('data', data=mat.data)
+            f.create_dataset('indices', data=mat.indices)
+            f.create_dataset('indptr', data=mat.indptr)
+            f.attrs['format'] = mat.format
+            f.attrs['shape'] = mat.shape
+        else:
+            f.create_dataset('dataset', data=mat)
         f.close()
 
-def h5read(fn):
+def h5read(fn, dense=False):
+    '''
+    Read a matrix written by h5write. Sparse layouts are returned as
+    scipy.sparse matrices unless dense is True.
+    '''
     import h5py
+    import scipy.sparse as sp
     with h5py.File(fn, 'r') as f:
-        data=f['dataset'][()]
+        if 'dataset' in f:
+            data=f['dataset'][()]
+        else:
+            fmt = f.attrs['format']
+            if not isinstance(fmt, str):
+                fmt = fmt.decode()
+            matrix_class = sp.csc_matrix if fmt == 'csc' else sp.csr_matrix
+            data = matrix_class((f['data'][()], f['indices'][()],
+                                 f['indptr'][()]),
+                                shape=tuple(f.attrs['shape']))
+            if dense:
+                data = data.toarray()
         f.close()
         return data
 
+def h5read_columns(fn, cols, dense=False):
+    '''
+    Read some columns of a matrix written by h5write, without reading the
+    rest of it: dense matrices through an h5py selection, CSC matrices
+    column by column through their indptr. CSR matrices are read whole.
+
+    Parameters
+    ----------
+    fn : str
+      HDF5 file
+    cols : array of int
+      column indices, in the order wanted
+    dense : bool, default=False
+      return sparse layouts as dense arrays
+
+    Returns
+    -------
+    mat : the columns cols of the matrix
+    '''
+    import h5py
+    import numpy as np
+    import scipy.sparse as sp
+    cols = np.asarray(cols, dtype=int)
+    with h5py.File(fn, 'r') as f:
+        if 'dataset' in f:
+            # h5py selections need increasing indices
+            sorted_cols, inverse = np.unique(cols, return_inverse=True)
+            data = f['dataset'][:, list(sorted_cols)][:, inverse]
+        else:
+            fmt = f.attrs['format']
+            if not isinstance(fmt, str):
+                fmt = fmt.decode()
+            shape = tuple(f.attrs['shape'])
+            if fmt == 'csc':
+                indptr = f['indptr'][()]
+                values = []
+                indices = []
+                for c in cols:
+                    values.append(f['data'][indptr[c]:indptr[c+1]])
+                    indices.append(f['indices'][indptr[c]:indptr[c+1]])
+                new_indptr = np.concatenate(([0], np.cumsum(
+                    [ len(v) for v in values ])))
+                data = sp.csc_matrix((np.concatenate(values + [[]]),
+                                      np.concatenate(indices + [[]])
+                                        .astype(indptr.dtype),
+                                      new_indptr),
+                                     shape=(shape[0], len(cols)))
+            else:
+                data = sp.csr_matrix((f['data'][()], f['indices'][()],
+                                      f['indptr'][()]), shape=shape)
+                data = data.tocsc()[:, cols]
+            if dense:
+                data = data.toarray()
+        f.close()
+        return data
+
+# Sparse matrix file formats, by extension, in order of preference when
+# several exist: HDF5 CSC (h5write layout), scipy .npz and Matrix Market
+SPARSE_EXTS = ('.h5', '.npz', '.mtx')
+
+def sparse_write(fn, mat):
+    '''
+    Write a sparse matrix in the format given by the extension of fn. The
+    binary formats ('.h5', '.npz') are stored CSC; '.mtx' is the Matrix
+    Market text format, kept for the external solver.
+    '''
+    import os
+    import scipy.sparse as sp
+    from scipy.io import mmwrite
+    ext = os.path.splitext(fn)[1]
+    if ext == '.h5':
+        h5write(fn, sp.csc_matrix(mat))
+    elif ext == '.npz':
+        sp.save_npz(fn, sp.csc_matrix(mat))
+    elif ext == '.mtx':
+        mmwrite(fn, mat)
+    else:
+        raise ValueError("unknown sparse matrix extension '%s'" % ext)
+
+def sparse_read(fn):
+    '''
+    Read a sparse matrix written by sparse_write, as a CSC matrix.
+    '''
+    import os
+    import scipy.sparse as sp
+    from scipy.io import mmread
+    ext = os.path.splitext(fn)[1]
+    if ext == '.h5':
+        mat = h5read(fn)
+    elif ext == '.npz':
+        mat = sp.load_npz(fn)
+    elif ext == '.mtx':
+        mat = mmread(fn)
+    else:
+        raise ValueError("unknown sparse matrix extension '%s'" % ext)
+    return sp.csc_matrix(mat)
+
+def find_sparse_file(stem):
+    '''
+    The existing file stem + ext, taking the extensions in the order of
+    SPARSE_EXTS, or None.
+    '''
+    import os
+    for ext in SPARSE_EXTS:
+        if os.path.exists(stem + ext):
+            return stem + ext
+    return None
+
+def convert_sparse_files(run_dir, ext='.h5', remove=False):
+    '''
+    Convert the Matrix Market files under run_dir (recursively) to a binary
+    format, next to the originals.
+
+    Parameters
+    ----------
+    run_dir : str
+    ext : '.h5' or '.npz', default='.h5'
+    remove : bool, default=False
+      delete the .mtx files once converted; keep them if the external
+      solver is still to be run on them
+
+    Returns
+    -------
+    converted : list of the files written
+    '''
+    import os
+    converted = []
+    for dirpath, dirnames, filenames in os.walk(run_dir):
+        for name in sorted(filenames):
+            if not name.endswith('.mtx'):
+                continue
+            mtx_fn = os.path.join(dirpath, name)
+            fn = mtx_fn[:-len('.mtx')] + ext
+            if not os.path.exists(fn):
+                sparse_write(fn, sparse_read(mtx_fn))
+                converted.append(fn)
+            if remove:
+                os.remove(mtx_fn)
+    return converted
+
+def dense_array(mat):
+    '''
+    Dense ndarray of a dense or scipy.sparse matrix.
+    '''
+    import numpy as np
+    import scipy.sparse as sp
+    if sp.issparse(mat):
+        return mat.toarray()
+    return np.asarray(mat)
+
+def n_processes(n_jobs):
+    '''
+    Number of worker processes for an n_jobs argument: one per cpu if
+    negative, and 1 (no pool) for 0 or 1.
+    '''
+    import multiprocessing
+    if n_jobs < 0:
+        return multiprocessing.cpu_count()
+    return max(1, int(n_jobs))
+
 def absjoin(path,*paths):
     import os
     return os.path.abspath(os.path.join(path,*paths))
 
-def integrate_in_mask(data, query_mask):
+def clean_error_codes(values):
+    '''
+    Zero the LIMS error codes in an array of values.
+
+    Parameters
+    ----------
+    values : array of values
+
+    Returns
+    -------
+    cleaned : copy of values with error codes set to 0
+    counts : DataErrorCounts of the codes that were found
+    '''
+    import numpy as np
+    cleaned = np.array(values)
+    # error codes are the only negative values, so only look at those
+    neg = np.flatnonzero(cleaned < 0)
+    if len(neg) == 0:
+        return cleaned, NO_DATA_ERRORS
+    neg_values = cleaned.flat[neg]
+    counts = []
+    for code in LIMS_ERROR_CODES:
+        is_code = (neg_values == code)
+        counts.append(int(np.count_nonzero(is_code)))
+        cleaned.flat[neg[is_code]] = 0.0
+    return cleaned, DataErrorCounts(*counts)
+
+def mask_values(data, mask):
+    '''
+    Gather the values of a 3-array at the voxels of a mask, either a
+    FlatMask (flat index gather) or an (xs, ys, zs) tuple.
+    '''
+    import numpy as np
+    from .mask import FlatMask
+    if isinstance(mask, FlatMask):
+        return mask.values(data)
+    if mask_len(mask) == 0:
+        return np.zeros((0,), dtype=data.dtype)
+    return data[mask]
+
+def integrate_in_mask(data, query_mask, return_counts=False):
     '''
     Integrate a data within a certain query mask.
     Deals with error codes appropriately.
@@ -52,34 +304,25 @@ def integrate_in_mask(data, query_mask):
     Parameters
     ----------
     data : 3-array of values
-    query_mask : mask over which to integrate (xs, ys, zs)
+    query_mask : mask over which to integrate, (xs, ys, zs) or FlatMask
+    return_counts : bool (default = False)
+      Also return the DataErrorCounts of the voxels in query_mask
 
     Returns
     -------
     sum : integral of data within query_mask
     '''
-    def safe_sum(values):
-        sum = 0.0
-        for val in values:
-            if val == -1:
-                val=0.0
-            elif val == -2:
-                warn("data error -2, missing tile in LIMS experiment %d" \
-                     % curr_LIMS_id)
-                val = 0.0
-            elif val == -3:
-                warn("data error -3, no data in LIMS experiment %d" \
-                     % curr_LIMS_id)
-                val = 0.0
-            sum += val
-        return sum
     if mask_len(query_mask) > 0:
-        curr_sum = safe_sum(data[query_mask])
+        values, counts = clean_error_codes(mask_values(data, query_mask))
+        curr_sum = float(values.sum())
     else:
-        curr_sum = 0.0
+        curr_sum, counts = 0.0, NO_DATA_ERRORS
+    if return_counts:
+        return curr_sum, counts
     return curr_sum
 
-def data_in_mask_and_region(data, query_mask, region_mask):
+def data_in_mask_and_region(data, query_mask, region_mask,
+                            return_counts=False):
     '''
     Returns the data within a given mask and region.
     Maps the voxel data from a 3d array into a vector.
@@ -88,39 +331,32 @@ def data_in_mask_and_region(data, query_mask, region_mask):
     Parameters
     ----------
     data : 3-array of values
-    query_mask : mask over which to integrate (xs, ys, zs)
+    query_mask : mask of voxels to keep, (xs, ys, zs) or FlatMask
+    region_mask : mask giving the voxels (and their order) of the output
+    return_counts : bool (default = False)
+      Also return the DataErrorCounts of the kept voxels
 
+    Returns
+    -------
+    data_in_mask : vector, same number of voxels as region_mask, zero
+      outside of query_mask
     '''
     import numpy as np
+    from .mask import mask_isin
     nvox = mask_len(region_mask)
-    if mask_len(query_mask)>0:
-        data_in_mask = data[region_mask]
-        irrelevant_indices = np.ones((nvox,))
-        list_relevant = zip(*query_mask)
-        list_region = zip(*region_mask)
-        for ii,el in enumerate(list_region):
-            if el in list_relevant:
-                irrelevant_indices[ii] = 0
-        data_in_mask[irrelevant_indices==1] = 0.0
-        errmask = (data_in_mask == -1)
-        if np.count_nonzero(errmask) > 0:
-            data_in_mask[errmask] = 0.0
-        errmask = (data_in_mask == -2)
-        if np.count_nonzero(errmask) > 0: 
-            warn("data error -2, missing tile in LIMS experiment %d" \
-                  % curr_LIMS_id)
-            data_in_mask[errmask] = 0.0
-        errmask = (data_in_mask == -3)
-        if np.count_nonzero(errmask) > 0: 
-            warn("data error -3, no data in LIMS experiment %d" \
-                 % curr_LIMS_id)
-            data_in_mask[errmask] = 0.0
+    counts = NO_DATA_ERRORS
+    if mask_len(query_mask)>0 and nvox>0:
+        data_in_mask = mask_values(data, region_mask)
+        data_in_mask[~mask_isin(region_mask, query_mask)] = 0.0
+        data_in_mask, counts = clean_error_codes(data_in_mask)
     else:
         data_in_mask = np.zeros((nvox,))
+    if return_counts:
+        return data_in_mask, counts
     return data_in_mask
 
-
-def get_structure_mask_nz(mcc, structure_id, ipsi=False, contra=False):
+def get_structure_mask_nz(mcc, structure_id, ipsi=False, contra=False,
+                          flat=False):
     '''
     Returns the structure mask associated with a given structure id,
     in a sparse format.
@@ -136,14 +372,31 @@ def get_structure_mask_nz(mcc, structure_id, ipsi=False, contra=False):
     contra : bool (default = False)
       Whether to return contralateral structure coordinates
 
+    flat : bool (default = False)
+      Return a FlatMask rather than coordinate arrays
+
     If both ipsi == contra == True or False, then return both (default).
 
     Returns
     -------
-    mask_nz : tuple
+    mask_nz : tuple or FlatMask
       Tuple of (x,y,z) coordinates belonging to structure_id
     '''
     import numpy as np
+    from .mask import FlatMask
+    if flat:
+        mask = mcc.get_structure_mask(structure_id)
+        mask_flat = FlatMask.from_volume(mask[0])
+        if ipsi == contra:
+            return mask_flat
+        midline_coord = mask[1]['sizes'][2]//2
+        # the last axis varies fastest in C order
+        z = mask_flat.idx % mask_flat.shape[2]
+        if ipsi:
+            idx = mask_flat.idx[z >= midline_coord]
+        else:
+            idx = mask_flat.idx[z < midline_coord]
+        return FlatMask(idx, mask_flat.shape, assume_sorted=True)
     if (ipsi and contra) or (not ipsi and not contra):
         return np.where(mcc.get_structure_mask(structure_id)[0])
     elif ipsi and not contra:
@@ -160,7 +413,7 @@ def get_structure_mask_nz(mcc, structure_id, ipsi=False, contra=False):
         return (mask_nz[0][idx], mask_nz[1][idx], mask_nz[2][idx])
 
 def get_injection_mask_nz(mcc, expt_id, threshold=0.,
-                          valid=True, shell=None):
+                          valid=True, shell=None, flat=False):
     '''
     Custom method to get injection masks. Can ensure that the data are
     valid, as well as build a shell around injection site.
@@ -179,25 +432,34 @@ def get_injection_mask_nz(mcc, expt_id, threshold=0.,
     shell : int (default = None)
       Expand the mask by a shell of this many voxels
 
+    flat : bool (default = False)
+      Return a FlatMask rather than coordinate arrays
+
     Returns
     -------
-    mask_nz : tuple
+    mask_nz : tuple or FlatMask
       Tuple of (x,y,z) coordinates belonging to injection site
     '''
     import numpy as np
-    from mask import shell_mask
+    from .mask import shell_mask, FlatMask
     inj_frac = mcc.get_injection_fraction(expt_id)
     if valid:
         data_mask = mcc.get_data_mask(expt_id)
-        mask_nz = np.where(
-            np.logical_and(inj_frac[0] > threshold,
-                           data_mask[0])
-            )
+        in_mask = np.logical_and(inj_frac[0] > threshold, data_mask[0])
     else:
-        mask_nz = np.where(inj_frac[0] > threshold)
+        in_mask = inj_frac[0] > threshold
+    if flat:
+        mask_flat = FlatMask.from_volume(in_mask)
+        if shell is not None:
+            mask_flat = shell_mask(mask_flat, radius=shell)
+        return mask_flat
+    mask_nz = np.where(in_mask)
     if shell is not None:
         mask_nz = shell_mask(mask_nz, radius=shell)
     return mask_nz
 
 def mask_len(mask):
+    from .mask import FlatMask
+    if isinstance(mask, FlatMask):
+        return len(mask)
     return len(mask[0])
@@ -0,0 +1,91 @@
+import numpy as np
+from collections import OrderedDict
+
+class VolumeCache(object):
+    '''
+    Caches the experiment volumes read through a MouseConnectivityCache, so
+    that each volume is read and decoded once. When the resident size
+    exceeds max_bytes, the least recently used volumes are evicted.
+
+    Any other attribute is forwarded to the wrapped object, so a VolumeCache
+    can be passed wherever an mcc is expected. Cached volumes are copies of
+    the volumes read, returned read-only; copy them before modifying.
+
+    Parameters
+    ----------
+    mcc : MouseConnectivityCache
+      container object for connectivity data
+    max_bytes : int (default = 2**30)
+      memory budget for the cached volumes, None for no limit
+    '''
+    VOLUMES = ('injection_fraction', 'injection_density',
+               'projection_density', 'data_mask')
+
+    def __init__(self, mcc, max_bytes=2**30):
+        self.mcc = mcc
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._store = OrderedDict()
+
+    def __getattr__(self, name):
+        # only called for attributes not found on the cache itself
+        if name == 'mcc':
+            raise AttributeError(name)
+        return getattr(self.mcc, name)
+
+    def _entry(self, kind, expt_id):
+        key = (kind, expt_id)
+        if key in self._store:
+            self.hits += 1
+            entry = self._store.pop(key)
+            self._store[key] = entry
+            return entry
+        self.misses += 1
+        data, header = getattr(self.mcc, 'get_' + kind)(expt_id)
+        # a copy: the volume read may belong to (and be cached by) mcc,
+        # which should not see it become read-only
+        values = np.array(data)
+        values.flags.writeable = False
+        entry = (values, header)
+        if self.max_bytes is None or values.nbytes <= self.max_bytes:
+            self._store[key] = entry
+            self.nbytes += values.nbytes
+            self._evict()
+        return entry
+
+    def _evict(self):
+        if self.max_bytes is None:
+            return
+        while self.nbytes > self.max_bytes and len(self._store) > 0:
+            key, entry = self._store.popitem(last=False)
+            self.nbytes -= entry[0].nbytes
+
+    def get_volume(self, kind, expt_id):
+        '''
+        Returns the (volume, header) pair of a given kind, one of VOLUMES,
+        for an experiment.
+        '''
+        return self._entry(kind, expt_id)
+
+    def get_injection_fraction(self, expt_id):
+        return self.get_volume('injection_fraction', expt_id)
+
+    def get_injection_density(self, expt_id):
+        return self.get_volume('injection_density', expt_id)
+
+    def get_projection_density(self, expt_id):
+        return self.get_volume('projection_density', expt_id)
+
+    def get_data_mask(self, expt_id):
+        return self.get_volume('data_mask', expt_id)
+
+    def clear(self):
+        ''' Drop all cached volumes (the hit/miss counters are kept). '''
+        self._store.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'nbytes': self.nbytes, 'volumes': len(self._store)}